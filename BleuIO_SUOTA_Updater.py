@@ -11,13 +11,26 @@
 
 import queue
 import time
+import threading
 import ctypes
 import sys
 import json
+import re
 import argparse
-from bleuio_lib.bleuio_funcs import BleuIO
 import binascii
 import os
+import random
+import sqlite3
+import hashlib
+import platform
+import collections
+import shutil
+import array
+
+try:
+    from bleuio_lib.bleuio_funcs import BleuIO
+except ImportError:
+    BleuIO = None
 
 # Check if on Windows
 if os.name == "nt":
@@ -74,6 +87,14 @@ SUOTA_STATUS_SAME_IMAGE_ERROR = 0x15
 SUOTA_STATUS_EXTERNAL_MEMORY_READ_ERROR = 0x16
 # SUOTA started for downloading image (SUOTA application)
 
+# Statuses that don't report an error
+SUOTA_OK_STATUSES = [
+    SUOTA_STATUS_SRV_STARTED,
+    SUOTA_STATUS_CMP_OK,
+    SUOTA_STATUS_SRV_EXIT,
+    SUOTA_STATUS_IMG_STARTED,
+]
+
 error_list = [
     "UNKNOWN_ERROR",
     "SUOTA_STATUS_SRV_STARTED",
@@ -110,53 +131,173 @@ SUOTA_SERV_STATUS_UUID = "5f78df94-798c-46f5-990a-b3eb6a065c88"
 SUOTA_VERSION_UUID = "64b4e8b5-0de5-401b-a21d-acc8db3b913a"
 SUOTA_PD_CHAR_SIZE_UUID = "42c3dfdd-77be-4d9c-8454-8f875267fb3b"
 SUOTA_MTU_UUID = "b7de1eea-823d-43bb-a3af-c4903dfce23c"
+# PSM of the L2CAP CoC channel, only on devices that can receive the image over L2CAP
+SUOTA_L2CAP_PSM_UUID = "61c8849c-f639-4765-946e-5c3419bebb2a"
+SUOTA_SERVICE_UUID = "0xfef5"
+DIS_FW_VERSION_UUID = "0x2a26"
+
+# Characteristics the updater looks for when browsing
+SUOTA_BROWSE_UUIDS = [
+    SUOTA_MEM_DEV_UUID,
+    SUOTA_GPIO_MAP_UUID,
+    SUOTA_MEM_INFO_UUID,
+    SUOTA_PATCH_LEN_UUID,
+    SUOTA_PATCH_DATA_UUID,
+    SUOTA_SERV_STATUS_UUID,
+    SUOTA_VERSION_UUID,
+    SUOTA_PD_CHAR_SIZE_UUID,
+    SUOTA_MTU_UUID,
+    SUOTA_L2CAP_PSM_UUID,
+    DIS_FW_VERSION_UUID,
+]
 
 # Global
 RETRIES_NUMBER = 3
 DEFAULT_TIMEOUT = 30
+AT_PIPELINE_WINDOW = 4
 BLEUIO_SUOTA_ADV_DATA = "02010603FF5B070302F5FE"
+# Manufacturer specific data of Smart Sensor Devices, advertised in both modes
+BLEUIO_ADV_DATA = "03FF5B07"
+# SUOTA service UUID in the advertising data, only advertised in SUOTA mode
+SUOTA_ADV_MARKER = "0302F5FE"
+VERIFY_TIMEOUT = 60
+# Seconds to keep scanning after the first device is found, to pick the best one
+SCHEDULE_WINDOW = 2
+# Seconds between the checks of find_BleuIO for a device found
+FIND_POLL_INTERVAL = 0.1
+# Candidates are ordered in steps of this many dB, then by their past throughput
+RSSI_STEP = 6
+RSSI_UNKNOWN = -127
+# Number of blocks sent before the transfer rate is checked against --min-rate
+EARLY_RATE_BLOCKS = 8
+# Seconds to scan for a device, not adaptive: it mostly waits for the operator
+SCAN_TIMEOUT = 130
+# Floor and ceiling in seconds of the timeout of each kind of operation
+TIMEOUT_LIMITS = {
+    "connect": (3, 30),
+    "read": (1, DEFAULT_TIMEOUT),
+    "write": (1, DEFAULT_TIMEOUT),
+    "block": (1, DEFAULT_TIMEOUT),
+    # Acks of the SUOTA start and end commands, the end one checks the image
+    "start": (2, DEFAULT_TIMEOUT),
+    "end": (2, DEFAULT_TIMEOUT),
+}
+# Operations whose round-trip time depends on the device, measured again for each session
+SESSION_TIMEOUTS = ["block"]
+# Number of samples needed before the ceiling is lowered
+RTT_MIN_SAMPLES = 3
+# Max number of events waiting to be written with --json, more are dropped
+EVENT_QUEUE_SIZE = 10000
+# SUOTA statuses that count against the image in a --rollout
+ROLLOUT_FAILURE_STATUSES = [
+    SUOTA_STATUS_CRC_ERR,
+    SUOTA_STATUS_PATCH_LEN_ERR,
+    SUOTA_STATUS_APP_ERROR,
+    SUOTA_STATUS_INVALID_IMAGE_BANK,
+    SUOTA_STATUS_INVALID_IMAGE_HEADER,
+    SUOTA_STATUS_INVALID_IMAGE_SIZE,
+    SUOTA_STATUS_INVALID_PRODUCT_HEADER,
+]
+# Frames per second of --dashboard and number of printed lines shown under it
+DASHBOARD_FPS = 4
+DASHBOARD_LOG_LINES = 5
+# L2CAP PSM of the simulated devices with --sim-l2cap, from the LE dynamic range
+SIM_L2CAP_PSM = 0x81
+# Default link assumptions of --plan
+PLAN_CONN_INTERVAL = 0.015
+PLAN_BAUD = 115200
+PLAN_AT_LATENCY = 0.01
+# "AT+GATTCWRITEWRB=0000 " and the line end
+AT_WRITE_CMD_BYTES = 23
+# Echo, Ack and End lines returned by the dongle for a command
+AT_RESPONSE_BYTES = 90
+FAULT_CLASSES = [
+    "drop_notification",
+    "delay_notification",
+    "corrupt_notification",
+    "drop_write_status",
+    "drop_read",
+    "ack_error",
+    "disconnect",
+]
+DEFAULT_HISTORY_FILE = "suota_history.db"
+DEFAULT_INVENTORY_FILE = "suota_inventory.json"
+# Devices not seen for this many days are dropped from the inventory
+INVENTORY_TTL_DAYS = 30
+INVENTORY_TTL = INVENTORY_TTL_DAYS * 24 * 3600
+HISTORY_COLUMNS = [
+    ("started", "REAL"),
+    ("site", "TEXT"),
+    ("port", "TEXT"),
+    ("transport", "TEXT"),
+    ("mac", "TEXT"),
+    ("old_version", "TEXT"),
+    ("new_version", "TEXT"),
+    ("image_name", "TEXT"),
+    ("image_hash", "TEXT"),
+    ("image_size", "INTEGER"),
+    ("mtu", "INTEGER"),
+    ("pd_char_size", "INTEGER"),
+    ("chunk_size", "INTEGER"),
+    ("block_size", "INTEGER"),
+    ("scan_s", "REAL"),
+    ("connect_s", "REAL"),
+    ("handshake_s", "REAL"),
+    ("transfer_s", "REAL"),
+    ("end_s", "REAL"),
+    ("total_s", "REAL"),
+    ("throughput", "REAL"),
+    ("early_rate", "REAL"),
+    ("retries", "INTEGER"),
+    ("rssi", "INTEGER"),
+    ("link", "TEXT"),
+    ("concurrency", "INTEGER"),
+    ("status", "INTEGER"),
+    ("status_name", "TEXT"),
+    ("success", "INTEGER"),
+    ("error", "TEXT"),
+    ("verified", "INTEGER"),
+    ("verified_version", "TEXT"),
+]
+# Phase durations: column, mark at the start of the phase, mark at the end
+HISTORY_PHASES = [
+    ("scan_s", "scan", "connect"),
+    ("connect_s", "connect", "handshake"),
+    ("handshake_s", "handshake", "transfer"),
+    ("transfer_s", "transfer", "end"),
+    ("end_s", "end", "done"),
+]
+HISTORY_GROUPS = {
+    "site": "site",
+    "port": "port",
+    "firmware": "new_version",
+    "mac": "mac",
+    "image": "image_hash",
+}
+
 debug_msg = False
-browse_complete = False
-main_running = True
 bleuio_found = False
-indi_resp_byte_list = []
-noti_resp_byte_list = []
-notifications_q = queue.Queue()
-indication_q = queue.Queue()
-gattc_read_q = queue.Queue()
-gattc_write_rsp_q = queue.Queue()
-dis_fw_ver_handle = ""
-suota_mem_dev_handle = ""
-suota_gpio_map_handle = ""
-suota_mem_info_handle = ""
-suota_patch_len_handle = ""
-suota_patch_data_handle = ""
-suota_serv_status_handle = ""
-suota_version_handle = ""
-suota_pd_char_size_handle = ""
-suota_mtu_handle = ""
-
-global suota_block_size
+transport = None
+scan_transport = None
+verifier = None
+fault_injector = None
+history = None
+inventory = None
+dashboard = None
+events = None
+tracer = None
+preconnect_session = None
+updater_events = None
+continuous = False
+min_rate = 0
+
 global patch_length
 global patch_data_len
 global patch_data
-global current_block_length
-global suota_chunk_size
-global block_offset
-global block_length
-global patch_chunck_offset
-global patch_chunck_length
-
-suota_block_size = 0
+
 patch_length = 0  # counts bytes - must be a multiple of 4
 patch_data_len = MAX_IMAGE_SIZE + CHECKSUM_SIZE
 patch_data = []
-current_block_length = 0
-suota_chunk_size = DEFAULT_DATA_CHUNK_SIZE
-block_offset = 0
-block_length = 0
-patch_chunck_offset = 0
-patch_chunck_length = 0
 
 
 def print_dbg_msg(string):
@@ -165,6 +306,11 @@ def print_dbg_msg(string):
         print(string)
 
 
+def print_line(string):
+    """Prints a whole line in one write, so the lines of several threads don't mix."""
+    print(str(string) + "\n", end="", flush=True)
+
+
 def hex_to_little_endian(hex_string):
     little_endian_hex = bytearray.fromhex(hex_string)[::-1]
     little_endian_hex = str(binascii.hexlify(little_endian_hex))
@@ -175,876 +321,4381 @@ def hex_to_little_endian(hex_string):
     return little_endian_hex
 
 
-def my_scan_callback(scan_input):
-    global bleuio_found
-    global mac_addr
-    global suota_avalible
-    print_dbg_msg("\n\nscan_evt: " + str(scan_input))
-    if not bleuio_found:
-        if '{"SF"' in str(scan_input) and '"data":' in str(scan_input):
-            try:
-                print_dbg_msg(scan_input[0])
-                scan_result = json.loads(scan_input[0])
-                print_dbg_msg("json loads ok")
-                length = len(scan_result["data"])
-                mac = scan_result["addr"]
-                print_dbg_msg("length ok: " + str(length))
-                bleuio_found = True
-                mac_addr = mac
-            except Exception as e:
-                print(str(e))
+class Tracer:
+    """Records spans in the Chrome trace event format.
 
+    The file can be opened in chrome://tracing or https://ui.perfetto.dev.
+    Call sites check `tracer is not None` first, so a disabled tracer costs
+    one comparison. Timestamps come from time.perf_counter().
+    """
 
-def my_evt_callback(evt_input):
-    global browse_complete
-    global suota_avalible
-    global bootloader_open
-    global indi_resp_byte_list
-    global noti_resp_byte_list
-    global dis_fw_ver_handle
-    global suota_mem_dev_handle
-    global suota_gpio_map_handle
-    global suota_mem_info_handle
-    global suota_patch_len_handle
-    global suota_patch_data_handle
-    global suota_serv_status_handle
-    global suota_version_handle
-    global suota_pd_char_size_handle
-    global suota_mtu_handle
-
-    print_dbg_msg("\n\nevt: " + str(evt_input))
-    if '"action":"connected"' in str(evt_input):
-        my_dongle.status.isConnected = True
-    if '"action":"disconnected"' in str(evt_input):
-        print("Disconnected from BleuIO Dongle.")
-        my_dongle.status.isConnected = False
-        browse_complete = False
-    if '"action":"browse completed"' in str(evt_input):
-        browse_complete = True
-    if '"serv","uuid":"0xfef5"' in str(evt_input):
-        suota_avalible = True
-    if ('"uuid":"' + SUOTA_MEM_DEV_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_mem_dev_char = json.loads(evt_input[0])
-            suota_mem_dev_handle = suota_mem_dev_char["evt"]["handle"]
-            suota_mem_dev_handle = str(suota_mem_dev_handle).upper()
-        except Exception as e:
-            print(str(e))
-        suota_avalible = True
-    if ('"uuid":"' + SUOTA_GPIO_MAP_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_gpio_map_char = json.loads(evt_input[0])
-            suota_gpio_map_handle = suota_gpio_map_char["evt"]["handle"]
-            suota_gpio_map_handle = str(suota_gpio_map_handle).upper()
-            print_dbg_msg("SUOTA_GPIO_MAP_UUID Handle: " + suota_gpio_map_handle)
-        except Exception as e:
-            print(str(e))
-    if ('"uuid":"' + SUOTA_MEM_INFO_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_mem_info_char = json.loads(evt_input[0])
-            suota_mem_info_handle = suota_mem_info_char["evt"]["handle"]
-            suota_mem_info_handle = str(suota_mem_info_handle).upper()
-            print_dbg_msg("SUOTA_MEM_INFO_UUID Handle: " + suota_mem_info_handle)
-        except Exception as e:
-            print(str(e))
-    if ('"uuid":"' + SUOTA_PATCH_LEN_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_patch_len_char = json.loads(evt_input[0])
-            suota_patch_len_handle = suota_patch_len_char["evt"]["handle"]
-            suota_patch_len_handle = str(suota_patch_len_handle).upper()
-            print_dbg_msg("SUOTA_PATCH_LEN_UUID Handle: " + suota_patch_len_handle)
-        except Exception as e:
-            print(str(e))
-    if ('"uuid":"' + SUOTA_PATCH_DATA_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_patch_data_char = json.loads(evt_input[0])
-            suota_patch_data_handle = suota_patch_data_char["evt"]["handle"]
-            suota_patch_data_handle = str(suota_patch_data_handle).upper()
-            print_dbg_msg("SUOTA_PATCH_DATA_UUID Handle: " + suota_patch_data_handle)
-        except Exception as e:
-            print(str(e))
-    if ('"uuid":"' + SUOTA_SERV_STATUS_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_serv_status_char = json.loads(evt_input[0])
-            suota_serv_status_handle = suota_serv_status_char["evt"]["handle"]
-            suota_serv_status_handle = str(suota_serv_status_handle).upper()
-            print_dbg_msg("SUOTA_SERV_STATUS_UUID Handle: " + suota_serv_status_handle)
-        except Exception as e:
-            print(str(e))
-    if ('"uuid":"' + SUOTA_VERSION_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_version_char = json.loads(evt_input[0])
-            suota_version_handle = suota_version_char["evt"]["handle"]
-            suota_version_handle = str(suota_version_handle).upper()
-            print_dbg_msg("SUOTA_VERSION_UUID Handle: " + suota_version_handle)
-        except Exception as e:
-            print(str(e))
-    if ('"uuid":"' + SUOTA_PD_CHAR_SIZE_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_pd_char_size_char = json.loads(evt_input[0])
-            suota_pd_char_size_handle = suota_pd_char_size_char["evt"]["handle"]
-            suota_pd_char_size_handle = str(suota_pd_char_size_handle).upper()
-            print_dbg_msg(
-                "SUOTA_PD_CHAR_SIZE_UUID Handle: " + suota_pd_char_size_handle
-            )
-        except Exception as e:
-            print(str(e))
-    if ('"uuid":"' + SUOTA_MTU_UUID) in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            suota_mtu_char = json.loads(evt_input[0])
-            suota_mtu_handle = suota_mtu_char["evt"]["handle"]
-            suota_mtu_handle = str(suota_mtu_handle).upper()
-            print_dbg_msg("SUOTA_MTU_UUID Handle: " + suota_mtu_handle)
-        except Exception as e:
-            print(str(e))
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+        self._threads = {}
 
-    # Get DIS FW Handle
-    if '"uuid":"0x2a26"' in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{768", '{"768"')
-            dis_fw_ver_char = json.loads(evt_input[0])
-            dis_fw_ver_handle = dis_fw_ver_char["evt"]["handle"]
-            dis_fw_ver_handle = str(dis_fw_ver_handle).upper()
-            print_dbg_msg("DIS FW Ver Handle: " + dis_fw_ver_handle)
-        except Exception as e:
-            print(str(e))
-    # Get FW version
-    if '{775:"0000","evt":{"handle":"' in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{775", '{"775"')
-            read_obj = json.loads(evt_input[0])
-            print_dbg_msg(evt_input[0])
-            if read_obj["evt"]["len"] == 0:
-                data = "00"
-            else:
-                data = read_obj["evt"]["hex"]
-                data = data.replace("0x", "")
-            if dis_fw_ver_handle.lower() in str(evt_input):
-                byte_string = bytes.fromhex(data)
-                read_data = byte_string.decode("ASCII")
-            elif suota_version_handle in str(evt_input):
-                read_data = str(int(data, 16) / 10)
-            else:
-                print_dbg_msg("read: " + data)
-                data = hex_to_little_endian(data)
-                print_dbg_msg("read to little endian: " + data)
-                read_data = str(int(data, 16))
-            gattc_read_q.put(read_data)
-        except Exception as e:
-            print(str(e))
-    if '","writeStatus":' in str(evt_input):
-        if (
-            not '"handle":"0024"' in str(evt_input)
-            and not '"handle":"0000"' in str(evt_input)
-            and not '"handle":"0021"' in str(evt_input)
-        ):
-            success = 1
-            if '"writeStatus":0' in str(evt_input):
-                success = 0
-            else:
-                success = 1
-            gattc_write_rsp_q.put(success)
-            print_dbg_msg("Put '" + str(success) + "' in gattc_write_rsp_q")
-    # Notifications
-    if '777:"0000"' in str(evt_input) and '"hex":' in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{777", '{"777"')
-            suota_noti = json.loads(evt_input[0])
-            length = suota_noti["evt"]["len"]
-            data = suota_noti["evt"]["hex"]
-            data = data.replace("0x", "")
-            suota_code = int(data, 16)
-            notifications_q.put(suota_code)
-        except Exception as e:
-            print(str(e))
-    # Indications
-    if '778:"0000"' in str(evt_input) and '"hex":' in str(evt_input):
-        try:
-            evt_input[0] = str(evt_input[0]).replace("{778", '{"778"')
-            suota_noti = json.loads(evt_input[0])
-            length = suota_noti["evt"]["len"]
-            data = suota_noti["evt"]["hex"]
-            data = data.replace("0x", "")
-            indi_resp_byte_list = []
-            for i in range(length):
-                indi_resp_byte_list.append(int(data[(i * 2) : (i * 2) + 2], 16))
-            indication_q.put(indi_resp_byte_list)
-            print_dbg_msg(
-                "Indication: " + str(binascii.hexlify(bytearray(indi_resp_byte_list)))
+    def now(self):
+        return time.perf_counter()
+
+    def _us(self, t):
+        return round((t - self._origin) * 1000000, 1)
+
+    def _tid(self):
+        tid = threading.get_ident()
+        self._threads[tid] = threading.current_thread().name
+        return tid
+
+    def span(self, name, cat, start, **args):
+        """Records a span from `start` (a now() value) until now on the calling thread."""
+        end = time.perf_counter()
+        self.events.append(
+            {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": self._us(start),
+                "dur": self._us(end) - self._us(start),
+                "pid": self._pid,
+                "tid": self._tid(),
+                "args": args,
+            }
+        )
+
+    def async_span(self, name, cat, id, start, **args):
+        """Records a span that can overlap others, e.g. a pipelined AT command."""
+        end = time.perf_counter()
+        tid = self._tid()
+        for ph, t in [("b", start), ("e", end)]:
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": cat,
+                    "ph": ph,
+                    "id": id,
+                    "ts": self._us(t),
+                    "pid": self._pid,
+                    "tid": tid,
+                    "args": args if ph == "b" else {},
+                }
             )
-        except Exception as e:
-            print(str(e))
-
-
-def connect_to_BleuIO(mac):
-    global my_dongle
-    global suota_avalible
-    global browse_complete
-    global bootloader_open
-    suota_avalible = False
-    browse_complete = False
-    bootloader_open = False
-    my_dongle.at_gapconnect(mac)
-    CONN_TIMEOUT = 30
-    conn_cnt = 0
-    while not my_dongle.status.isConnected and conn_cnt < CONN_TIMEOUT:
-        time.sleep(0.1)
-        print("#", end="", flush=True)
-        conn_cnt += 0.1
-        pass
-    if not my_dongle.status.isConnected:
-        print(
-            f"\n\n{bcolors.WARNING}-:CANNOT CONNECT TO BleuIO Dongle:-\r\n{bcolors.ENDC}"
+
+    def instant(self, name, cat, **args):
+        self.events.append(
+            {
+                "name": name,
+                "cat": cat,
+                "ph": "i",
+                "s": "t",
+                "ts": self._us(time.perf_counter()),
+                "pid": self._pid,
+                "tid": self._tid(),
+                "args": args,
+            }
         )
-        my_dongle.at_cancel_connect()
-        raise Exception("Cannot connect!")
-    print("\n\n")
-    print("Connected to " + mac + "\n")
-    time.sleep(1)
 
+    def save(self):
+        names = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self._pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in list(self._threads.items())
+        ]
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": names + list(self.events)}, f)
+        print("Trace written to %s (%d events)." % (self.path, len(self.events)))
 
-def find_BleuIO(id):
-    global my_dongle
-    global bleuio_found
-    global main_running
-    global mac_addr
-    bleuio_found = False
-    print_dbg_msg("find_BleuIO(%s)" % (id))
 
-    my_dongle.at_findscandata(id)
-    SCAN_TIMEOUT = 130
-    scan_cnt = 0
-    while not bleuio_found and scan_cnt < SCAN_TIMEOUT:
-        time.sleep(1)
-        scan_cnt += 1
-        if scan_cnt % 2 == 0:
-            print("#", end="", flush=True)
-        pass
-    if not bleuio_found:
-        print(
-            f"\n\n{bcolors.WARNING}-:CANNOT FIND ANY BLEUIO DONGLE IN SOUTA MODE:-\r\n{bcolors.ENDC}Please make sure the BleuIO Dongle is in SUOTA mode and advertising then try again."
-        )
-        my_dongle.stop_scan()
-        raise Exception("Cannot find BleuIO!")
-    print("\n\n")
-    my_dongle.stop_scan()
-    mac_addr = str(mac_addr).upper()
-
-    found_mac = "[0]" + mac_addr
-    print(f"Found BleuIO Dongle ({mac_addr}).\n")
-
-    time.sleep(0.5)
-    return found_mac
-
-
-# /**
-#  ****************************************************************************************
-#  * @brief Checks if the current block is the last block of the image.
-#  *
-#  * @return True if the current block is the last block of the image.
-#  ****************************************************************************************
-#  */
-def is_last_block():
-    global block_offset
-    global block_length
-    global patch_length
-    return (block_offset + block_length) == patch_length
-
-
-# /**
-#  ****************************************************************************************
-#  * @brief Advances current block to the next block of the image.
-#  *
-#  * If the current block is the last block of the image then no action is taken
-#  ****************************************************************************************
-#  */
-def next_block():
-    global block_offset
-    global block_length
-    global patch_length
-    global suota_block_size
-    if is_last_block():
+def traced_sleep(seconds):
+    if tracer is None:
+        time.sleep(seconds)
         return
+    start = tracer.now()
+    time.sleep(seconds)
+    tracer.span("sleep", "sleep", start, seconds=seconds)
 
-    # // update current block offset and length
-    block_offset += block_length
-    if (patch_length - block_offset) > suota_block_size:
-        block_length = suota_block_size
-    else:
-        block_length = patch_length - block_offset
-
-
-# /**
-#  ****************************************************************************************
-#  * @brief Checks if the current chunk of the current block is the last chunk of the block.
-#  *
-#  * @return True if the current chunk is the last chunk of the current block.
-#  ****************************************************************************************
-#  */
-def is_last_chunk():
-    global patch_chunck_offset
-    global patch_chunck_length
-    global block_length
-    return (patch_chunck_offset + patch_chunck_length) == block_length
-
-
-# /**
-#  ****************************************************************************************
-#  * @brief Advances current chunk to the next chunk of the current block.
-#  *
-#  * If the current chunk is the last chunk of the current block then no action is taken
-#  ****************************************************************************************
-#  */
-def next_chunk():
-    global patch_chunck_offset
-    global patch_chunck_length
-    global block_length
-    global suota_chunk_size
-    if is_last_chunk():
-        return
 
-    # // update next chunk offset and length
-    patch_chunck_offset += patch_chunck_length
-    if (block_length - patch_chunck_offset) > suota_chunk_size:
-        patch_chunck_length = suota_chunk_size
-    else:
-        patch_chunck_length = block_length - patch_chunck_offset
-
-
-# /**
-#  ****************************************************************************************
-#  * @brief Writes the current block length to SUOTA_PATCH_LEN characteristic
-#  ****************************************************************************************
-#  */
-def app_suota_write_patch_len():
-    global block_length
-
-    value1 = block_length & 0xFF
-    value2 = (block_length >> 8) & 0xFF
-    value_str = "%02X%02X" % (value1, value2)
-    if writeToChar(suota_patch_len_handle, value_str, False):
-        print_dbg_msg("write_patch_len: " + value_str)
-        return True
-    else:
-        return False
+class AtPipeline:
+    """Queues AT commands to the dongle without waiting for each Ack.
 
+    While running, the pipeline owns the serial port: the reader thread of
+    bleuio_lib is stopped and a reader of our own matches Acks to the queued
+    commands in order (the dongle executes AT commands in the order received)
+    and forwards events and scan results to the registered callbacks.
+    Up to `window` commands are written to the serial port in one bulk write.
+    After that the pipeline waits until half of the window is acked and
+    writes the commands queued meanwhile in one bulk write again, rather
+    than one write per freed slot.
+    """
 
-# /**
-#  ****************************************************************************************
-#  * @brief Writes the current chunk to SUOTA_PATCH_DATA characteristic
-#  ****************************************************************************************
-#  */
-def app_suota_write_current_block_chunk():
-    global patch_chunck_offset
-    global patch_chunck_length
-    global block_offset
-    global expected_write_completion_events_counter
+    def __init__(self, dongle, evt_cb, scan_cb=None, window=AT_PIPELINE_WINDOW):
+        self.dongle = dongle
+        self.evt_cb = evt_cb
+        self.scan_cb = scan_cb
+        self.window = max(1, int(window))
+        # Free slots to wait for before writing again
+        self.refill = max(1, self.window // 2)
+        self.running = False
+        self.errors = []
+        self._cond = threading.Condition()
+        self._batch = []
+        self._outstanding = []
+        self._cmd_count = 0
+        self._done_count = 0
+        self._first_submit = None
+        self._last_done = None
+        self._reader_alive = False
+        self._reader_thread = None
 
-    value_str = ""
+    def start(self):
+        """Takes over the serial port from bleuio_lib."""
+        if self.running:
+            return
+        self.dongle._stop_reader()
+        self._rx_buffer = self.dongle.rx_buffer
+        self.dongle.rx_buffer = b""
+        self.errors = []
+        self._cmd_count = 0
+        self._done_count = 0
+        self._first_submit = None
+        self._last_done = None
+        self._reader_alive = True
+        self._reader_thread = threading.Thread(
+            target=self._poll_serial, name="at_pipeline_rx"
+        )
+        self._reader_thread.daemon = True
+        self._reader_thread.start()
+        self.running = True
 
-    for x in range(
-        block_offset + patch_chunck_offset,
-        (block_offset + patch_chunck_offset) + patch_chunck_length,
-    ):
-        value_str += "%02X" % (patch_data[x])
+    def stop(self, timeout=DEFAULT_TIMEOUT):
+        """Waits for all queued commands and hands the serial port back to bleuio_lib."""
+        if not self.running:
+            return
+        try:
+            self.flush(timeout)
+        finally:
+            self._reader_alive = False
+            self._reader_thread.join()
+            self.running = False
+            self.dongle.rx_buffer = self._rx_buffer
+            self.dongle._start_reader()
 
-    if writeToChar(suota_patch_data_handle, value_str, True):
-        if not expected_write_completion_events_counter <= 0:
-            expected_write_completion_events_counter -= 1
-        else:
-            print(
-                "expected_write_completion_events_counter error: %d"
-                % (expected_write_completion_events_counter)
+    def submit(self, cmd):
+        """Queues an AT command. Blocks only while the window is full."""
+        with self._cond:
+            if self._first_submit is None:
+                self._first_submit = time.time()
+            self._cmd_count += 1
+            self._batch.append(
+                [self._cmd_count, cmd, None, tracer.now() if tracer is not None else 0]
             )
-    else:
-        print("app_suota_write_current_block_chunk ERROR!")
-        print_dbg_msg(value_str)
-
-
-# /**
-#  ****************************************************************************************
-#  * @brief  Calculates and prints current upload progress
-#  ****************************************************************************************
-#  */
-def app_suota_show_upload_progress():
-    global block_length
-    global block_offset
-    global patch_length
-    progress = ((block_offset + block_length) * 100) / patch_length
-    try:
-        response = notifications_q.get(timeout=DEFAULT_TIMEOUT)
-        if not response == SUOTA_STATUS_CMP_OK:
-            print("Image file error: %02X (%s)" % (response, error_list[response]))
-            my_dongle.at_gapdisconnectall()
-            if response == SUOTA_STATUS_SAME_IMAGE_ERROR:
-                raise Exception("Device is already updated")
-            if response == SUOTA_STATUS_INVALID_PRODUCT_HEADER:
-                raise Exception("Invalid Product Header!")
-            raise Exception("Image file error.")
-    except:
-        raise Exception("No response or error response!")
-    if progress == 100:
-        print("Upload complete.")
-    else:
-        print("Uploading : %.1f %% " % (progress))
-        print_dbg_msg(
-            "block_length: %d, block_offset: %d, patch_length:%d"
-            % (block_length, block_offset, patch_length)
+            if len(self._batch) + len(self._outstanding) < self.window:
+                return self._cmd_count
+            index = self._cmd_count
+        self._write_batch()
+        if tracer is not None:
+            start = tracer.now()
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: len(self._outstanding) <= self.window - self.refill,
+                DEFAULT_TIMEOUT,
+            ):
+                raise Exception("AT pipeline stalled!")
+        if tracer is not None:
+            tracer.span("window wait", "wait", start)
+        return index
+
+    def flush(self, timeout=DEFAULT_TIMEOUT):
+        """Waits until every queued command is acked.
+
+        :returns: List of (index, cmd, err) for the commands acked with an error since the last flush.
+        """
+        self._write_batch()
+        with self._cond:
+            if not self._cond.wait_for(lambda: not self._outstanding, timeout):
+                raise Exception("AT pipeline stalled!")
+            errors = self.errors
+            self.errors = []
+        return errors
+
+    def commands_per_second(self):
+        """Measured rate of acked commands since start()."""
+        with self._cond:
+            if self._first_submit is None or self._last_done is None:
+                return 0.0
+            elapsed = self._last_done - self._first_submit
+            if elapsed <= 0:
+                return 0.0
+            return self._done_count / elapsed
+
+    def _write_batch(self):
+        with self._cond:
+            batch = self._batch
+            self._batch = []
+            self._outstanding.extend(batch)
+        if batch:
+            self.dongle._serial.write(
+                b"".join((entry[1] + "\r").encode() for entry in batch)
+            )
+
+    def _poll_serial(self):
+        serial_port = self.dongle._serial
+        while self._reader_alive:
+            try:
+                self._rx_buffer += serial_port.read(serial_port.in_waiting or 1)
+            except Exception as e:
+                print("exception: " + str(e))
+                self._reader_alive = False
+                break
+            while b"\n" in self._rx_buffer:
+                line, self._rx_buffer = self._rx_buffer.split(b"\n", 1)
+                line = line.decode("utf-8", "ignore").strip()
+                if line:
+                    self._handle_line(line)
+
+    def _handle_line(self, line):
+        if '"evt":' in line:
+            try:
+                self.evt_cb([line])
+            except Exception as e:
+                print_dbg_msg("at_pipeline evt_cb: " + str(e))
+        elif line.startswith('{"A"'):
+            with self._cond:
+                if self._outstanding:
+                    try:
+                        self._outstanding[0][2] = json.loads(line)["err"]
+                    except Exception:
+                        self._outstanding[0][2] = -1
+        elif line.startswith('{"E"'):
+            with self._cond:
+                if self._outstanding:
+                    index, cmd, err, submitted = self._outstanding.pop(0)
+                    if tracer is not None:
+                        tracer.async_span(
+                            cmd.split("=")[0], "at", index, submitted, err=err
+                        )
+                    if err:
+                        self.errors.append((index, cmd, err))
+                    self._done_count += 1
+                    self._last_done = time.time()
+                    self._cond.notify_all()
+        elif line.startswith('{"S') and not line.startswith('{"SE'):
+            if self.scan_cb is not None:
+                try:
+                    self.scan_cb([line])
+                except Exception as e:
+                    print_dbg_msg("at_pipeline scan_cb: " + str(e))
+
+
+class DiscoveryQueue:
+    """SUOTA advertisers waiting for an update.
+
+    The best candidate is updated first: devices not known to run the new
+    firmware in the inventory, then the strongest signal in steps of
+    RSSI_STEP dB, then the highest throughput in the history, then the first
+    found. Deferred devices come after all others.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._macs = []
+        self._attempts = {}
+        self._updated = set()
+        self._deferred = set()
+        # Devices being updated
+        self._active = set()
+        self._rssi = {}
+        self._throughput = {}
+        self.current = None
+
+    def add(self, mac, rssi=None):
+        """Queues `mac`, or updates its RSSI if it is already queued.
+
+        :returns: True if `mac` is waiting for an update.
+        """
+        mac = str(mac).upper()
+        with self._lock:
+            if (
+                mac in self._active
+                or mac in self._updated
+                or self._attempts.get(mac, 0) >= RETRIES_NUMBER
+            ):
+                return False
+        if inventory is not None and inventory.up_to_date(mac):
+            return False
+        with self._lock:
+            if rssi is not None:
+                self._rssi[mac] = rssi
+            if mac in self._macs:
+                return True
+            self._macs.append(mac)
+        if mac not in self._throughput and history is not None:
+            self._throughput[mac] = history.throughput(mac)
+        print_dbg_msg("Queued BleuIO Dongle: %s rssi: %s" % (mac, rssi))
+        return True
+
+    def pop(self):
+        """Returns the best queued MAC address or None."""
+        with self._lock:
+            if not self._macs:
+                return None
+            mac = max(self._macs, key=self._score)
+            self._macs.remove(mac)
+            return mac
+
+    def rssi(self, mac):
+        return self._rssi.get(str(mac).upper())
+
+    def _score(self, mac):
+        rssi = self._rssi.get(mac)
+        if rssi is None:
+            rssi = RSSI_UNKNOWN
+        return (
+            mac not in self._deferred,
+            inventory is None or inventory.stale(mac),
+            rssi // RSSI_STEP,
+            self._throughput.get(mac) or 0,
         )
 
+    def start(self, mac):
+        """Marks `mac` as the device being updated."""
+        mac = str(mac).upper()
+        with self._lock:
+            if mac in self._macs:
+                self._macs.remove(mac)
+            self._attempts[mac] = self._attempts.get(mac, 0) + 1
+            self._active.add(mac)
+            self.current = mac
 
-# /**
-#  ****************************************************************************************
-#  * @brief  Writes current block to SUOTA_PATCH_DATA  in 20 byte chunks
-#  ****************************************************************************************
-#  */
-def app_suota_write_chunks():
-    # init 1st chunk of block
-    global patch_chunck_length
-    global patch_chunck_offset
-    global block_length
-    global expected_write_completion_events_counter
-    patch_chunck_offset = 0  # offset in block
-
-    if (block_length - patch_chunck_offset) > suota_chunk_size:
-        patch_chunck_length = suota_chunk_size
-    else:
-        patch_chunck_length = block_length - patch_chunck_offset
-
-    expected_write_completion_events_counter = 0
-    while 1:
-        expected_write_completion_events_counter += 1
-        app_suota_write_current_block_chunk()
-        if is_last_chunk():
-            break
-        next_chunk()
-    app_suota_show_upload_progress()
-
-
-# /**
-#  ****************************************************************************************
-#  * @brief  Sends the SUOTA END command
-#  ****************************************************************************************
-#  */
-def app_suota_end():
-    # SUOTA END
-    value3 = 0xFE
-    value2 = 0
-    value1 = 0
-    value0 = 0
-    value_str = "%02X%02X%02X%02X" % (value0, value1, value2, value3)
-    print_dbg_msg("app_suota_end: " + str(value_str))
-    writeToChar(suota_mem_dev_handle, value_str, False)
-
-
-def app_suota_reboot():
-    # reboot
-    value3 = 0xFD
-    value2 = 0
-    value1 = 0
-    value0 = 0
-    value_str = "%02X%02X%02X%02X" % (value0, value1, value2, value3)
-    print_dbg_msg("app_suota_reboot: " + str(value_str))
-    my_dongle.at_gattcwriteb(suota_mem_dev_handle, value_str)
+    def attempts(self, mac):
+        """Returns how many times an update of `mac` was started."""
+        with self._lock:
+            return self._attempts.get(str(mac).upper(), 0)
 
+    def defer(self, mac):
+        """Puts the current device back in the queue behind the others.
 
-def checksum(data, len):
-    crc_code = 0
-    i = 0
+        A device is only deferred once, and only if a device that was not
+        deferred is waiting.
+        :returns: True if the device was deferred.
+        """
+        mac = str(mac).upper()
+        with self._lock:
+            waiting = [m for m in self._macs if m not in self._deferred]
+            if not waiting or mac in self._deferred or mac not in self._active:
+                return False
+            self._deferred.add(mac)
+            # Not a failed attempt
+            self._attempts[mac] -= 1
+            self._macs.append(mac)
+            self._active.discard(mac)
+            if mac == self.current:
+                self.current = None
+            return True
 
-    # for(i = 0; i < len; i++)
-    for i in range(0, len):
-        crc_code ^= data[i]
+    def finish(self, success, mac=None):
+        """Ends the update of `mac`, the current device if not given."""
+        with self._lock:
+            if mac is None:
+                mac = self.current
+            if mac is None:
+                return
+            mac = str(mac).upper()
+            if success:
+                self._updated.add(mac)
+            self._active.discard(mac)
+            if mac == self.current:
+                self.current = None
 
-    return crc_code
+    def active(self):
+        """Returns how many devices are being updated."""
+        with self._lock:
+            return len(self._active)
 
+    def __len__(self):
+        with self._lock:
+            return len(self._macs)
 
-def writeToChar(handle, value, noResp):
-    success = False
-    if noResp:
-        resp = my_dongle.at_gattcwritewrb(handle, value)
-        if not resp.Ack["err"] == 0:
-            print("AT Command error: %02X" % (resp.Ack["err"]))
-        else:
-            success = True
-    else:
-        resp = my_dongle.at_gattcwriteb(handle, value)
-        if not resp.Ack["err"] == 0:
-            print("AT Command error: %02X" % (resp.Ack["err"]))
-            return success
-        try:
-            response = gattc_write_rsp_q.get(timeout=DEFAULT_TIMEOUT)
-        except:
-            print("No write confirmation!")
-            print_dbg_msg("Write to Char: " + value)
-            return success
-        if response == 0:
-            print_dbg_msg("BLE Write OK: %02X" % (response))
-            success = True
-        else:
-            print("BLE Write error: %02X" % (response))
-    return success
 
+discovery = DiscoveryQueue()
 
-def main():
-    global main_running
-    global debug_msg
-    global my_dongle
-    global SSD00x_ID
-    global mac_addr
-    global suota_firmware_name
-    global suota_avalible
-    global suota_dat_file
-    global suota_bin_file
-    global bootloader_open
 
-    global suota_block_size
-    global current_block_length
-    global suota_chunk_size
+class UpdaterEvents:
+    """Receives the events reported by the main SuotaTransport.
 
-    global block_offset
-    global block_length
+    Adverts go to the discovery queue, the events of the connection to the
+    SuotaSession that main() is running, if any.
+    """
 
-    global patch_chunck_offset
-    global patch_chunck_length
+    def __init__(self):
+        self.session = None
 
-    global patch_length
-    global patch_data_len
-    global patch_data
+    def on_adv(self, mac, data, rssi):
+        global bleuio_found
+        print_dbg_msg("adv: %s rssi: %s data: %s" % (mac, rssi, data))
+        if inventory is not None:
+            inventory.seen(mac, SUOTA_ADV_MARKER in str(data), rssi)
+        if discovery.add(mac, rssi):
+            bleuio_found = True
 
-    parser = argparse.ArgumentParser(
-        "Requires SUOTA firmware img file to update BleuIO Dongle with."
-    )
-    parser.add_argument(
-        "-fw",
-        help="Requires SUOTA firmware img file to update BleuIO Dongle with.",
-        required=True,
-        default=None,
-    )
-    parser.add_argument("-dbg", "--debug", action="store_true", help="shows debug msg")
-    parser.add_argument(
-        "-p",
-        "--port",
-        required=False,
-        default="",
-        help="Choose port used by dongle used to update. If note choosen the first port found used by a BleuIO Dongle will be used.",
-    )
-    args = parser.parse_args()
+    def on_connected(self):
+        print_dbg_msg("connected")
+        if self.session is not None:
+            self.session.on_connected()
 
-    suota_firmware_name = args.fw
-    if args.debug:
-        debug_msg = True
+    def on_disconnected(self):
+        print_line("Disconnected from BleuIO Dongle.")
+        if self.session is not None:
+            self.session.on_disconnected()
 
-    custom_port = args.port
-    if custom_port:
-        my_dongle = BleuIO(port=custom_port)
-    else:
-        my_dongle = BleuIO()
+    def on_browse_complete(self):
+        if self.session is not None:
+            self.session.on_browse_complete()
 
-    try:
-        f = open(suota_firmware_name, "rb")
-        patch_data = f.read()
-        patch_length = len(patch_data)
-        if patch_length > patch_data_len:
-            print("Firmare file is too big.")
-            f.close
-            sys.exit(1)
-        f.close
-    except Exception as e:
-        print(e)
-        sys.exit(1)
+    def on_service(self, uuid):
+        if self.session is not None:
+            self.session.on_service(uuid)
 
-    check = checksum(patch_data, patch_length)
+    def on_characteristic(self, uuid, handle):
+        if self.session is not None:
+            self.session.on_characteristic(uuid, handle)
 
-    patch_data += bytes([check])
-    patch_length += 1
+    def on_read(self, handle, data):
+        if self.session is not None:
+            self.session.on_read(handle, data)
 
-    print(
-        f"\n-BleuIO_SUOTA_SSD00X_Updater.py\n-Version: {bcolors.OKCYAN}{fw_version}{bcolors.ENDC}"
-    )
-    print(f"-Created: {bcolors.OKCYAN}{created}\r\n{bcolors.ENDC}")
-    print(
-        "-=:Welcome to Smart Sensor Devices Script for Updating the BleuIO Dongle Firmware (SUOTA):=-\r\n"
-    )
-    print_dbg_msg("File size: %d bytes" % (patch_length))
+    def on_write_status(self, handle, status):
+        if self.session is not None:
+            self.session.on_write_status(handle, status)
 
-    # Init
-    my_dongle.register_evt_cb(my_evt_callback)
-    my_dongle.register_scan_cb(my_scan_callback)
-    my_dongle.at_cancel_connect()
-    my_dongle.at_gapdisconnectall()
-    my_dongle.at_dual()
-    my_dongle.ata(False)
-    resp = my_dongle.send_command("AT+MTU=512")
-    for r in resp:
-        print_dbg_msg(r.decode("ascii"))
+    def on_notification(self, handle, data):
+        if self.session is not None:
+            self.session.on_notification(handle, data)
 
-    update_done = False
-    while not update_done:
-        print_dbg_msg("Entring while not update_done")
-        tryingToConnect = True
-        err = False
-        main_running = True
-        while tryingToConnect:
-            print(
-                f"\r\nLooking to update BleuIO Dongle with fw: {suota_firmware_name}\r\n\r\n"
+    def on_indication(self, handle, data):
+        if self.session is not None:
+            self.session.on_indication(handle, data)
+
+
+class SuotaTransport:
+    """The BLE central operations used by the updater.
+
+    Results and events are reported asynchronously to `handler` (see
+    UpdaterEvents). Characteristic handles are opaque strings given by the
+    transport in on_characteristic(). Data is passed as bytes.
+    """
+
+    name = ""
+    # Dongle port or adapter the transport runs on, recorded in the history
+    port = ""
+    # True if the transport can keep scanning while connected
+    background_scan = False
+    # True if the transport can open L2CAP connection-oriented channels
+    l2cap = False
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def start(self):
+        """Puts the central in a known state before the first scan."""
+        pass
+
+    def close(self):
+        pass
+
+    def scan(self, adv_data):
+        """Starts scanning for devices advertising `adv_data` (hex str), reported by on_adv()."""
+        raise NotImplementedError
+
+    def stop_scan(self):
+        raise NotImplementedError
+
+    def connect(self, mac):
+        """Initiates a connection, reported by on_connected()."""
+        raise NotImplementedError
+
+    def cancel_connect(self):
+        raise NotImplementedError
+
+    def browse(self):
+        """Discovers services and characteristics, ends with on_browse_complete()."""
+        raise NotImplementedError
+
+    def read(self, handle):
+        """Reads a characteristic, the value is reported by on_read()."""
+        raise NotImplementedError
+
+    def write(self, handle, data, response=False):
+        """Writes a characteristic.
+
+        With response the write status is reported by on_write_status().
+        :returns: 0 if the write was sent, otherwise a transport error code.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """Waits for the writes queued by the transport.
+
+        :returns: List of (index, command, err) for the queued writes that failed.
+        """
+        return []
+
+    def subscribe(self, handle):
+        """Enables notifications, reported by on_notification()."""
+        raise NotImplementedError
+
+    def l2cap_connect(self, psm):
+        """Opens an L2CAP CoC channel to the connected device.
+
+        :returns: True if the channel is open.
+        """
+        return False
+
+    def l2cap_send(self, data):
+        """Sends one SDU on the L2CAP channel, blocking while out of credits.
+
+        :returns: 0 if the SDU was sent, otherwise a transport error code.
+        """
+        raise NotImplementedError
+
+    def l2cap_close(self):
+        pass
+
+    def open_connection(self, handler):
+        """Returns a transport for one more connection on the same central.
+
+        Its events go to `handler`. Used to run several sessions at once.
+        """
+        raise Exception("The %s transport can't run several sessions." % (self.name))
+
+    def disconnect(self):
+        raise NotImplementedError
+
+    def is_connected(self):
+        raise NotImplementedError
+
+    def bulk_start(self):
+        """Called before the image transfer."""
+        pass
+
+    def bulk_stop(self):
+        """Called after the image transfer."""
+        pass
+
+    def commands_per_second(self):
+        """Measured command rate of the last bulk transfer, 0 if not measured."""
+        return 0.0
+
+    def hold(self):
+        """Keeps the central on this connection until release(), e.g. for the chunks of a block."""
+        pass
+
+    def release(self):
+        pass
+
+
+class BleuIOTransport(SuotaTransport):
+    """Central role of a BleuIO dongle, driven over its AT command interface."""
+
+    name = "bleuio"
+
+    def __init__(
+        self, handler, port="", pipeline=False, pipeline_window=AT_PIPELINE_WINDOW
+    ):
+        SuotaTransport.__init__(self, handler)
+        if BleuIO is None:
+            raise Exception("The bleuio library is needed for the BleuIO transport!")
+        if port:
+            self.dongle = BleuIO(port=port)
+        else:
+            self.dongle = BleuIO()
+        self.port = self.dongle._port
+        self.dongle.register_evt_cb(self._evt_callback)
+        self.dongle.register_scan_cb(self._scan_callback)
+        # Connections opened with open_connection(), by connection index
+        self._connections = {}
+        self._connecting = None
+        self._connecting_mac = None
+        self._target = None
+        self._cmd_lock = threading.RLock()
+        # Held from a connect until it succeeds or is cancelled, the dongle
+        # makes one connection at a time
+        self._connect_lock = threading.Lock()
+        self._connect_state_lock = threading.Lock()
+        self.pipeline = None
+        if pipeline:
+            self.pipeline = AtPipeline(
+                self.dongle, self._evt_callback, self._scan_callback, pipeline_window
+            )
+
+    def start(self):
+        self.dongle.at_cancel_connect()
+        self.dongle.at_gapdisconnectall()
+        self.dongle.at_dual()
+        self.dongle.ata(False)
+        resp = self.dongle.send_command("AT+MTU=512")
+        for r in resp:
+            print_dbg_msg(r.decode("ascii"))
+
+    def scan(self, adv_data):
+        self.dongle.at_findscandata(adv_data)
+
+    def stop_scan(self):
+        self.dongle.stop_scan()
+
+    def connect(self, mac):
+        # BleuIO expects the address type in front of the address
+        if not mac.startswith("["):
+            mac = "[0]" + mac
+        self.dongle.at_gapconnect(mac)
+
+    def cancel_connect(self):
+        self.dongle.at_cancel_connect()
+
+    def browse(self):
+        # The dongle browses the services by itself after connecting
+        pass
+
+    def read(self, handle):
+        if tracer is not None:
+            start = tracer.now()
+        self.dongle.at_gattcread(handle)
+        if tracer is not None:
+            tracer.span("AT+GATTCREAD", "at", start, handle=handle)
+
+    def write(self, handle, data, response=False):
+        value = data.hex().upper()
+        if self.pipeline is not None and self.pipeline.running:
+            if not response:
+                # Acks are matched by the pipeline, errors are reported by flush()
+                self.pipeline.submit("AT+GATTCWRITEWRB=" + handle + " " + value)
+                return 0
+            self.pipeline.submit("AT+GATTCWRITEB=" + handle + " " + value)
+            errors = self.pipeline.flush()
+            if errors:
+                return errors[0][2]
+            return 0
+        if tracer is not None:
+            start = tracer.now()
+        if response:
+            resp = self.dongle.at_gattcwriteb(handle, value)
+        else:
+            resp = self.dongle.at_gattcwritewrb(handle, value)
+        if tracer is not None:
+            tracer.span(
+                "AT+GATTCWRITEB" if response else "AT+GATTCWRITEWRB",
+                "at",
+                start,
+                handle=handle,
+                bytes=len(data),
             )
-            print_dbg_msg("Entring while tryingToConnect:")
+        return resp.Ack["err"]
+
+    def flush(self):
+        if self.pipeline is not None and self.pipeline.running:
+            return self.pipeline.flush()
+        return []
+
+    def subscribe(self, handle):
+        self.dongle.at_set_noti(handle)
+
+    def disconnect(self):
+        # Hand the serial port back to bleuio_lib first
+        if self.pipeline is not None and self.pipeline.running:
             try:
-                bleuio_mac = find_BleuIO(BLEUIO_SUOTA_ADV_DATA)
-                print(
-                    f"\nConnecting to BleuIO Dongle: {bcolors.OKCYAN} (MAC Addr: {mac_addr}){bcolors.ENDC}\n"
-                )
-                connect_to_BleuIO(bleuio_mac)
-                tryingToConnect = False
-                err = False
-                print("Connect Success!")
+                self.pipeline.stop(timeout=1)
             except Exception as e:
                 print_dbg_msg(e)
-                err = True
-                tryingToConnect = False
+        self.dongle.at_gapdisconnectall()
 
-        # main loop
-        main_running_counter = 0
-        try:
-            while main_running:
-                if err:
-                    main_running = False
-                    break
-                if main_running_counter >= 250:
-                    my_dongle.at_cancel_connect()
-                    my_dongle.at_gapdisconnectall()
-                    print("Failed to connect.")
-                    main_running = False
-                    break
+    def is_connected(self):
+        return self.dongle.status.isConnected
 
-                if my_dongle.status.isConnected and browse_complete:
-                    if suota_avalible:
-                        suota_block_size = 0
-                        current_block_length = 0
-                        suota_chunk_size = DEFAULT_DATA_CHUNK_SIZE
-
-                        block_offset = 0
-                        block_length = 0
-
-                        patch_chunck_offset = 0
-                        patch_chunck_length = 0
-                        while not notifications_q.qsize() == 0:
-                            temp_val = notifications_q.get()
-                            print_dbg_msg(
-                                "Get message from notifications_q: " + str(temp_val)
-                            )
-                            time.sleep(0.4)
-                        my_dongle.at_set_noti(suota_serv_status_handle)
-                        try:
-                            my_dongle.at_gattcread(dis_fw_ver_handle)
-                            fw_from_dis = gattc_read_q.get(timeout=DEFAULT_TIMEOUT)
-                            print(
-                                f"\nCurrent Firmware Version of BleuIO Dongle: {bcolors.OKCYAN}{fw_from_dis}{bcolors.ENDC}\n"
-                            )
-                        except:
-                            print("Cannot read firmware version!")
-                            pass
-                        # Read SUOTA VERSION
-                        try:
-                            my_dongle.at_gattcread(suota_version_handle)
-                            suota_ver = gattc_read_q.get(timeout=DEFAULT_TIMEOUT)
-                            print(
-                                f"\nSUOTA Version : {bcolors.OKCYAN}{suota_ver}{bcolors.ENDC}\n"
-                            )
-                        except:
-                            print("Cannot read SUOTA version!")
-                            main_running = False
-                            my_dongle.at_gapdisconnectall()
-                            raise Exception("Cannot read SUOTA version!")
-                        print("Device support SUOTA.")
-                        # Read MTU_SIZE
-                        try:
-                            my_dongle.at_gattcread(suota_mtu_handle)
-                            mtu_size = gattc_read_q.get(timeout=DEFAULT_TIMEOUT)
-                            print(
-                                f"\nMTU_SIZE: {bcolors.OKCYAN}{mtu_size}{bcolors.ENDC}\n"
-                            )
-                        except:
-                            print("Cannot read MTU_SIZE!")
-                            main_running = False
-                            my_dongle.at_gapdisconnectall()
-                            raise Exception("Cannot read MTU_SIZE!")
-                        # Read RD_PD_CHAR_SIZE
-                        try:
-                            my_dongle.at_gattcread(suota_pd_char_size_handle)
-                            rd_pd_char_size = gattc_read_q.get(timeout=DEFAULT_TIMEOUT)
-                            print(
-                                f"PD_CHAR_SIZE: {bcolors.OKCYAN}{rd_pd_char_size}{bcolors.ENDC}\n"
-                            )
-                        except:
-                            print("Cannot read RD_PD_CHAR_SIZE!")
-                            main_running = False
-                            my_dongle.at_gapdisconnectall()
-                            raise Exception("Cannot read RD_PD_CHAR_SIZE!")
-
-                        suota_chunk_size = min(
-                            int(mtu_size) - ATT_HEADER_SIZE, int(rd_pd_char_size)
-                        )
-                        print_dbg_msg("suota_chunk_size: " + str(suota_chunk_size))
-
-                        # Write mem_dev info SUOTA_MEM_DEV_SPI and Bank 0
-                        writeToChar(suota_mem_dev_handle, "00000013", False)
-                        response = notifications_q.get(timeout=DEFAULT_TIMEOUT)
-                        if not response == SUOTA_STATUS_IMG_STARTED:
-                            print(
-                                "SUOTA_STATUS ERROR: %02X (%s)"
-                                % (response, error_list[response])
-                            )
-                            main_running = False
-                            my_dongle.at_gapdisconnectall()
-                            raise Exception("Suota error!")
-                        else:
-                            print(
-                                "Update started: %02X (%s)"
-                                % (response, error_list[response])
-                            )
-
-                        # suota_chunk_size = 244
-                        # suota_block_size = 509
-                        suota_block_size = int(mtu_size)
-                        if suota_chunk_size > suota_block_size:
-                            suota_chunk_size = suota_block_size
-                        else:
-                            # Set block size to the closest possible value to the user input
-                            suota_block_size = (
-                                suota_block_size / suota_chunk_size
-                            ) * suota_chunk_size
-                            suota_block_size = int(suota_block_size)
-
-                        if (patch_length - block_offset) > suota_block_size:
-                            block_length = suota_block_size
-                        else:
-                            block_length = patch_length - block_offset
-
-                        print_dbg_msg(
-                            "Info: suota_chunk_size: %d  suota_block_size: %d  block_length %d"
-                            % (suota_chunk_size, suota_block_size, block_length)
-                        )
+    def bulk_start(self):
+        if self.pipeline is not None:
+            self.pipeline.start()
 
-                        if not app_suota_write_patch_len():
-                            main_running = False
-                            my_dongle.at_gapdisconnectall()
-                            raise Exception("Cannot write patch lenght!")
-                        time.sleep(0.4)
+    def bulk_stop(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
 
-                        done = False
-                        print_dbg_msg(
-                            "block_length: %d, block_offset: %d, patch_length:%d"
-                            % (block_length, block_offset, patch_length)
-                        )
-                        start_time = time.time()
-                        app_suota_write_chunks()
-
-                        while not done and my_dongle.status.isConnected:
-                            if is_last_block():
-                                print("Done!")
-                                done = True
-                            else:
-                                next_block()
-
-                                if is_last_block():
-                                    # we may need a different block length for the last block
-                                    # trigger next step - write SUOTA_PATCH_LEN for last block
-                                    if not app_suota_write_patch_len():
-                                        main_running = False
-                                        my_dongle.at_gapdisconnectall()
-                                        raise Exception("Cannot write patch lenght!")
-                                    time.sleep(0.4)
-                                else:
-                                    # trigger next step - start writing the block chunks
-                                    app_suota_write_chunks()
-                                    time.sleep(0.01)
-
-                        # Write Last Chunk
-                        app_suota_write_chunks()
-                        end_time = time.time()
-
-                        # Clearing the notification queue
-                        while not notifications_q.qsize() == 0:
-                            response = notifications_q.get_nowait()
-                            if not response == SUOTA_STATUS_CMP_OK:
-                                print(
-                                    "ERROR: %02X (%s)"
-                                    % (response, error_list[response])
-                                )
-                                main_running = False
-                                my_dongle.at_gapdisconnectall()
-                                raise Exception("Suota error %02X!" % (response))
-                            else:
-                                print(
-                                    "OK: %02X (%s)" % (response, error_list[response])
-                                )
-
-                        app_suota_end()
-                        try:
-                            response = notifications_q.get(timeout=DEFAULT_TIMEOUT)
-                            if not response == SUOTA_STATUS_CMP_OK:
-                                print(
-                                    f"\nUpdate Error: {bcolors.FAIL}{error_list[response]}{bcolors.ENDC}\n"
-                                )
-                            else:
-                                print(
-                                    f"{bcolors.OKGREEN}Update Successful: %02X %s{bcolors.ENDC}\n"
-                                    % (response, error_list[response])
-                                )
-                        except:
-                            print("app_suota_end no response!")
-
-                        print("Image sent in %.2fs" % (end_time - start_time))
-
-                        print("Rebooting BleuIO.")
-                        app_suota_reboot()
-                        print("BleuIO rebooted.")
-
-                        my_dongle.at_gapdisconnectall()
-                        while my_dongle.status.isConnected:
-                            pass
-                        main_running = False
-                        print(
-                            f"{bcolors.OKGREEN}BleuIO Updated Successfully!{bcolors.ENDC}\n"
-                        )
-                        # Update done
-                        answer = input("Update another BleuIO Dongle? (y/n)\n>>")
-                        answer = answer.lower()
-                        if answer[0] == "y":
-                            pass
-                        else:
-                            update_done = True
-                    else:
-                        print("Device doesn't support SUOTA.")
-                        main_running = False
-                        my_dongle.at_gapdisconnectall()
-                        # Update not possible
-                        answer = input("Do you want to try again? (y/n)\n>>")
-                        answer = answer.lower()
-                        if answer[0] == "y":
-                            pass
-                        else:
-                            update_done = True
+    def commands_per_second(self):
+        if self.pipeline is not None:
+            return self.pipeline.commands_per_second()
+        return 0.0
 
-                pass
-        except Exception as e:
+    def open_connection(self, handler):
+        if self.pipeline is not None:
+            raise Exception("--pipeline can't be used with several sessions.")
+        return BleuIOConnection(self, handler)
+
+    def _command(self, conn, fn, *args):
+        """Sends a command for `conn`, targeting its connection first if needed."""
+        with self._cmd_lock:
+            if conn is not None and conn.conn_idx is not None:
+                if not conn.conn_idx == self._target:
+                    self.dongle.at_target_conn(conn.conn_idx)
+                    self._target = conn.conn_idx
+            return fn(*args)
+
+    def _connect(self, conn, mac):
+        self._connect_lock.acquire()
+        with self._connect_state_lock:
+            self._connecting = conn
+            self._connecting_mac = re.sub("^\\[\\d\\]", "", mac).upper()
+        with self._cmd_lock:
+            if not mac.startswith("["):
+                mac = "[0]" + mac
+            self.dongle.at_gapconnect(mac)
+
+    def _end_connect(self, conn):
+        """Ends the connect of `conn` and lets the next one go, False if it wasn't pending."""
+        with self._connect_state_lock:
+            if conn is None or self._connecting is not conn:
+                return False
+            self._connecting = None
+            self._connecting_mac = None
+        self._connect_lock.release()
+        return True
+
+    def _hold(self, conn):
+        self._cmd_lock.acquire()
+        if not conn.conn_idx == self._target:
+            self.dongle.at_target_conn(conn.conn_idx)
+            self._target = conn.conn_idx
+
+    def _set_connected(self, connected):
+        self.dongle.status.isConnected = connected
+
+    def _route(self, line):
+        """Returns the connection an event belongs to, None if it isn't for one of them."""
+        match = re.search('^\\{\\d+:"([0-9A-Fa-f]{4})"', line) or re.search(
+            '"conn_idx":"([0-9A-Fa-f]{4})"', line
+        )
+        conn_idx = match.group(1).upper() if match else None
+        if '"action":"connected"' in line:
+            conn = self._connecting
+            addr = re.search('"addr":"(?:\\[\\d\\])?([0-9A-Fa-f:]{17})"', line)
+            if conn is None or (
+                addr and not addr.group(1).upper() == self._connecting_mac
+            ):
+                print_dbg_msg("Connected event for no pending connect: " + line)
+                return None
+            conn.conn_idx = conn_idx or "0000"
+            self._connections[conn.conn_idx] = conn
+            self._end_connect(conn)
+            return conn
+        conn = self._connections.get(conn_idx)
+        if conn is not None and '"action":"disconnected"' in line:
+            del self._connections[conn_idx]
+            if self._target == conn_idx:
+                self._target = None
+        return conn
+
+    def _scan_callback(self, scan_input):
+        print_dbg_msg("\n\nscan_evt: " + str(scan_input))
+        if '{"SF"' in str(scan_input) and '"data":' in str(scan_input):
+            try:
+                scan_result = json.loads(scan_input[0])
+                self.handler.on_adv(
+                    scan_result["addr"], scan_result["data"], scan_result.get("rssi")
+                )
+            except Exception as e:
+                print(str(e))
+
+    def _evt_callback(self, evt_input):
+        line = str(evt_input[0])
+        print_dbg_msg("\n\nevt: " + str(evt_input))
+        if not self._connections and self._connecting is None:
+            self._handle_evt(line, self)
+            return
+        # Several sessions: demultiplex by connection index
+        conn = self._route(line)
+        if conn is not None:
+            self._handle_evt(line, conn)
+
+    def _handle_evt(self, line, link):
+        handler = link.handler
+        match = re.search('^\\{(\\d+):"[0-9A-Fa-f]{4}"', line)
+        code = match.group(1) if match else ""
+        if '"action":"connected"' in line:
+            link._set_connected(True)
+            handler.on_connected()
+        if '"action":"disconnected"' in line:
+            link._set_connected(False)
+            handler.on_disconnected()
+        if '"action":"browse completed"' in line:
+            handler.on_browse_complete()
+        if '"serv","uuid":"' + SUOTA_SERVICE_UUID + '"' in line:
+            handler.on_service(SUOTA_SERVICE_UUID)
+        for uuid in SUOTA_BROWSE_UUIDS:
+            if ('"uuid":"' + uuid + '"') in line:
+                try:
+                    char = json.loads(line.replace("{768", '{"768"'))
+                    handle = str(char["evt"]["handle"]).upper()
+                    handler.on_characteristic(uuid, handle)
+                except Exception as e:
+                    print(str(e))
+        # Read response
+        if code == "775" and '","evt":{"handle":"' in line:
+            try:
+                read_obj = json.loads(line.replace("{775", '{"775"'))
+                if read_obj["evt"]["len"] == 0:
+                    data = "00"
+                else:
+                    data = read_obj["evt"]["hex"].replace("0x", "")
+                handle = str(read_obj["evt"]["handle"]).upper()
+                handler.on_read(handle, bytes.fromhex(data))
+            except Exception as e:
+                print(str(e))
+        if '","writeStatus":' in line:
+            if (
+                not '"handle":"0024"' in line
+                and not '"handle":"0000"' in line
+                and not '"handle":"0021"' in line
+            ):
+                match = re.search('"handle":"([0-9A-Fa-f]+)"', line)
+                handle = match.group(1).upper() if match else ""
+                if '"writeStatus":0' in line:
+                    handler.on_write_status(handle, 0)
+                else:
+                    handler.on_write_status(handle, 1)
+        # Notifications
+        if code == "777" and '"hex":' in line:
+            try:
+                suota_noti = json.loads(line.replace("{777", '{"777"'))
+                data = suota_noti["evt"]["hex"].replace("0x", "")
+                handle = str(suota_noti["evt"].get("handle", "")).upper()
+                handler.on_notification(handle, bytes.fromhex(data))
+            except Exception as e:
+                print(str(e))
+        # Indications
+        if code == "778" and '"hex":' in line:
+            try:
+                suota_indi = json.loads(line.replace("{778", '{"778"'))
+                length = suota_indi["evt"]["len"]
+                data = suota_indi["evt"]["hex"].replace("0x", "")
+                handle = str(suota_indi["evt"].get("handle", "")).upper()
+                handler.on_indication(handle, bytes.fromhex(data[: length * 2]))
+            except Exception as e:
+                print(str(e))
+
+
+class BleuIOConnection(SuotaTransport):
+    """One of the connections of a BleuIOTransport running several sessions.
+
+    Commands are sent through the parent, which targets the connection with
+    AT+TARGETCONN first, and the parent hands over the events carrying this
+    connection's index.
+    """
+
+    name = "bleuio"
+
+    def __init__(self, parent, handler):
+        SuotaTransport.__init__(self, handler)
+        self.parent = parent
+        self.port = parent.port
+        self.conn_idx = None
+        self.connected = False
+
+    def connect(self, mac):
+        self.parent._connect(self, mac)
+
+    def cancel_connect(self):
+        if self.parent._connecting is self:
+            self.parent._command(None, self.parent.dongle.at_cancel_connect)
+            self.parent._end_connect(self)
+
+    def browse(self):
+        # The dongle browses the services by itself after connecting
+        pass
+
+    def read(self, handle):
+        self.parent._command(self, self.parent.dongle.at_gattcread, handle)
+
+    def write(self, handle, data, response=False):
+        if response:
+            fn = self.parent.dongle.at_gattcwriteb
+        else:
+            fn = self.parent.dongle.at_gattcwritewrb
+        resp = self.parent._command(self, fn, handle, data.hex().upper())
+        return resp.Ack["err"]
+
+    def subscribe(self, handle):
+        self.parent._command(self, self.parent.dongle.at_set_noti, handle)
+
+    def disconnect(self):
+        if self.connected:
+            self.parent._command(self, self.parent.dongle.at_gapdisconnect)
+
+    def is_connected(self):
+        return self.connected
+
+    def hold(self):
+        self.parent._hold(self)
+
+    def release(self):
+        self.parent._cmd_lock.release()
+
+    def _set_connected(self, connected):
+        self.connected = connected
+
+
+def parse_adv_data(adv_data):
+    """Splits advertising data (hex str) into a list of (AD type, bytes)."""
+    raw = bytes.fromhex(adv_data)
+    structures = []
+    i = 0
+    while i < len(raw) and raw[i] > 0:
+        length = raw[i]
+        structures.append((raw[i + 1], raw[i + 2 : i + 1 + length]))
+        i += length + 1
+    return structures
+
+
+def short_uuid(uuid):
+    """Returns "0xXXXX" for UUIDs on the Bluetooth base UUID, otherwise the UUID in lower case."""
+    uuid = str(uuid).lower()
+    if uuid.startswith("0000") and uuid.endswith("-0000-1000-8000-00805f9b34fb"):
+        return "0x" + uuid[4:8]
+    return uuid
+
+
+class BlueZTransport(SuotaTransport):
+    """Central role of the host's own BLE controller through BlueZ over D-Bus.
+
+    Needs dbus-python and PyGObject. Handles are the D-Bus object paths of
+    the characteristics.
+    """
+
+    name = "bluez"
+    background_scan = True
+
+    def __init__(self, handler, adapter="hci0"):
+        SuotaTransport.__init__(self, handler)
+        try:
+            import dbus
+            import dbus.mainloop.glib
+            from gi.repository import GLib
+        except ImportError:
+            raise Exception(
+                "dbus-python and PyGObject are needed for the BlueZ transport!"
+            )
+        self._dbus = dbus
+        dbus.mainloop.glib.threads_init()
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        # Private connection so several instances don't share discovery sessions
+        self._bus = dbus.SystemBus(private=True)
+        self._loop = GLib.MainLoop()
+        self._loop_thread = threading.Thread(target=self._loop.run, name="bluez")
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        self._adapter_path = "/org/bluez/" + adapter
+        self.port = adapter
+        self._adapter = dbus.Interface(
+            self._bus.get_object("org.bluez", self._adapter_path), "org.bluez.Adapter1"
+        )
+        self._object_manager = dbus.Interface(
+            self._bus.get_object("org.bluez", "/"),
+            "org.freedesktop.DBus.ObjectManager",
+        )
+        self._scan_filter = None
+        self._scan_adv_data = ""
+        self._device_path = None
+        self._connected = False
+        self._browse_pending = False
+        self._chars = {}
+        # Characteristics passed to subscribe(), only their values are notifications
+        self._subscribed = set()
+        self._bus.add_signal_receiver(
+            self._interfaces_added,
+            dbus_interface="org.freedesktop.DBus.ObjectManager",
+            signal_name="InterfacesAdded",
+        )
+        self._bus.add_signal_receiver(
+            self._properties_changed,
+            dbus_interface="org.freedesktop.DBus.Properties",
+            signal_name="PropertiesChanged",
+            path_keyword="path",
+        )
+
+    def start(self):
+        props = self._dbus.Interface(
+            self._bus.get_object("org.bluez", self._adapter_path),
+            "org.freedesktop.DBus.Properties",
+        )
+        props.Set("org.bluez.Adapter1", "Powered", self._dbus.Boolean(True))
+        if self._device_path is not None:
+            self.disconnect()
+
+    def close(self):
+        self._loop.quit()
+
+    def scan(self, adv_data):
+        # BlueZ doesn't expose the raw advertising data, match the
+        # 16-bit service UUIDs and manufacturer IDs it contains instead
+        uuids = set()
+        manufacturers = set()
+        for ad_type, value in parse_adv_data(adv_data):
+            if ad_type in (0x02, 0x03):
+                for i in range(0, len(value) - 1, 2):
+                    uuids.add("0x%04x" % (int.from_bytes(value[i : i + 2], "little")))
+            if ad_type == 0xFF and len(value) >= 2:
+                manufacturers.add(int.from_bytes(value[0:2], "little"))
+        self._scan_filter = (uuids, manufacturers)
+        self._scan_adv_data = adv_data
+        self._adapter.SetDiscoveryFilter(
+            {"Transport": "le", "DuplicateData": self._dbus.Boolean(True)}
+        )
+        self._adapter.StartDiscovery()
+        for path, interfaces in self._object_manager.GetManagedObjects().items():
+            if "org.bluez.Device1" in interfaces:
+                self._check_adv(interfaces["org.bluez.Device1"])
+
+    def stop_scan(self):
+        self._scan_filter = None
+        try:
+            self._adapter.StopDiscovery()
+        except self._dbus.exceptions.DBusException as e:
+            print_dbg_msg(e)
+
+    def connect(self, mac):
+        self._device_path = self._adapter_path + "/dev_" + mac.upper().replace(":", "_")
+        self._connected = False
+        self._chars = {}
+        self._subscribed = set()
+        self._device().Connect(
+            reply_handler=lambda: None, error_handler=self._print_error
+        )
+
+    def cancel_connect(self):
+        self.disconnect()
+
+    def browse(self):
+        props = self._dbus.Interface(
+            self._bus.get_object("org.bluez", self._device_path),
+            "org.freedesktop.DBus.Properties",
+        )
+        if props.Get("org.bluez.Device1", "ServicesResolved"):
+            self._report_services()
+        else:
+            self._browse_pending = True
+
+    def read(self, handle):
+        self._char(handle).ReadValue(
+            {},
+            reply_handler=lambda value: self.handler.on_read(handle, bytes(value)),
+            error_handler=self._print_error,
+        )
+
+    def write(self, handle, data, response=False):
+        value = self._dbus.Array(data, signature="y")
+        if response:
+            self._char(handle).WriteValue(
+                value,
+                {"type": "request"},
+                reply_handler=lambda: self.handler.on_write_status(handle, 0),
+                error_handler=lambda e: self.handler.on_write_status(handle, 1),
+            )
+            return 0
+        try:
+            self._char(handle).WriteValue(value, {"type": "command"})
+        except self._dbus.exceptions.DBusException as e:
+            print_dbg_msg(e)
+            return 1
+        return 0
+
+    def subscribe(self, handle):
+        self._subscribed.add(handle)
+        self._char(handle).StartNotify()
+
+    def disconnect(self):
+        if self._device_path is None:
+            return
+        try:
+            self._device().Disconnect()
+        except self._dbus.exceptions.DBusException as e:
+            print_dbg_msg(e)
+
+    def is_connected(self):
+        return self._connected
+
+    def _device(self):
+        return self._dbus.Interface(
+            self._bus.get_object("org.bluez", self._device_path), "org.bluez.Device1"
+        )
+
+    def _char(self, handle):
+        return self._dbus.Interface(
+            self._bus.get_object("org.bluez", handle), "org.bluez.GattCharacteristic1"
+        )
+
+    def _print_error(self, error):
+        print(str(error))
+
+    def _check_adv(self, device):
+        if self._scan_filter is None or "Address" not in device:
+            return
+        uuids, manufacturers = self._scan_filter
+        device_uuids = set(short_uuid(uuid) for uuid in device.get("UUIDs", []))
+        device_manufacturers = set(
+            int(key) for key in device.get("ManufacturerData", {})
+        )
+        if uuids <= device_uuids and manufacturers <= device_manufacturers:
+            rssi = device.get("RSSI")
+            # The filter doesn't tell the mode, the UUIDs of the device do
+            data = self._scan_adv_data.replace(SUOTA_ADV_MARKER, "")
+            if SUOTA_SERVICE_UUID in device_uuids:
+                data += SUOTA_ADV_MARKER
+            self.handler.on_adv(
+                str(device["Address"]),
+                data,
+                int(rssi) if rssi is not None else None,
+            )
+
+    def _interfaces_added(self, path, interfaces):
+        if "org.bluez.Device1" in interfaces:
+            self._check_adv(interfaces["org.bluez.Device1"])
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        if interface == "org.bluez.Device1":
+            if path == self._device_path:
+                if "Connected" in changed:
+                    self._connected = bool(changed["Connected"])
+                    if self._connected:
+                        self.handler.on_connected()
+                    else:
+                        self._forget(path)
+                        self.handler.on_disconnected()
+                if changed.get("ServicesResolved") and self._browse_pending:
+                    self._report_services()
+            elif self._scan_filter is not None and "RSSI" in changed:
+                props = self._dbus.Interface(
+                    self._bus.get_object("org.bluez", path),
+                    "org.freedesktop.DBus.Properties",
+                )
+                self._check_adv(props.GetAll("org.bluez.Device1"))
+        elif interface == "org.bluez.GattCharacteristic1" and "Value" in changed:
+            # Read results change the Value too
+            if path in self._subscribed:
+                self.handler.on_notification(path, bytes(changed["Value"]))
+
+    def _forget(self, path):
+        # BlueZ adds the UUIDs of every advert to the ones it has cached, so
+        # after a reboot the device would still look like it is in SUOTA
+        # mode. Drop it, the next advert creates it again with its own data.
+        props = self._dbus.Interface(
+            self._bus.get_object("org.bluez", path),
+            "org.freedesktop.DBus.Properties",
+        )
+        try:
+            if not props.Get("org.bluez.Device1", "Paired"):
+                self._adapter.RemoveDevice(path)
+        except self._dbus.exceptions.DBusException as e:
+            print_dbg_msg(e)
+
+    def _report_services(self):
+        self._browse_pending = False
+        objects = self._object_manager.GetManagedObjects()
+        for path, interfaces in objects.items():
+            if not path.startswith(self._device_path + "/"):
+                continue
+            if "org.bluez.GattService1" in interfaces:
+                uuid = interfaces["org.bluez.GattService1"]["UUID"]
+                self.handler.on_service(short_uuid(uuid))
+            if "org.bluez.GattCharacteristic1" in interfaces:
+                uuid = short_uuid(interfaces["org.bluez.GattCharacteristic1"]["UUID"])
+                self._chars[str(path)] = uuid
+                self.handler.on_characteristic(uuid, str(path))
+        self.handler.on_browse_complete()
+
+
+class SimSuotaPeer:
+    """A simulated SUOTA target for SimTransport."""
+
+    def __init__(
+        self,
+        mac,
+        fw_version="1.0.0",
+        new_fw_version="2.0.0",
+        mtu=512,
+        pd_char_size=244,
+        rssi=-50,
+        latency=0.0,
+        l2cap_psm=None,
+        flash_time=0.0,
+        crc_error=False,
+    ):
+        self.mac = mac.upper()
+        self.fw_version = fw_version
+        self.new_fw_version = new_fw_version
+        self.mtu = mtu
+        self.pd_char_size = pd_char_size
+        self.rssi = rssi
+        # Extra delay of every write, a weak link
+        self.latency = latency
+        self.l2cap_psm = l2cap_psm
+        # Time to write a received block to flash before it is acknowledged
+        self.flash_time = flash_time
+        # Reports a CRC error at the end whatever the image
+        self.crc_error = crc_error
+        self.connected = False
+        self.suota_mode = True
+        self.rebooted = False
+        self.image = bytearray()
+        self.block = bytearray()
+        self.block_len = 0
+        self.image_ok = False
+
+    def adv_data(self):
+        if self.suota_mode:
+            return BLEUIO_SUOTA_ADV_DATA
+        return "02010603FF5B07"
+
+    def read(self, uuid):
+        if uuid == DIS_FW_VERSION_UUID:
+            return self.fw_version.encode("ascii")
+        if uuid == SUOTA_VERSION_UUID:
+            return bytes([13])
+        if uuid == SUOTA_MTU_UUID:
+            return self.mtu.to_bytes(2, "little")
+        if uuid == SUOTA_PD_CHAR_SIZE_UUID:
+            return self.pd_char_size.to_bytes(2, "little")
+        if uuid == SUOTA_L2CAP_PSM_UUID and self.l2cap_psm is not None:
+            return self.l2cap_psm.to_bytes(2, "little")
+        return bytes(4)
+
+    def write(self, uuid, data):
+        """Handles a write from the central.
+
+        :returns: List of SUOTA status codes to notify.
+        """
+        if uuid == SUOTA_MEM_DEV_UUID:
+            cmd = data[3]
+            if cmd == 0x13:
+                self.image = bytearray()
+                self.block = bytearray()
+                self.image_ok = False
+                return [SUOTA_STATUS_IMG_STARTED]
+            if cmd == 0xFE:
+                # The image ends with its XOR checksum
+                self.image_ok = (
+                    len(self.image) > 0
+                    and checksum(self.image, len(self.image)) == 0
+                    and not self.crc_error
+                )
+                if self.image_ok:
+                    return [SUOTA_STATUS_CMP_OK]
+                return [SUOTA_STATUS_CRC_ERR]
+            if cmd == 0xFD:
+                self.rebooted = True
+                self.suota_mode = False
+                if self.image_ok:
+                    self.fw_version = self.new_fw_version
+            return []
+        if uuid == SUOTA_PATCH_LEN_UUID:
+            self.block_len = int.from_bytes(data, "little")
+            return []
+        if uuid == SUOTA_PATCH_DATA_UUID:
+            return self.receive(data)
+        return []
+
+    def receive(self, data):
+        """Handles image data, written to SUOTA_PATCH_DATA or sent on the L2CAP channel."""
+        self.block += data
+        if len(self.block) > self.block_len:
+            self.block = bytearray()
+            return [SUOTA_STATUS_PATCH_LEN_ERR]
+        if len(self.block) == self.block_len:
+            self.image += self.block
+            self.block = bytearray()
+            return [SUOTA_STATUS_CMP_OK]
+        return []
+
+
+class SimTransport(SuotaTransport):
+    """In-process fake central connected to SimSuotaPeer objects, no hardware needed.
+
+    Events are delivered from a separate thread like the callbacks of the
+    other transports. `latency` is added to every write to mimic the radio,
+    on top of the latency of the peer. It is spent holding `link_lock`, which
+    is shared by the connections opened with open_connection() like the
+    serial port of a dongle.
+    """
+
+    name = "sim"
+    port = "sim"
+    background_scan = True
+    l2cap = True
+    HANDLES = {
+        DIS_FW_VERSION_UUID: "000E",
+        SUOTA_MEM_DEV_UUID: "0012",
+        SUOTA_GPIO_MAP_UUID: "0014",
+        SUOTA_MEM_INFO_UUID: "0016",
+        SUOTA_PATCH_LEN_UUID: "0018",
+        SUOTA_PATCH_DATA_UUID: "001A",
+        SUOTA_SERV_STATUS_UUID: "001C",
+        SUOTA_VERSION_UUID: "001F",
+        SUOTA_PD_CHAR_SIZE_UUID: "0022",
+        SUOTA_MTU_UUID: "0025",
+        SUOTA_L2CAP_PSM_UUID: "0028",
+    }
+
+    def __init__(self, handler, peers, latency=0.0, link_lock=None):
+        SuotaTransport.__init__(self, handler)
+        self.peers = dict((peer.mac, peer) for peer in peers)
+        self.latency = latency
+        self.link_lock = link_lock or threading.Lock()
+        self._uuids = dict((handle, uuid) for uuid, handle in self.HANDLES.items())
+        self._peer = None
+        self._connected = False
+        self._subscribed = False
+        self._l2cap_open = False
+        self._scan_adv_data = None
+        self._events = queue.Queue()
+        self._event_thread = threading.Thread(target=self._deliver, name="sim_evt")
+        self._event_thread.daemon = True
+        self._event_thread.start()
+
+    def scan(self, adv_data):
+        self._scan_adv_data = adv_data
+        for peer in list(self.peers.values()):
+            if peer is self._peer or peer.connected:
+                # Connected devices don't advertise
+                continue
+            if adv_data in peer.adv_data():
+                self._post(self.handler.on_adv, peer.mac, peer.adv_data(), peer.rssi)
+
+    def stop_scan(self):
+        self._scan_adv_data = None
+
+    def connect(self, mac):
+        peer = self.peers.get(mac.upper())
+        if peer is None:
+            return
+        peer.rebooted = False
+        peer.connected = True
+        self._peer = peer
+        self._subscribed = False
+        self._post(self._set_connected, True)
+
+    def cancel_connect(self):
+        if not self._connected:
+            if self._peer is not None:
+                self._peer.connected = False
+            self._peer = None
+
+    def browse(self):
+        self._post(self.handler.on_service, SUOTA_SERVICE_UUID)
+        for uuid, handle in self.HANDLES.items():
+            if uuid == SUOTA_L2CAP_PSM_UUID and self._peer.l2cap_psm is None:
+                continue
+            self._post(self.handler.on_characteristic, uuid, handle)
+        self._post(self.handler.on_browse_complete)
+
+    def read(self, handle):
+        peer = self._peer
+        if self._connected and peer is not None:
+            self._post(self.handler.on_read, handle, peer.read(self._uuids.get(handle)))
+
+    def write(self, handle, data, response=False):
+        peer = self._peer
+        if not self._connected or peer is None:
+            return 1
+        self._delay(peer)
+        uuid = self._uuids.get(handle)
+        statuses = peer.write(uuid, bytes(data))
+        if response:
+            self._post(self.handler.on_write_status, handle, 0)
+        self._notify(statuses, peer.flash_time if uuid == SUOTA_PATCH_DATA_UUID else 0)
+        if peer.rebooted:
+            self._post(self._set_connected, False)
+        return 0
+
+    def subscribe(self, handle):
+        self._subscribed = True
+
+    def l2cap_connect(self, psm):
+        peer = self._peer
+        self._l2cap_open = (
+            self._connected and peer is not None and peer.l2cap_psm == psm
+        )
+        return self._l2cap_open
+
+    def l2cap_send(self, data):
+        peer = self._peer
+        if not self._l2cap_open or not self._connected or peer is None:
+            return 1
+        # The whole SDU goes out in one go as long as there are credits
+        self._delay(peer)
+        self._notify(peer.receive(bytes(data)), peer.flash_time)
+        return 0
+
+    def l2cap_close(self):
+        self._l2cap_open = False
+
+    def disconnect(self):
+        if self._connected:
+            self._post(self._set_connected, False)
+
+    def is_connected(self):
+        return self._connected
+
+    def _set_connected(self, connected):
+        if connected == self._connected:
+            return
+        self._connected = connected
+        if connected:
+            self.handler.on_connected()
+        else:
+            if self._peer is not None:
+                self._peer.connected = False
+            self._peer = None
+            self._l2cap_open = False
+            self.handler.on_disconnected()
+
+    def open_connection(self, handler):
+        return SimTransport(
+            handler, list(self.peers.values()), self.latency, self.link_lock
+        )
+
+    def close(self):
+        self._events.put(None)
+
+    def _delay(self, peer):
+        if self.latency:
+            with self.link_lock:
+                time.sleep(self.latency)
+        if peer.latency:
+            time.sleep(peer.latency)
+
+    def _notify(self, statuses, delay=0):
+        """Notifies the SUOTA statuses, `delay` seconds later if given."""
+        if not self._subscribed:
+            return
+        for status in statuses:
+            args = (
+                self.handler.on_notification,
+                self.HANDLES[SUOTA_SERV_STATUS_UUID],
+                bytes([status]),
+            )
+            if delay:
+                timer = threading.Timer(delay, self._post, args)
+                timer.daemon = True
+                timer.start()
+            else:
+                self._post(*args)
+
+    def _post(self, fn, *args):
+        self._events.put((fn, args))
+
+    def _deliver(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            fn, args = event
+            try:
+                fn(*args)
+            except Exception as e:
+                print(str(e))
+
+
+class PostRebootVerifier:
+    """Checks in the background that rebooted devices come back with the new firmware.
+
+    Runs on its own transport so it doesn't hold up the next update. For each
+    rebooted device it waits for advertising in normal mode, connects, reads
+    the DIS firmware version and disconnects. The device passes if the version
+    is `expected_version`, or differs from the version before the update when
+    the expected version is not known.
+    """
+
+    def __init__(
+        self, transport_factory, expected_version=None, timeout=VERIFY_TIMEOUT
+    ):
+        self.expected_version = expected_version
+        self.timeout = timeout
+        self.results = {}
+        self._pending = queue.Queue()
+        self._read_q = queue.Queue()
+        self._target = None
+        self._normal_adv = threading.Event()
+        self._connected = threading.Event()
+        self._browsed = threading.Event()
+        self._dis_handle = None
+        self.transport = transport_factory(self)
+        if self.transport is None:
+            raise Exception("-vp/--verify-port is needed with the bleuio transport.")
+        self.transport.start()
+        self._thread = threading.Thread(target=self._run, name="verifier")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, mac, old_version):
+        """Queues a device that was just rebooted."""
+        self._pending.put((str(mac).upper(), old_version, time.time()))
+
+    def wait(self, timeout):
+        """Waits for the queued verifications, at most `timeout` seconds."""
+        deadline = time.time() + timeout
+        while self._pending.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+        return self._pending.unfinished_tasks == 0
+
+    def summary(self):
+        passed = len([r for r in self.results.values() if r["passed"]])
+        failed = len(self.results) - passed
+        return (passed, failed, self._pending.unfinished_tasks)
+
+    def _run(self):
+        while True:
+            mac, old_version, rebooted_at = self._pending.get()
+            try:
+                passed, version, reason = self._verify(mac, old_version, rebooted_at)
+            except Exception as e:
+                passed, version, reason = (False, None, str(e))
+            try:
+                self.transport.disconnect()
+            except Exception as e:
+                print_dbg_msg(e)
+            self.results[mac] = {
+                "passed": passed,
+                "old_version": old_version,
+                "version": version,
+                "reason": reason,
+                "duration": time.time() - rebooted_at,
+            }
+            if passed:
+                print(
+                    f"{bcolors.OKGREEN}Verified {mac}: running firmware {version}.{bcolors.ENDC}"
+                )
+            else:
+                print(
+                    f"{bcolors.FAIL}Verification of {mac} failed: {reason}{bcolors.ENDC}"
+                )
+            if history is not None:
+                history.set_verified(mac, passed, version)
+            if inventory is not None:
+                inventory.verified(mac, passed, version)
+            emit_event(
+                "verified", mac=mac, passed=passed, version=version, reason=reason
+            )
+            self._pending.task_done()
+
+    def _wait(self, event, deadline):
+        return event.wait(max(0, deadline - time.time()))
+
+    def _verify(self, mac, old_version, rebooted_at):
+        # The devices are checked one after the other, the time of each
+        # starts when its own check does
+        deadline = max(rebooted_at, time.time()) + self.timeout
+        self._target = mac
+        self._normal_adv.clear()
+        self._connected.clear()
+        self._browsed.clear()
+        self._dis_handle = None
+        while not self._read_q.empty():
+            self._read_q.get_nowait()
+
+        self.transport.scan(BLEUIO_ADV_DATA)
+        seen = self._wait(self._normal_adv, deadline)
+        self.transport.stop_scan()
+        if not seen:
+            return (False, None, "not advertising in normal mode")
+
+        self.transport.connect(mac)
+        if not self._wait(self._connected, deadline):
+            self.transport.cancel_connect()
+            return (False, None, "cannot connect")
+        self.transport.browse()
+        if not self._wait(self._browsed, deadline) or self._dis_handle is None:
+            return (False, None, "no firmware version characteristic")
+        self.transport.read(self._dis_handle)
+        try:
+            version = self._read_q.get(timeout=max(0.1, deadline - time.time()))
+        except queue.Empty:
+            return (False, None, "no firmware version read after reboot")
+
+        if self.expected_version:
+            if version == self.expected_version:
+                return (True, version, "")
+            return (
+                False,
+                version,
+                "running %s, expected %s" % (version, self.expected_version),
+            )
+        if version == old_version:
+            return (False, version, "still running %s" % (version))
+        return (True, version, "")
+
+    # Events from the verification transport
+    def on_adv(self, mac, data, rssi):
+        if inventory is not None:
+            inventory.seen(mac, SUOTA_ADV_MARKER in str(data), rssi)
+        if str(mac).upper() == self._target and SUOTA_ADV_MARKER not in str(data):
+            self._normal_adv.set()
+
+    def on_connected(self):
+        self._connected.set()
+
+    def on_disconnected(self):
+        self._connected.clear()
+
+    def on_browse_complete(self):
+        self._browsed.set()
+
+    def on_service(self, uuid):
+        pass
+
+    def on_characteristic(self, uuid, handle):
+        if uuid == DIS_FW_VERSION_UUID:
+            self._dis_handle = handle
+
+    def on_read(self, handle, data):
+        if handle == self._dis_handle:
+            self._read_q.put(data.decode("ASCII", "ignore").strip("\x00"))
+
+    def on_write_status(self, handle, status):
+        pass
+
+    def on_notification(self, handle, data):
+        pass
+
+    def on_indication(self, handle, data):
+        pass
+
+
+def image_version(data):
+    """Returns the version string in the header of a DA1468x SUOTA image, None if not found."""
+    # Header: "pP", valid flag, image id, code size, CRC, version[16], timestamp, IVT offset
+    if len(data) < 28 or not data[0:2] == b"pP":
+        return None
+    version = bytes(data[12:28]).split(b"\x00")[0]
+    try:
+        return version.decode("ascii") or None
+    except UnicodeDecodeError:
+        return None
+
+
+class FaultInjector:
+    """Decides which operations get a fault and measures how the updater copes.
+
+    The schedule only depends on `seed` and the order of the operations, so a
+    run can be repeated. For every injected fault the time until the updater
+    detects it (detected()) and until a block is transferred again
+    (recovered()) is recorded. Faults belong to the device they were injected
+    on and stay open when its session fails, so a retry of the device can
+    recover them. They are lost() when the device isn't retried.
+    """
+
+    def __init__(self, classes, rate, seed=0, delay=2.0):
+        self.classes = classes
+        self.rate = rate
+        self.delay = delay
+        self.rng = random.Random(seed)
+        self.records = []
+        self._lock = threading.Lock()
+        self._open = []
+
+    def draw(self, candidates, mac=None):
+        """Returns the fault class to inject for an operation on `mac`, None for no fault."""
+        with self._lock:
+            hit = self.rng.random() < self.rate
+            enabled = [c for c in candidates if c in self.classes]
+            if not hit or not enabled:
+                return None
+            fault = self.rng.choice(enabled)
+            record = {
+                "class": fault,
+                "mac": str(mac).upper() if mac else None,
+                "injected": time.time(),
+                "detected": None,
+                "recovered": None,
+                "lost": False,
+            }
+            self.records.append(record)
+            self._open.append(record)
+        print_dbg_msg("Injected fault: " + fault)
+        return fault
+
+    def detected(self, mac=None):
+        with self._lock:
+            for record in self._owned(mac):
+                if record["detected"] is None:
+                    record["detected"] = time.time()
+
+    def recovered(self, mac=None):
+        with self._lock:
+            for record in self._owned(mac):
+                record["recovered"] = time.time()
+                self._open.remove(record)
+
+    def lost(self, mac=None):
+        """Closes the open faults of a failed session, they are never recovered."""
+        with self._lock:
+            for record in self._owned(mac):
+                record["lost"] = True
+                self._open.remove(record)
+
+    def _owned(self, mac):
+        if not mac:
+            return list(self._open)
+        mac = str(mac).upper()
+        return [r for r in self._open if r["mac"] in (mac, None)]
+
+    def report(self):
+        """Returns {class: (count, detected, mean/max time-to-detect, mean/max time-to-recover, lost)}."""
+        stats = {}
+        with self._lock:
+            records = list(self.records)
+        for fault in self.classes:
+            group = [r for r in records if r["class"] == fault]
+            if not group:
+                continue
+            detect = [r["detected"] - r["injected"] for r in group if r["detected"]]
+            recover = [r["recovered"] - r["injected"] for r in group if r["recovered"]]
+            stats[fault] = (
+                len(group),
+                len(detect),
+                sum(detect) / len(detect) if detect else None,
+                max(detect) if detect else None,
+                sum(recover) / len(recover) if recover else None,
+                max(recover) if recover else None,
+                len([r for r in group if r["lost"]]),
+            )
+        return stats
+
+    def print_report(self):
+        """Prints the report, the faults still open at the end of the run are lost."""
+        self.lost()
+        print("\nFault injection report:")
+        print(
+            "%-22s %6s %9s %10s %10s %10s %10s %6s"
+            % (
+                "class",
+                "count",
+                "detected",
+                "ttd_mean",
+                "ttd_max",
+                "ttr_mean",
+                "ttr_max",
+                "lost",
+            )
+        )
+
+        def fmt(value):
+            return "-" if value is None else "%.2fs" % (value)
+
+        for fault, row in self.report().items():
+            print(
+                "%-22s %6d %9d %10s %10s %10s %10s %6d"
+                % (
+                    fault,
+                    row[0],
+                    row[1],
+                    fmt(row[2]),
+                    fmt(row[3]),
+                    fmt(row[4]),
+                    fmt(row[5]),
+                    row[6],
+                )
+            )
+
+
+class FaultInjectingTransport(SuotaTransport):
+    """Wraps a transport and injects the faults chosen by a FaultInjector.
+
+    Events from the wrapped transport can be dropped, delayed or corrupted
+    before they reach `handler`; writes can fail with an error or cause a
+    disconnect.
+    """
+
+    def __init__(self, handler, injector):
+        SuotaTransport.__init__(self, handler)
+        self.injector = injector
+        self.inner = None
+        self.name = ""
+        # Device of the faults drawn, the last one connected to
+        self.mac = None
+
+    def wrap(self, inner):
+        self.inner = inner
+        self.name = inner.name
+        self.background_scan = inner.background_scan
+        self.port = inner.port
+        self.l2cap = inner.l2cap
+        return self
+
+    def start(self):
+        self.inner.start()
+
+    def close(self):
+        self.inner.close()
+
+    def scan(self, adv_data):
+        self.inner.scan(adv_data)
+
+    def stop_scan(self):
+        self.inner.stop_scan()
+
+    def connect(self, mac):
+        self.mac = mac
+        self.inner.connect(mac)
+
+    def cancel_connect(self):
+        self.inner.cancel_connect()
+
+    def browse(self):
+        self.inner.browse()
+
+    def read(self, handle):
+        self.inner.read(handle)
+
+    def write(self, handle, data, response=False):
+        if not self.inner.is_connected():
+            return self.inner.write(handle, data, response)
+        fault = self.injector.draw(["ack_error", "disconnect"], self.mac)
+        if fault == "ack_error":
+            return 0x01
+        if fault == "disconnect":
+            # The link drops before this write reaches the device
+            self.inner.disconnect()
+            return 0
+        return self.inner.write(handle, data, response)
+
+    def flush(self):
+        return self.inner.flush()
+
+    def subscribe(self, handle):
+        self.inner.subscribe(handle)
+
+    def l2cap_connect(self, psm):
+        return self.inner.l2cap_connect(psm)
+
+    def l2cap_send(self, data):
+        if not self.inner.is_connected():
+            return self.inner.l2cap_send(data)
+        fault = self.injector.draw(["disconnect"], self.mac)
+        if fault == "disconnect":
+            self.inner.disconnect()
+            return 0
+        return self.inner.l2cap_send(data)
+
+    def l2cap_close(self):
+        self.inner.l2cap_close()
+
+    def disconnect(self):
+        self.inner.disconnect()
+
+    def is_connected(self):
+        return self.inner.is_connected()
+
+    def bulk_start(self):
+        self.inner.bulk_start()
+
+    def bulk_stop(self):
+        self.inner.bulk_stop()
+
+    def commands_per_second(self):
+        return self.inner.commands_per_second()
+
+    def hold(self):
+        self.inner.hold()
+
+    def release(self):
+        self.inner.release()
+
+    def open_connection(self, handler):
+        wrapper = FaultInjectingTransport(handler, self.injector)
+        return wrapper.wrap(self.inner.open_connection(wrapper))
+
+    # Events from the wrapped transport
+    def on_adv(self, mac, data, rssi):
+        self.handler.on_adv(mac, data, rssi)
+
+    def on_connected(self):
+        self.handler.on_connected()
+
+    def on_disconnected(self):
+        self.handler.on_disconnected()
+
+    def on_browse_complete(self):
+        self.handler.on_browse_complete()
+
+    def on_service(self, uuid):
+        self.handler.on_service(uuid)
+
+    def on_characteristic(self, uuid, handle):
+        self.handler.on_characteristic(uuid, handle)
+
+    def on_read(self, handle, data):
+        if self.injector.draw(["drop_read"], self.mac):
+            return
+        self.handler.on_read(handle, data)
+
+    def on_write_status(self, handle, status):
+        if self.injector.draw(["drop_write_status"], self.mac):
+            return
+        self.handler.on_write_status(handle, status)
+
+    def on_notification(self, handle, data):
+        fault = self.injector.draw(
+            ["drop_notification", "delay_notification", "corrupt_notification"],
+            self.mac,
+        )
+        if fault == "drop_notification":
+            return
+        if fault == "delay_notification":
+            timer = threading.Timer(
+                self.injector.delay, self.handler.on_notification, (handle, data)
+            )
+            timer.daemon = True
+            timer.start()
+            return
+        if fault == "corrupt_notification" and data:
+            data = bytes([data[0] ^ 0x01]) + data[1:]
+        self.handler.on_notification(handle, data)
+
+    def on_indication(self, handle, data):
+        self.handler.on_indication(handle, data)
+
+
+def fault_detected(mac=None):
+    """Called where the updater notices that something went wrong with `mac`.
+
+    Without `mac` it is the device main() is updating.
+    """
+    if fault_injector is not None:
+        fault_injector.detected(mac or mac_addr)
+
+
+def fault_recovered(mac=None):
+    """Called when the update of `mac` makes progress again."""
+    if fault_injector is not None:
+        fault_injector.recovered(mac or mac_addr)
+
+
+def fault_lost(mac=None):
+    """Called when the session of `mac` fails, its faults are not recovered."""
+    if fault_injector is not None:
+        fault_injector.lost(mac or mac_addr)
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of `values` with linear interpolation, None if empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class SessionRecord:
+    """The history row of one update session, filled in while the session runs."""
+
+    def __init__(self, **fields):
+        self.fields = dict(fields)
+        self.fields["started"] = time.time()
+        self.marks = {}
+        self.mark("scan")
+
+    def mark(self, phase):
+        """Records the time a phase starts."""
+        self.marks[phase] = time.time()
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def finish(self, success, status=None, error=""):
+        """Returns the row with the phase durations and the result."""
+        row = dict(self.fields)
+        marks = dict(self.marks)
+        marks.setdefault("done", time.time())
+        for column, start, stop in HISTORY_PHASES:
+            if start in marks and stop in marks:
+                row[column] = marks[stop] - marks[start]
+        row["total_s"] = marks["done"] - row["started"]
+        if row.get("transfer_s") and row.get("image_size"):
+            row["throughput"] = row["image_size"] / row["transfer_s"]
+        row["status"] = status
+        if status is not None and status < len(error_list):
+            row["status_name"] = error_list[status]
+        row["success"] = 1 if success else 0
+        row["error"] = str(error)
+        return row
+
+
+class UpdateHistory:
+    """Keeps a record of every update session in a SQLite database.
+
+    Each session fills in its own SessionRecord and writes it with insert()
+    when it ends, so a crash never leaves half a record behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, %s)"
+            % (", ".join("%s %s" % (c, t) for c, t in HISTORY_COLUMNS))
+        )
+        # Databases written by an older version of the script
+        existing = [row[1] for row in self._db.execute("PRAGMA table_info(sessions)")]
+        for column, column_type in HISTORY_COLUMNS:
+            if column not in existing:
+                self._db.execute(
+                    "ALTER TABLE sessions ADD COLUMN %s %s" % (column, column_type)
+                )
+        for column in ["mac", "port", "new_version", "image_hash"]:
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_%s ON sessions (%s, started)"
+                % (column, column)
+            )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_site ON sessions (site, started)"
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+            self._db = None
+
+    def insert(self, row):
+        """Writes a finished session row to the database."""
+        columns = [c for c, t in HISTORY_COLUMNS if c in row]
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT INTO sessions (%s) VALUES (%s)"
+                % (", ".join(columns), ", ".join("?" * len(columns))),
+                [row[c] for c in columns],
+            )
+            self._db.commit()
+
+    def set_verified(self, mac, passed, version):
+        """Stores the post-reboot verification result in the last session of `mac`."""
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute(
+                "UPDATE sessions SET verified = ?, verified_version = ? WHERE id = "
+                "(SELECT id FROM sessions WHERE mac = ? ORDER BY started DESC LIMIT 1)",
+                (1 if passed else 0, version, mac),
+            )
+            self._db.commit()
+
+    def throughput(self, mac):
+        """Returns the median throughput of the successful updates of `mac`, None if unknown."""
+        with self._lock:
+            if self._db is None:
+                return None
+            rows = self._db.execute(
+                "SELECT throughput FROM sessions WHERE mac = ? AND success = 1 "
+                "AND throughput IS NOT NULL",
+                (str(mac).upper(),),
+            ).fetchall()
+        return percentile([row[0] for row in rows], 50)
+
+    def query(self, since=None, **filters):
+        """Returns the sessions as dicts, newest first.
+
+        :param since: Only sessions started after this time.
+        :param filters: Column values the sessions must have, e.g. mac="...".
+        """
+        where = []
+        params = []
+        for column, value in filters.items():
+            if column not in dict(HISTORY_COLUMNS):
+                raise Exception("Unknown history column: " + column)
+            where.append("%s = ?" % (column))
+            params.append(value)
+        if since is not None:
+            where.append("started >= ?")
+            params.append(since)
+        sql = "SELECT * FROM sessions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY started DESC"
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def report(self, group_by, since=None):
+        """Returns per group: (group, sessions, success rate, [p50, p90, p99] of
+        the total time and [p50, p90, p99] of the throughput of the successful sessions).
+        """
+        column = HISTORY_GROUPS[group_by]
+        groups = {}
+        for row in self.query(since):
+            groups.setdefault(row[column], []).append(row)
+        rows = []
+        for group, sessions in sorted(groups.items(), key=lambda g: str(g[0])):
+            ok = [s for s in sessions if s["success"]]
+            totals = [s["total_s"] for s in ok if s["total_s"] is not None]
+            rates = [s["throughput"] for s in ok if s["throughput"] is not None]
+            rows.append(
+                (
+                    group,
+                    len(sessions),
+                    len(ok) / len(sessions),
+                    [percentile(totals, p) for p in (50, 90, 99)],
+                    [percentile(rates, p) for p in (50, 90, 99)],
+                )
+            )
+        return rows
+
+    def print_report(self, group_by, since=None):
+        print(
+            "%-24s %8s %7s %9s %9s %9s %10s %10s %10s"
+            % (
+                group_by,
+                "sessions",
+                "ok",
+                "time_p50",
+                "time_p90",
+                "time_p99",
+                "B/s_p50",
+                "B/s_p90",
+                "B/s_p99",
+            )
+        )
+
+        def fmt(value, unit):
+            return "-" if value is None else ("%.1f" % (value)) + unit
+
+        for group, count, ok, totals, rates in self.report(group_by, since):
+            print(
+                "%-24s %8d %6.0f%% %9s %9s %9s %10s %10s %10s"
+                % (
+                    str(group)[:24],
+                    count,
+                    ok * 100,
+                    fmt(totals[0], "s"),
+                    fmt(totals[1], "s"),
+                    fmt(totals[2], "s"),
+                    fmt(rates[0], ""),
+                    fmt(rates[1], ""),
+                    fmt(rates[2], ""),
+                )
+            )
+
+
+class DeviceInventory:
+    """What is known about each device seen, kept between runs in a JSON file.
+
+    Fed by the scan callbacks (last seen, SUOTA mode or not) and by the
+    update sessions (firmware version, result of the last update). Devices
+    not seen for `ttl` seconds are forgotten. A device that was already
+    updated with the image being sent is not connected to again.
+    """
+
+    def __init__(self, path, ttl=INVENTORY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.target_version = None
+        self.target_image = None
+        self.devices = {}
+        self._skipped = set()
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.devices = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(
+                f"{bcolors.WARNING}Cannot read the inventory {path}: {e}{bcolors.ENDC}"
+            )
+        self._evict()
+
+    def _entry(self, mac):
+        return self.devices.setdefault(str(mac).upper(), {})
+
+    def _evict(self):
+        now = time.time()
+        for mac in list(self.devices):
+            if now - self.devices[mac].get("last_seen", 0) > self.ttl:
+                del self.devices[mac]
+
+    def seen(self, mac, suota_mode, rssi=None):
+        with self._lock:
+            entry = self._entry(mac)
+            entry["last_seen"] = time.time()
+            entry["suota_mode"] = suota_mode
+            if rssi is not None:
+                entry["rssi"] = rssi
+
+    def set_version(self, mac, version):
+        """Records the firmware version read from the device."""
+        if not version:
+            return
+        with self._lock:
+            self._entry(mac)["version"] = version
+
+    def result(self, mac, success, status=None, error=""):
+        """Records how an update of `mac` ended."""
+        with self._lock:
+            entry = self._entry(mac)
+            entry["last_seen"] = time.time()
+            if success:
+                entry["result"] = "ok"
+                entry["image"] = self.target_image
+                entry["updated"] = time.time()
+                # None if the image has no version in its header
+                entry["version"] = self.target_version
+            elif status is not None and status < len(error_list):
+                entry["result"] = error_list[status]
+            else:
+                entry["result"] = str(error) or "failed"
+        self.save()
+
+    def verified(self, mac, passed, version):
+        """Records the post-reboot verification of `mac`."""
+        with self._lock:
+            entry = self._entry(mac)
+            entry["last_seen"] = time.time()
+            if version:
+                entry["version"] = version
+            if not passed:
+                # The update didn't take, don't skip the device next time
+                entry["result"] = "not verified"
+        self.save()
+
+    def up_to_date(self, mac):
+        """Returns True if `mac` was updated with the image being sent."""
+        mac = str(mac).upper()
+        with self._lock:
+            entry = self.devices.get(mac)
+            up_to_date = (
+                entry is not None
+                and self.target_image is not None
+                and entry.get("result") == "ok"
+                and entry.get("image") == self.target_image
+            )
+            if not up_to_date or mac in self._skipped:
+                return up_to_date
+            self._skipped.add(mac)
+        print(
+            f"{bcolors.OKCYAN}Skipping {mac}: already updated with this image on {time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['updated']))}.{bcolors.ENDC}"
+        )
+        emit_event("skipped", mac=mac, version=entry.get("version"))
+        return True
+
+    def stale(self, mac):
+        """Returns True unless `mac` is known to run the version being sent."""
+        with self._lock:
+            entry = self.devices.get(str(mac).upper())
+            return (
+                entry is None
+                or not self.target_version
+                or not entry.get("version") == self.target_version
+            )
+
+    def save(self):
+        with self._lock:
+            self._evict()
+            data = json.dumps(self.devices, indent=1, sort_keys=True)
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print_dbg_msg("inventory: " + str(e))
+
+
+class EventStream:
+    """Writes the updater events as JSON lines, one object per event.
+
+    emit() never blocks: events are queued and written in batches by a
+    background thread. If the output can't keep up the queue is bounded and
+    further events are counted in `dropped`. With `close_out` close() also
+    closes `out`.
+    """
+
+    def __init__(self, out, progress_step=10, close_out=False):
+        self.out = out
+        self.close_out = close_out
+        self.progress_step = progress_step
+        self.dropped = 0
+        self._progress = {}
+        self._q = queue.Queue(EVENT_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name="events")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, event, **fields):
+        record = {"ts": round(time.time(), 3), "event": event}
+        record.update(fields)
+        try:
+            self._q.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def progress(self, mac, percent, **fields):
+        """Emits a progress event each time `percent` passes a multiple of progress_step."""
+        step = int(percent // self.progress_step) if self.progress_step else percent
+        if self._progress.get(mac) == step:
+            return
+        self._progress[mac] = step
+        self.emit("progress", mac=mac, percent=round(percent, 1), **fields)
+
+    def close(self, timeout=5):
+        """Writes the queued events and stops the writer."""
+        try:
+            self._q.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self.close_out and not self._thread.is_alive():
+            self.out.close()
+
+    def _run(self):
+        while True:
+            records = [self._q.get()]
+            while len(records) < 256:
+                try:
+                    records.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            lines = [
+                json.dumps(r, separators=(",", ":"), default=str) + "\n"
+                for r in records
+                if r is not None
+            ]
+            try:
+                self.out.write("".join(lines))
+                self.out.flush()
+            except Exception as e:
+                print_dbg_msg("events: " + str(e))
+            if stop:
+                return
+
+
+def emit_event(event, **fields):
+    """Sends an event to the --json stream, if enabled."""
+    if events is not None:
+        events.emit(event, **fields)
+
+
+def failure_status(status):
+    """Returns `status` if it is a SUOTA error status, None otherwise."""
+    if status is None or status in SUOTA_OK_STATUSES:
+        return None
+    return status
+
+
+def suota_geometry(mtu, pd_char_size):
+    """Returns the (chunk size, block size) used for a negotiated MTU and PD_CHAR_SIZE."""
+    chunk_size = min(int(mtu) - ATT_HEADER_SIZE, int(pd_char_size))
+    block_size = int(mtu)
+    if chunk_size > block_size:
+        chunk_size = block_size
+    else:
+        # Set block size to the closest possible value to the user input
+        block_size = int((block_size / chunk_size) * chunk_size)
+    return (chunk_size, block_size)
+
+
+class TransferPlan:
+    """The chunk writes of an image transfer, computed before it starts.
+
+    Entry i is (block index, offset in the image, length, patch length): the
+    patch length is the value to write to SUOTA_PATCH_LEN before the chunk,
+    0 when the block length doesn't change. The entries are kept in a flat
+    array, so any of them, e.g. the first of a block to send again, is found
+    in O(1).
+    """
+
+    FIELDS = 4
+
+    def __init__(self, image_size, chunk_size, block_size):
+        self.image_size = image_size
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.blocks = -(-image_size // block_size)
+        self._entries = array.array("I")
+        # Index of the first entry of each block, then the number of entries
+        self._block_first = array.array("I")
+        patch_len = 0
+        for block in range(self.blocks):
+            block_offset = block * block_size
+            block_end = min(block_offset + block_size, image_size)
+            self._block_first.append(len(self))
+            for offset in range(block_offset, block_end, chunk_size):
+                change = 0
+                if offset == block_offset and not block_end - block_offset == patch_len:
+                    change = patch_len = block_end - block_offset
+                self._entries.extend(
+                    (block, offset, min(chunk_size, block_end - offset), change)
+                )
+        self._block_first.append(len(self))
+
+    def __len__(self):
+        return len(self._entries) // self.FIELDS
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return tuple(self._entries[i * self.FIELDS : (i + 1) * self.FIELDS])
+
+    def block(self, block):
+        """Returns the entries of `block`."""
+        return [
+            self[i]
+            for i in range(self._block_first[block], self._block_first[block + 1])
+        ]
+
+    def block_end(self, block):
+        """Returns the image offset right after `block`."""
+        return min((block + 1) * self.block_size, self.image_size)
+
+    def index(self, offset):
+        """Returns the index of the entry that sends the image byte at `offset`."""
+        block = offset // self.block_size
+        return (
+            self._block_first[block]
+            + (offset - block * self.block_size) // self.chunk_size
+        )
+
+    def patch_len_writes(self):
+        return len(
+            [
+                b
+                for b in range(self.blocks)
+                if self._entries[self._block_first[b] * self.FIELDS + 3]
+            ]
+        )
+
+
+def transfer_counts(image_size, chunk_size, block_size):
+    """Counts the operations of an image transfer from its TransferPlan.
+
+    Each block is written in chunks and ends with a notification,
+    SUOTA_PATCH_LEN is written when the block length changes.
+    """
+    plan = TransferPlan(image_size, chunk_size, block_size)
+    patch_len_writes = plan.patch_len_writes()
+    return {
+        "blocks": plan.blocks,
+        "patch_len_writes": patch_len_writes,
+        "chunk_writes": len(plan),
+        "notifications": plan.blocks,
+        # Sleeps of the transfer loop: after each SUOTA_PATCH_LEN write,
+        # otherwise between blocks
+        "sleep": 0.4 * patch_len_writes + 0.01 * (plan.blocks - patch_len_writes),
+    }
+
+
+class TransferPlanner:
+    """Predicts how long updates take from the image size and link assumptions.
+
+    Every AT command costs its serial transfer time plus the round trip to the
+    dongle (`at_latency`), with --pipeline `window` round trips overlap. A
+    chunk can't be sent faster than one per connection event, writes with
+    response and reads take two connection events, a block notification one.
+    calibrate() scales the prediction to the sessions in the history.
+    """
+
+    def __init__(
+        self,
+        conn_interval=PLAN_CONN_INTERVAL,
+        baud=PLAN_BAUD,
+        at_latency=PLAN_AT_LATENCY,
+        pipeline_window=1,
+    ):
+        self.conn_interval = conn_interval
+        self.baud = baud
+        self.at_latency = at_latency
+        self.pipeline_window = pipeline_window
+        self.transfer_scale = 1.0
+        self.overhead = None
+
+    def at_command(self, cmd_len, pipelined=False):
+        serial = (cmd_len + AT_RESPONSE_BYTES) * 10.0 / self.baud
+        if pipelined:
+            return max(serial, self.at_latency / self.pipeline_window)
+        return serial + self.at_latency
+
+    def transfer_time(self, image_size, chunk_size, block_size):
+        """Predicted time from the first SUOTA_PATCH_LEN write to the last block notification."""
+        counts = transfer_counts(image_size, chunk_size, block_size)
+        chunk_cmd = AT_WRITE_CMD_BYTES + 2 * chunk_size
+        chunk = max(
+            self.at_command(chunk_cmd, self.pipeline_window > 1), self.conn_interval
+        )
+        patch_len = self.at_command(AT_WRITE_CMD_BYTES + 4) + 2 * self.conn_interval
+        seconds = (
+            counts["chunk_writes"] * chunk
+            + counts["patch_len_writes"] * patch_len
+            + counts["notifications"] * self.conn_interval
+            + counts["sleep"]
+        )
+        return seconds * self.transfer_scale
+
+    def device_overhead(self):
+        """Predicted time of everything but the transfer: scan, connect, handshake, end and reboot."""
+        if self.overhead is not None:
+            return self.overhead
+        gatt = self.at_command(AT_WRITE_CMD_BYTES + 8) + 2 * self.conn_interval
+        # find_BleuIO notices the device half a poll interval after the
+        # advert on average and then doesn't wait, nor does the session
+        # outside of the transfer: scan stop, connect, 4 reads, subscribe,
+        # start, end and reboot
+        return FIND_POLL_INTERVAL / 2 + 8 * self.conn_interval + 8 * gatt
+
+    def plan(self, image_size, mtu, pd_char_size):
+        chunk_size, block_size = suota_geometry(mtu, pd_char_size)
+        counts = transfer_counts(image_size, chunk_size, block_size)
+        transfer = self.transfer_time(image_size, chunk_size, block_size)
+        counts.update(
+            {
+                "mtu": mtu,
+                "pd_char_size": pd_char_size,
+                "chunk_size": chunk_size,
+                "block_size": block_size,
+                # Scan start and stop, connect, 4 reads, subscribe, start, end,
+                # reboot and disconnect
+                "at_commands": counts["chunk_writes"] + counts["patch_len_writes"] + 12,
+                "transfer_s": transfer,
+                "device_s": transfer + self.device_overhead(),
+            }
+        )
+        return counts
+
+    def calibrate(self, sessions):
+        """Fits the prediction to successful sessions from UpdateHistory.query().
+
+        Only sessions that had the link to themselves are used.
+
+        :returns: Number of sessions used.
+        """
+        ratios = []
+        overheads = []
+        self.transfer_scale = 1.0
+        for s in sessions:
+            if not s["success"] or not s["transfer_s"] or not s["chunk_size"]:
+                continue
+            if (s.get("concurrency") or 1) > 1:
+                continue
+            predicted = self.transfer_time(
+                s["image_size"], s["chunk_size"], s["block_size"]
+            )
+            ratios.append(s["transfer_s"] / predicted)
+            if s["total_s"] is not None:
+                overheads.append(s["total_s"] - s["transfer_s"])
+        if ratios:
+            self.transfer_scale = percentile(ratios, 50)
+            self.overhead = percentile(overheads, 50)
+        return len(ratios)
+
+
+def print_plan(planner, image_size, mtus, pd_char_size, devices, dongles):
+    print(
+        "%5s %5s %5s %5s %6s %7s %5s %7s %8s %10s %9s %9s"
+        % (
+            "mtu",
+            "pd",
+            "chunk",
+            "block",
+            "blocks",
+            "chunks",
+            "plen",
+            "notify",
+            "at_cmds",
+            "transfer",
+            "device",
+            "B/s",
+        )
+    )
+    for mtu in mtus:
+        p = planner.plan(image_size, mtu, pd_char_size)
+        print(
+            "%5d %5d %5d %5d %6d %7d %5d %7d %8d %9.1fs %8.1fs %9.0f"
+            % (
+                p["mtu"],
+                p["pd_char_size"],
+                p["chunk_size"],
+                p["block_size"],
+                p["blocks"],
+                p["chunk_writes"],
+                p["patch_len_writes"],
+                p["notifications"],
+                p["at_commands"],
+                p["transfer_s"],
+                p["device_s"],
+                image_size / p["transfer_s"],
+            )
+        )
+        # Each dongle updates its share of the devices one after the other
+        fleet = -(-devices // dongles) * p["device_s"]
+        print(
+            "      %d devices on %d dongle(s): %d:%02d:%02d, %.0f devices/hour"
+            % (
+                devices,
+                dongles,
+                fleet // 3600,
+                fleet % 3600 // 60,
+                fleet % 60,
+                devices * 3600 / fleet,
+            )
+        )
+
+
+def open_transport(args, handler, new_version=None):
+    """Creates the transport chosen with -t/--transport.
+
+    The simulated devices come back from the update running `new_version`.
+    """
+    if args.transport == "bluez":
+        return BlueZTransport(handler, adapter=args.port or "hci0")
+    if args.transport == "sim":
+        return SimTransport(
+            handler,
+            [
+                SimSuotaPeer(
+                    "00:00:00:00:00:%02X" % (i + 1),
+                    new_fw_version=new_version or "2.0.0",
+                    rssi=-85 if weak else -45 - i,
+                    latency=0.05 if weak else 0.0,
+                    l2cap_psm=SIM_L2CAP_PSM if i < args.sim_l2cap else None,
+                    flash_time=args.sim_flash_ms / 1000.0,
+                    crc_error=i < args.sim_crc_errors,
+                )
+                for i, weak in [
+                    (i, i >= args.sim_devices - args.sim_weak)
+                    for i in range(args.sim_devices)
+                ]
+            ],
+            latency=args.sim_latency_ms / 1000.0,
+        )
+    return BleuIOTransport(handler, args.port, args.pipeline, args.pipeline_window)
+
+
+def open_verify_transport(args, handler):
+    """Creates a second transport for the post-reboot verification, None if not possible."""
+    if args.verify_port:
+        return BleuIOTransport(handler, args.verify_port)
+    if args.transport == "bluez":
+        return BlueZTransport(handler, adapter=args.port or "hci0")
+    if args.transport == "sim":
+        main_transport = transport
+        if isinstance(main_transport, FaultInjectingTransport):
+            main_transport = main_transport.inner
+        return SimTransport(handler, list(main_transport.peers.values()))
+    return None
+
+
+def open_scan_transport(args, handler):
+    """Creates the transport used for discovery, None to scan with the main transport."""
+    if args.scan_port:
+        return BleuIOTransport(handler, args.scan_port)
+    return None
+
+
+def start_background_scan():
+    """Keeps looking for the next BleuIO Dongle in SUOTA mode during the update."""
+    if scan_transport is not None:
+        scan_transport.scan(BLEUIO_SUOTA_ADV_DATA)
+    elif transport.background_scan:
+        transport.scan(BLEUIO_SUOTA_ADV_DATA)
+
+
+def stop_background_scan():
+    if scan_transport is not None:
+        scan_transport.stop_scan()
+    elif transport.background_scan:
+        transport.stop_scan()
+
+
+def preconnect_next_device(gatt_only=False):
+    """Starts connecting to the next queued BleuIO Dongle, if any.
+
+    :returns: The SuotaSession of the device or None.
+    """
+    global preconnect_session
+    mac = discovery.pop()
+    if mac is None:
+        return None
+    print(f"Connecting to next BleuIO Dongle ({mac}) found during the update.\n")
+    preconnect_session = main_session(mac, gatt_only)
+    preconnect_session.connect()
+    return preconnect_session
+
+
+def main_session(mac, gatt_only=False):
+    """Returns a SuotaSession on the main transport, the one main() runs next."""
+    session = SuotaSession(
+        mac,
+        patch_data,
+        gatt_only=gatt_only,
+        connection=transport,
+        shared_timeouts=timeouts,
+    )
+    session.prefix = ""
+    session.legacy = True
+    updater_events.session = session
+    return session
+
+
+def find_BleuIO(id):
+    """Scans for a BleuIO Dongle in SUOTA mode and returns the one to update next.
+
+    Takes the first device found. Only run_sessions() waits SCHEDULE_WINDOW
+    for more devices, it has to choose the ones to update at the same time.
+    """
+    global bleuio_found
+    global mac_addr
+    bleuio_found = False
+    print_dbg_msg("find_BleuIO(%s)" % (id))
+
+    if preconnect_session is not None:
+        bleuio_found = True
+        mac_addr = preconnect_session.mac
+        discovery.start(mac_addr)
+        return mac_addr
+    queued_mac = discovery.pop()
+    if queued_mac is not None:
+        # Found while updating the previous device, no need to scan again
+        bleuio_found = True
+        mac_addr = queued_mac
+        discovery.start(mac_addr)
+        print(
+            f"Found BleuIO Dongle ({mac_addr}, RSSI: {discovery.rssi(mac_addr)}) during the last update.\n"
+        )
+        return mac_addr
+
+    scanner = scan_transport if scan_transport is not None else transport
+    scanner.stop_scan()
+    scanner.scan(id)
+    scan_start = time.time()
+    scan_cnt = 0
+    while not bleuio_found and time.time() - scan_start < SCAN_TIMEOUT:
+        time.sleep(FIND_POLL_INTERVAL)
+        scan_cnt += 1
+        # A "#" every 2s
+        if scan_cnt % round(2 / FIND_POLL_INTERVAL) == 0:
+            print("#", end="", flush=True)
+        pass
+    if not bleuio_found:
+        print(
+            f"\n\n{bcolors.WARNING}-:CANNOT FIND ANY BLEUIO DONGLE IN SOUTA MODE:-\r\n{bcolors.ENDC}Please make sure the BleuIO Dongle is in SUOTA mode and advertising then try again."
+        )
+        scanner.stop_scan()
+        raise Exception("Cannot find BleuIO!")
+    print("\n\n")
+    scanner.stop_scan()
+    mac_addr = discovery.pop()
+    if mac_addr is None:
+        raise Exception("Cannot find BleuIO!")
+    discovery.start(mac_addr)
+
+    print(f"Found BleuIO Dongle ({mac_addr}, RSSI: {discovery.rssi(mac_addr)}).\n")
+    return mac_addr
+
+
+class RttEstimator:
+    """Smoothed round-trip time of one kind of operation.
+
+    Same estimator as the TCP retransmission timer (RFC 6298): the timeout is
+    srtt + 4 * rttvar, kept between `floor` and `ceiling`. The ceiling is used
+    until RTT_MIN_SAMPLES round trips have been measured.
+    """
+
+    def __init__(self, floor, ceiling):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.reset()
+
+    def reset(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+
+    def timeout(self):
+        if self.samples < RTT_MIN_SAMPLES:
+            return self.ceiling
+        return min(max(self.srtt + 4 * self.rttvar, self.floor), self.ceiling)
+
+
+class AdaptiveTimeouts:
+    """Timeouts of the updater operations, derived from their measured round-trip times."""
+
+    def __init__(self, limits=TIMEOUT_LIMITS):
+        self.enabled = True
+        self._rtt = dict(
+            (op, RttEstimator(floor, ceiling))
+            for op, (floor, ceiling) in limits.items()
+        )
+
+    def get(self, op):
+        """Returns the timeout in seconds of `op`."""
+        if not self.enabled:
+            return self._rtt[op].ceiling
+        return self._rtt[op].timeout()
+
+    def sample(self, op, rtt):
+        """Records the measured round-trip time in seconds of `op`."""
+        self._rtt[op].sample(rtt)
+
+    def new_session(self):
+        for op in SESSION_TIMEOUTS:
+            self._rtt[op].reset()
+
+    def summary(self):
+        return ", ".join(
+            "%s: %.2fs (srtt %s, n=%d)"
+            % (
+                op,
+                self.get(op),
+                "-" if rtt.srtt is None else "%.3fs" % (rtt.srtt),
+                rtt.samples,
+            )
+            for op, rtt in self._rtt.items()
+        )
+
+
+timeouts = AdaptiveTimeouts()
+
+
+def checksum(data, len):
+    crc_code = 0
+    i = 0
+
+    # for(i = 0; i < len; i++)
+    for i in range(0, len):
+        crc_code ^= data[i]
+
+    return crc_code
+
+
+def read_value(uuid, data):
+    """Returns a characteristic value read from the device as the updater uses it."""
+    if uuid == DIS_FW_VERSION_UUID:
+        return data.decode("ASCII")
+    if uuid == SUOTA_VERSION_UUID:
+        return str(int.from_bytes(data, "big") / 10)
+    return str(int.from_bytes(data, "little"))
+
+
+class SuotaSession:
+    """Updates one device, the SUOTA engine of the updater.
+
+    main() runs one session at a time on the main transport, which hands the
+    connection events over through UpdaterEvents.session. run_sessions()
+    runs several side by side in their own threads, each on its own
+    connection of the shared transport. Either way the session keeps its own
+    handles and queues. The public attributes show how far it got.
+    """
+
+    def __init__(
+        self,
+        mac,
+        image,
+        record=None,
+        gatt_only=False,
+        connection=None,
+        shared_timeouts=None,
+    ):
+        self.mac = mac
+        self.image = image
+        self.record = record
+        self.gatt_only = gatt_only
+        # Put in front of the printed lines, to tell the sessions apart
+        self.prefix = "[%s] " % (mac)
+        # Print the lines of the single-device updater instead, see _status()
+        self.legacy = False
+        self.phase = "connect"
+        self.link = "gatt"
+        self.bytes_sent = 0
+        self.rate = 0.0
+        # Rate of the last blocks, smoothed
+        self.current_rate = 0.0
+        self.eta = None
+        self.started = time.time()
+        self.ended = None
+        self.success = False
+        self.supported = True
+        self.status = None
+        self.error = ""
+        self.old_version = ""
+        self.handles = {}
+        self.timeouts = shared_timeouts
+        if self.timeouts is None:
+            self.timeouts = AdaptiveTimeouts()
+            self.timeouts.enabled = timeouts.enabled
+        self._connect_sent = None
+        # Set once the session ends the connection itself
+        self._closing = False
+        self._connected = threading.Event()
+        self._browsed = threading.Event()
+        self._read_q = queue.Queue()
+        self._write_rsp_q = queue.Queue()
+        self._notifications_q = queue.Queue()
+        # Runs on `connection` if given, the caller routes its events here
+        self._own_transport = connection is None
+        if connection is None:
+            connection = transport.open_connection(self)
+        self.transport = connection
+        self.thread = threading.Thread(target=self._run, name="suota_" + mac)
+        self.thread.daemon = True
+
+    def connect(self):
+        """Starts connecting, can be called before the session runs."""
+        self._connect_sent = time.time()
+        self.transport.connect(self.mac)
+
+    def start(self):
+        """Runs the session in its own thread."""
+        self.thread.start()
+
+    def run(self):
+        """Runs the session in the calling thread."""
+        self._run()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def _print(self, msg):
+        print_line(self.prefix + msg)
+
+    def _status(self, msg, legacy=None):
+        """Prints `msg`, or `legacy` in legacy mode, either can be None.
+
+        The legacy lines are the ones the single-device updater always
+        printed, scripts read them.
+        """
+        msg = legacy if self.legacy else msg
+        if msg is not None:
+            self._print(msg)
+
+    def _run(self):
+        self.started = time.time()
+        try:
+            self._update()
+        except Exception as e:
+            self.error = str(e)
+            if not self.legacy:
+                self._print(f"{bcolors.FAIL}{e}{bcolors.ENDC}")
+            elif self.phase == "connect":
+                print_dbg_msg(e)
+            else:
+                self._print(str(e))
+            fault_detected(self.mac)
+        self._closing = True
+        if self.transport.is_connected():
+            self.transport.disconnect()
+            # Don't take this connection for the next session
+            disconnect_start = time.time()
+            while (
+                self.transport.is_connected()
+                and time.time() - disconnect_start < self.timeouts.get("connect")
+            ):
+                time.sleep(0.01)
+        self.ended = time.time()
+        self.phase = "done" if self.success else "failed"
+        if self.success:
+            fault_recovered(self.mac)
+        elif discovery.attempts(self.mac) >= RETRIES_NUMBER:
+            # Not retried, otherwise its faults stay open for the next session
+            fault_lost(self.mac)
+        discovery.finish(self.success, self.mac)
+        if self.record is not None and history is not None:
+            history.insert(self.record.finish(self.success, self.status, self.error))
+        if inventory is not None:
+            inventory.result(self.mac, self.success, self.status, self.error)
+        emit_event(
+            "complete",
+            mac=self.mac,
+            success=self.success,
+            status=self.status,
+            status_name=(
+                error_list[self.status]
+                if self.status is not None and self.status < len(error_list)
+                else None
+            ),
+            error=self.error,
+            elapsed=round(self.ended - self.started, 3),
+        )
+        if self.success and verifier is not None:
+            verifier.add(self.mac, self.old_version)
+        if self._own_transport:
+            self.transport.close()
+
+    def _mark(self, phase):
+        self.phase = phase
+        if self.record is not None:
+            self.record.mark(phase)
+
+    def _set(self, **fields):
+        if self.record is not None:
+            self.record.set(**fields)
+
+    def _read(self, uuid, name):
+        handle = self.handles.get(uuid)
+        if not handle:
+            raise Exception("No %s characteristic!" % (name))
+        sent = time.time()
+        self.transport.read(handle)
+        try:
+            data = self._read_q.get(timeout=self.timeouts.get("read"))
+        except queue.Empty:
+            raise Exception("Cannot read %s!" % (name))
+        if data is None:
+            raise Exception("Disconnected!")
+        self.timeouts.sample("read", time.time() - sent)
+        return read_value(uuid, data)
+
+    def _write(self, uuid, data):
+        """Writes a characteristic with response."""
+        sent = time.time()
+        err = self.transport.write(self.handles.get(uuid, ""), data, True)
+        if not err == 0:
+            raise Exception("Write command error: %02X" % (err))
+        try:
+            status = self._write_rsp_q.get(timeout=self.timeouts.get("write"))
+        except queue.Empty:
+            raise Exception("No write confirmation!")
+        if status is None:
+            raise Exception("Disconnected!")
+        self.timeouts.sample("write", time.time() - sent)
+        if not status == 0:
+            raise Exception("BLE Write error: %02X" % (status))
+
+    def _wait_status(self, op):
+        sent = time.time()
+        if tracer is not None:
+            start = tracer.now()
+        try:
+            status = self._notifications_q.get(timeout=self.timeouts.get(op))
+        except queue.Empty:
+            raise Exception("No response or error response!")
+        if status is None:
+            raise Exception("Disconnected!")
+        if tracer is not None:
+            tracer.span("notification wait", "wait", start, mac=self.mac, status=status)
+        self.timeouts.sample(op, time.time() - sent)
+        return status
+
+    def _command(self, cmd, op):
+        """Writes a command to SUOTA_MEM_DEV and returns the status notified within the `op` timeout."""
+        self._write(SUOTA_MEM_DEV_UUID, bytes([0, 0, 0, cmd]))
+        status = self._wait_status(op)
+        emit_event("status", mac=self.mac, status=status, name=error_list[status])
+        return status
+
+    def _update(self):
+        self._mark("connect")
+        connect_start = time.time()
+        preconnected = self._connect_sent is not None
+        if not preconnected:
+            self.connect()
+        connect_timeout = self.timeouts.get("connect")
+        while not self._connected.wait(0.1):
+            if time.time() - connect_start >= connect_timeout:
+                self._status(
+                    None,
+                    f"\n\n{bcolors.WARNING}-:CANNOT CONNECT TO BleuIO Dongle:-\r\n{bcolors.ENDC}",
+                )
+                self.transport.cancel_connect()
+                raise Exception("Cannot connect!")
+            if self.legacy:
+                print("#", end="", flush=True)
+        if not preconnected:
+            self.timeouts.sample("connect", time.time() - connect_start)
+        emit_event(
+            "connected", mac=self.mac, connect_s=round(time.time() - connect_start, 3)
+        )
+        self._status(
+            "Connected to %s." % (self.mac),
+            "\n\n\nConnected to " + self.mac + "\n\nConnect Success!",
+        )
+        self._mark("handshake")
+        self.transport.browse()
+        # Not adaptive, a browse takes as long as the device has services
+        if not self._browsed.wait(DEFAULT_TIMEOUT):
+            raise Exception("Browse timed out!")
+        if SUOTA_MEM_DEV_UUID not in self.handles:
+            self.supported = False
+            raise Exception("Device doesn't support SUOTA.")
+        self.transport.subscribe(self.handles.get(SUOTA_SERV_STATUS_UUID, ""))
+        try:
+            self.old_version = self._read(DIS_FW_VERSION_UUID, "firmware version")
+            if inventory is not None:
+                inventory.set_version(self.mac, self.old_version)
+            self._status(
+                None,
+                f"\nCurrent Firmware Version of BleuIO Dongle: {bcolors.OKCYAN}{self.old_version}{bcolors.ENDC}\n",
+            )
+        except Exception:
+            self._print("Cannot read firmware version!")
+        suota_ver = self._read(SUOTA_VERSION_UUID, "SUOTA version")
+        self._status(
+            None,
+            f"\nSUOTA Version : {bcolors.OKCYAN}{suota_ver}{bcolors.ENDC}\n\nDevice support SUOTA.",
+        )
+        mtu = int(self._read(SUOTA_MTU_UUID, "MTU_SIZE"))
+        self._status(None, f"\nMTU_SIZE: {bcolors.OKCYAN}{mtu}{bcolors.ENDC}\n")
+        pd_char_size = int(self._read(SUOTA_PD_CHAR_SIZE_UUID, "RD_PD_CHAR_SIZE"))
+        self._status(
+            None, f"PD_CHAR_SIZE: {bcolors.OKCYAN}{pd_char_size}{bcolors.ENDC}\n"
+        )
+        l2cap = False
+        if (
+            SUOTA_L2CAP_PSM_UUID in self.handles
+            and self.transport.l2cap
+            and not self.gatt_only
+        ):
+            psm = 0
+            try:
+                psm = int(self._read(SUOTA_L2CAP_PSM_UUID, "L2CAP PSM"))
+                l2cap = self.transport.l2cap_connect(psm)
+            except Exception as e:
+                print_dbg_msg(e)
+            if l2cap:
+                self._status(
+                    None,
+                    f"Sending the image over L2CAP: {bcolors.OKCYAN}PSM 0x{psm:02X}{bcolors.ENDC}\n",
+                )
+            else:
+                self._status(
+                    "Cannot open the L2CAP channel, using GATT.",
+                    "Cannot open the L2CAP channel, using GATT.\n",
+                )
+        self.link = "l2cap" if l2cap else "gatt"
+        chunk_size, block_size = suota_geometry(mtu, pd_char_size)
+        if l2cap:
+            # One SDU per block, the channel segments it
+            chunk_size = block_size
+        self._set(old_version=self.old_version, mtu=mtu, pd_char_size=pd_char_size)
+        self._status(
+            "Firmware %s, SUOTA %s, MTU %d, PD_CHAR_SIZE %d, %s."
+            % (
+                self.old_version,
+                suota_ver,
+                mtu,
+                pd_char_size,
+                "L2CAP PSM 0x%02X" % (psm) if l2cap else "GATT",
+            )
+        )
+
+        # SUOTA_MEM_DEV_SPI and bank 0
+        status = self._command(0x13, "start")
+        if not status == SUOTA_STATUS_IMG_STARTED:
+            self.status = failure_status(status)
+            raise Exception(
+                "SUOTA_STATUS ERROR: %02X (%s)" % (status, error_list[status])
+            )
+        self._status(None, "Update started: %02X (%s)" % (status, error_list[status]))
+        self._set(chunk_size=chunk_size, block_size=block_size, link=self.link)
+        self._mark("transfer")
+        emit_event(
+            "handshake",
+            mac=self.mac,
+            fw_version=self.old_version,
+            suota_version=suota_ver,
+            mtu=mtu,
+            pd_char_size=pd_char_size,
+            chunk_size=chunk_size,
+            block_size=block_size,
+            link=self.link,
+        )
+        self.transport.bulk_start()
+        try:
+            transfer_time = self._transfer(chunk_size, block_size, l2cap)
+        finally:
+            self.transport.bulk_stop()
+            if l2cap:
+                self.transport.l2cap_close()
+        self._mark("end")
+        # The legacy output has these after the end status
+        if not self.legacy:
+            self._print_transfer_time(transfer_time)
+        commands_per_second = self.transport.commands_per_second()
+        emit_event(
+            "transferred",
+            mac=self.mac,
+            transfer_s=round(transfer_time, 3),
+            rate=round(len(self.image) / transfer_time),
+            commands_per_second=round(commands_per_second, 1),
+        )
+        # Statuses notified after the last block
+        while not self._notifications_q.empty():
+            status = self._notifications_q.get_nowait()
+            if not status == SUOTA_STATUS_CMP_OK:
+                self.status = failure_status(status)
+                self._status(None, "ERROR: %02X (%s)" % (status, error_list[status]))
+                raise Exception("Suota error: %02X (%s)" % (status, error_list[status]))
+            self._status(None, "OK: %02X (%s)" % (status, error_list[status]))
+        try:
+            status = self._command(0xFE, "end")
+        except Exception:
+            self._status(None, "app_suota_end no response!")
+            raise
+        if not status == SUOTA_STATUS_CMP_OK:
+            self.status = failure_status(status)
+            self._status(
+                None,
+                f"\nUpdate Error: {bcolors.FAIL}{error_list[status]}{bcolors.ENDC}\n",
+            )
+            raise Exception("Update Error: %s" % (error_list[status]))
+        self.status = status
+        self._status(
+            None,
+            f"{bcolors.OKGREEN}Update Successful: %02X %s{bcolors.ENDC}\n"
+            % (status, error_list[status]),
+        )
+        if self.legacy:
+            self._print_transfer_time(transfer_time)
+        self._status(None, "Rebooting BleuIO.")
+        # The device disconnects when it reboots
+        self._closing = True
+        self.transport.write(
+            self.handles[SUOTA_MEM_DEV_UUID], bytes([0, 0, 0, 0xFD]), True
+        )
+        self._status(None, "BleuIO rebooted.")
+        self.success = True
+        self._status(f"{bcolors.OKGREEN}Updated Successfully!{bcolors.ENDC}")
+
+    def _print_transfer_time(self, transfer_time):
+        self._print("Image sent in %.2fs" % (transfer_time))
+        commands_per_second = self.transport.commands_per_second()
+        if commands_per_second:
+            self._print("Commands/s: %.1f" % (commands_per_second))
+
+    def _transfer(self, chunk_size, block_size, l2cap):
+        """Sends the image block by block, returns the time it took."""
+        size = len(self.image)
+        plan = TransferPlan(size, chunk_size, block_size)
+        print_dbg_msg(
+            "chunk size: %d, block size: %d, blocks: %d, chunks: %d"
+            % (chunk_size, block_size, plan.blocks, len(plan))
+        )
+        start_time = time.time()
+        last_percent = 0
+        for block in range(plan.blocks):
+            if not self.transport.is_connected():
+                raise Exception("Disconnected!")
+            entries = plan.block(block)
+            block_offset = entries[0][1]
+            block_length = plan.block_end(block) - block_offset
+            block_sent = time.time()
+            if entries[0][3]:
+                if tracer is not None:
+                    start = tracer.now()
+                self._write(SUOTA_PATCH_LEN_UUID, entries[0][3].to_bytes(2, "little"))
+                if tracer is not None:
+                    tracer.span("patch len write", "suota", start, length=entries[0][3])
+                traced_sleep(0.4)
+            if tracer is not None:
+                block_start = tracer.now()
+            # Don't let the other sessions in between the chunks of the block
+            self.transport.hold()
+            try:
+                for block_index, offset, length, patch_len in entries:
+                    chunk = self.image[offset : offset + length]
+                    if tracer is not None:
+                        start = tracer.now()
+                    if l2cap:
+                        err = self.transport.l2cap_send(chunk)
+                    else:
+                        err = self.transport.write(
+                            self.handles[SUOTA_PATCH_DATA_UUID], chunk, False
+                        )
+                    if tracer is not None:
+                        tracer.span(
+                            "chunk write", "suota", start, offset=offset, length=length
+                        )
+                    if not err == 0:
+                        self._print("Write command error: %02X" % (err))
+                        fault_detected(self.mac)
+            finally:
+                self.transport.release()
+            if tracer is not None:
+                start = tracer.now()
+            for index, cmd, err in self.transport.flush():
+                self._print("Write command error: %02X (command #%d)" % (err, index))
+                print_dbg_msg(cmd)
+            if tracer is not None:
+                tracer.span("flush", "wait", start)
+            status = self._wait_status("block")
+            if not status == SUOTA_STATUS_CMP_OK:
+                self.status = failure_status(status)
+                emit_event(
+                    "status", mac=self.mac, status=status, name=error_list[status]
+                )
+                self._status(
+                    None, "Image file error: %02X (%s)" % (status, error_list[status])
+                )
+                if status == SUOTA_STATUS_SAME_IMAGE_ERROR:
+                    raise Exception("Device is already updated.")
+                if status == SUOTA_STATUS_INVALID_PRODUCT_HEADER:
+                    raise Exception("Invalid Product Header!")
+                raise Exception(
+                    "Image file error: %02X (%s)" % (status, error_list[status])
+                )
+            fault_recovered(self.mac)
+            if tracer is not None:
+                tracer.span(
+                    "block",
+                    "suota",
+                    block_start,
+                    mac=self.mac,
+                    offset=block_offset,
+                    length=block_length,
+                )
+            self.bytes_sent = block_offset + block_length
+            elapsed = max(time.time() - start_time, 0.001)
+            self.rate = self.bytes_sent / elapsed
+            block_rate = block_length / max(time.time() - block_sent, 0.001)
+            if self.current_rate:
+                block_rate = 0.75 * self.current_rate + 0.25 * block_rate
+            self.current_rate = block_rate
+            self.eta = (size - self.bytes_sent) / self.rate
+            percent = self.bytes_sent * 100 / size
+            if events is not None:
+                events.progress(
+                    self.mac, percent, bytes=self.bytes_sent, rate=round(self.rate)
+                )
+            if self.legacy:
+                # Every block, as the single-device updater always did
+                if self.bytes_sent == size:
+                    self._print("Done!")
+                    self._print("Upload complete.")
+                else:
+                    self._print("Uploading : %.1f %% " % (percent))
+            elif dashboard is None and (
+                percent - last_percent >= 10 or self.bytes_sent == size
+            ):
+                last_percent = percent
+                self._print("Uploading : %.1f %% " % (percent))
+            if block + 1 == EARLY_RATE_BLOCKS:
+                self._set(early_rate=self.rate)
+                if min_rate and self.rate < min_rate and discovery.defer(self.mac):
+                    self._print(
+                        f"{bcolors.WARNING}Slow link ({self.rate:.0f} B/s), updating the other devices first.{bcolors.ENDC}"
+                    )
+                    emit_event("deferred", mac=self.mac, rate=round(self.rate))
+                    raise Exception("Update deferred, slow link.")
+            if block + 1 < plan.blocks and not plan.block(block + 1)[0][3]:
+                traced_sleep(0.01)
+        return time.time() - start_time
+
+    # Events from the connection
+    def on_adv(self, mac, data, rssi):
+        pass
+
+    def on_connected(self):
+        self._connected.set()
+
+    def on_disconnected(self):
+        was_connected = self._connected.is_set()
+        self._connected.clear()
+        if was_connected and not self._closing:
+            # Lost the link, wake up whatever the session waits for
+            fault_detected(self.mac)
+            for q in (self._read_q, self._write_rsp_q, self._notifications_q):
+                q.put(None)
+
+    def on_browse_complete(self):
+        self._browsed.set()
+
+    def on_service(self, uuid):
+        pass
+
+    def on_characteristic(self, uuid, handle):
+        print_dbg_msg("%s Handle: %s" % (uuid, handle))
+        self.handles[uuid] = handle
+
+    def on_read(self, handle, data):
+        self._read_q.put(data)
+
+    def on_write_status(self, handle, status):
+        if tracer is not None:
+            tracer.instant("write status", "event", handle=handle, status=status)
+        self._write_rsp_q.put(status)
+
+    def on_notification(self, handle, data):
+        status = int.from_bytes(data, "big")
+        if tracer is not None:
+            tracer.instant("notification", "event", mac=self.mac, status=status)
+        self._notifications_q.put(status)
+
+    def on_indication(self, handle, data):
+        print_dbg_msg("Indication: " + str(binascii.hexlify(data)))
+
+
+class Dashboard:
+    """Live table of the running sessions, redrawn at a fixed frame rate.
+
+    Each frame is rendered from the attributes of the sessions, so the cost
+    doesn't depend on how many chunks are sent. While it runs, everything
+    printed goes to a short log under the table instead of the terminal.
+    """
+
+    def __init__(self, fps=DASHBOARD_FPS, log_lines=DASHBOARD_LOG_LINES):
+        self.fps = fps
+        self.sessions = []
+        self.out = sys.stdout
+        self.started = time.time()
+        self._log = collections.deque(maxlen=log_lines)
+        self._partial = ""
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="dashboard")
+        self._thread.daemon = True
+
+    def start(self):
+        self.out = sys.stdout
+        self.started = time.time()
+        sys.stdout = self
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._draw()
+        sys.stdout = self.out
+
+    # Takes the place of sys.stdout
+    def write(self, text):
+        with self._lock:
+            lines = (self._partial + text).split("\n")
+            self._partial = lines.pop()
+            for line in lines:
+                line = re.sub("\x1b\\[[0-9;]*m", "", line).strip()
+                if line:
+                    self._log.append(line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def render(self):
+        """Returns the current frame."""
+        width = shutil.get_terminal_size().columns - 1
+        sessions = list(self.sessions)
+        active = [s for s in sessions if s.ended is None]
+        ok = len([s for s in sessions if s.success])
+        lines = [
+            "%-17s %-9s %-29s %10s %6s" % ("device", "phase", "progress", "B/s", "eta")
+        ]
+        for s in active:
+            done = s.bytes_sent / len(s.image)
+            lines.append(
+                "%-17s %-9s [%-20s] %5.1f%% %10.0f %6s"
+                % (
+                    s.mac,
+                    s.phase,
+                    "#" * int(done * 20),
+                    done * 100,
+                    s.current_rate,
+                    "-" if s.eta is None else "%.0fs" % (s.eta),
+                )
+            )
+        lines.append(
+            "%d running, %d queued, %d updated, %d failed, %.1f kB sent, %.0f B/s, %.0fs"
+            % (
+                len(active),
+                len(discovery),
+                ok,
+                len(sessions) - len(active) - ok,
+                sum(s.bytes_sent for s in sessions) / 1000.0,
+                sum(s.current_rate for s in active),
+                time.time() - self.started,
+            )
+        )
+        with self._lock:
+            lines.append("")
+            lines.extend(self._log)
+        return [line[:width] for line in lines]
+
+    def _draw(self):
+        frame = self.render()
+        text = ""
+        if self._lines:
+            # Back to the top of the last frame
+            text += "\x1b[%dF" % (self._lines)
+        text += "".join(line + "\x1b[K\n" for line in frame) + "\x1b[J"
+        self.out.write(text)
+        self.out.flush()
+        self._lines = len(frame)
+
+    def _run(self):
+        while not self._stop.wait(1.0 / self.fps):
+            try:
+                self._draw()
+            except Exception as e:
+                self._log.append("dashboard: " + str(e))
+
+
+class RolloutController:
+    """Runs the update of a fleet in waves and halts it if the image looks bad.
+
+    The first wave updates `canary` devices, each next wave `growth` times
+    more, up to `cap` devices at a time. A wave only starts when the one
+    before it has ended. Once `canary` sessions have finished, the rollout
+    halts as soon as the share of the finished sessions that failed with a
+    SUOTA image error (ROLLOUT_FAILURE_STATUSES) goes above
+    `max_failure_rate`. The sessions already running are finished but no new
+    one is started.
+    """
+
+    def __init__(self, canary, growth, cap, max_failure_rate):
+        self.canary = canary
+        self.growth = growth
+        self.cap = cap
+        self.max_failure_rate = max_failure_rate
+        self.wave = 1
+        self.wave_size = min(canary, cap)
+        self.started = 0
+        self.finished = 0
+        self.failures = 0
+        self.last_failure = None
+        self.halted = False
+        self._wave_started = 0
+
+    def slots(self, running, waiting):
+        """Returns how many sessions may be started now.
+
+        :param running: Number of sessions still running.
+        :param waiting: Number of devices waiting for an update.
+        """
+        if self.halted:
+            return 0
+        if self._wave_started >= self.wave_size:
+            if running or not waiting:
+                return 0
+            self._next_wave()
+        return min(self.cap - running, self.wave_size - self._wave_started)
+
+    def _next_wave(self):
+        self.wave += 1
+        self.wave_size = min(
+            max(int(self.wave_size * self.growth), self.wave_size + 1), self.cap
+        )
+        self._wave_started = 0
+        print_line(
+            f"{bcolors.OKCYAN}Rollout wave {self.wave}: {self.wave_size} devices, {self.failures} image failures in {self.finished} sessions so far.{bcolors.ENDC}"
+        )
+        emit_event("wave", wave=self.wave, size=self.wave_size, finished=self.finished)
+
+    def session_started(self, session):
+        self.started += 1
+        self._wave_started += 1
+
+    def session_ended(self, session):
+        self.finished += 1
+        if session.status in ROLLOUT_FAILURE_STATUSES:
+            self.failures += 1
+            self.last_failure = session
+        rate = self.failures / self.finished
+        if (
+            not self.halted
+            and self.finished >= min(self.canary, self.started)
+            and rate > self.max_failure_rate
+        ):
+            self.halted = True
+            print_line(
+                f"{bcolors.FAIL}Rollout halted in wave {self.wave}: {self.failures} of {self.finished} sessions failed with image errors ({rate:.0%}, limit {self.max_failure_rate:.0%}). Last: {self.last_failure.mac} {error_list[self.last_failure.status]}.{bcolors.ENDC}"
+            )
+            emit_event(
+                "halted",
+                wave=self.wave,
+                failures=self.failures,
+                finished=self.finished,
+                rate=round(rate, 3),
+                mac=self.last_failure.mac,
+                status_name=error_list[self.last_failure.status],
+            )
+
+
+def run_sessions(max_sessions, image, record_fields, gatt_only=False, rollout=None):
+    """Updates the devices found, up to `max_sessions` at a time on the one transport.
+
+    The connections share the dongle, so while one device writes a block to
+    its flash the chunks of the others go out. With a RolloutController it
+    decides how many sessions may run instead. Prints the time it took
+    against updating the same devices one by one.
+    """
+    scanner = scan_transport if scan_transport is not None else transport
+    # BleuIO can't scan while it has other commands to send
+    scan_while_busy = scan_transport is not None or transport.background_scan
+    sessions = []
+    active = []
+    scanning = False
+    run_start = last_busy = time.time()
+    print(
+        f"\r\nLooking to update BleuIO Dongles with fw: {suota_firmware_name}, {max_sessions} at a time\r\n"
+    )
+    if dashboard is not None:
+        dashboard.sessions = sessions
+        dashboard.start()
+    try:
+        while True:
+            running = [s for s in active if s.is_alive()]
+            if rollout is not None:
+                for session in active:
+                    if session not in running:
+                        rollout.session_ended(session)
+                if rollout.halted and not running:
+                    break
+            if scanning and len(running) < len(active):
+                # Scan again for the devices that just dropped their connection
+                scanner.stop_scan()
+                scanning = False
+            active = running
+            if active or len(discovery):
+                last_busy = time.time()
+            if rollout is not None:
+                slots = rollout.slots(len(active), len(discovery))
+            else:
+                slots = max_sessions - len(active)
+            if slots > 0 and len(discovery):
+                if not sessions:
+                    # Give the other devices in range a chance to be seen
+                    time.sleep(SCHEDULE_WINDOW)
+                if scanning and not scan_while_busy:
+                    scanner.stop_scan()
+                    scanning = False
+                while slots > 0:
+                    mac = discovery.pop()
+                    if mac is None:
+                        break
+                    discovery.start(mac)
+                    emit_event(
+                        "discovered",
+                        mac=mac,
+                        rssi=discovery.rssi(mac),
+                        attempt=discovery.attempts(mac),
+                    )
+                    print_line(
+                        f"Updating BleuIO Dongle: {bcolors.OKCYAN}{mac}{bcolors.ENDC} (RSSI: {discovery.rssi(mac)})"
+                    )
+                    record = None
+                    if history is not None:
+                        record = SessionRecord(
+                            mac=mac,
+                            retries=discovery.attempts(mac) - 1,
+                            rssi=discovery.rssi(mac),
+                            concurrency=max_sessions,
+                            **record_fields,
+                        )
+                        record.mark("connect")
+                    session = SuotaSession(mac, image, record, gatt_only)
+                    session.start()
+                    sessions.append(session)
+                    active.append(session)
+                    slots -= 1
+                    if rollout is not None:
+                        rollout.session_started(session)
+            if rollout is not None and rollout.halted:
+                pass
+            elif not scanning and (scan_while_busy or not active):
+                scanner.scan(BLEUIO_SUOTA_ADV_DATA)
+                scanning = True
+            if not active and not len(discovery) and not continuous:
+                # Stop once nothing new shows up for a while
+                if time.time() - last_busy > (
+                    SCHEDULE_WINDOW if sessions else SCAN_TIMEOUT
+                ):
+                    break
+            time.sleep(0.1)
+    finally:
+        if dashboard is not None:
+            dashboard.stop()
+    if scanning:
+        scanner.stop_scan()
+    print_sessions_summary(
+        sessions, run_start, record_fields.get("image_hash"), max_sessions
+    )
+    if rollout is not None:
+        print(
+            "Rollout %s after %d waves: %d image failures in %d sessions."
+            % (
+                "halted" if rollout.halted else "done",
+                rollout.wave,
+                rollout.failures,
+                rollout.finished,
+            )
+        )
+    return sessions
+
+
+def print_sessions_summary(sessions, run_start, image_hash, max_sessions):
+    """Prints the time the sessions took and the speedup over one device at a time.
+
+    Both times cover the successful sessions and start before the scan, like
+    the total time of a session in the history. Without single sessions of the
+    image on this port in the history the time one at a time is unknown.
+    """
+    if not sessions:
+        print(
+            f"\n{bcolors.WARNING}-:CANNOT FIND ANY BLEUIO DONGLE IN SOUTA MODE:-{bcolors.ENDC}"
+        )
+        return
+    ok = [s for s in sessions if s.success]
+    wall = max(s.ended for s in sessions) - run_start
+    # Until the last successful session ended, the time the devices took
+    ok_wall = max(s.ended for s in ok) - run_start if ok else 0
+    sequential = None
+    if history is not None and ok:
+        rows = history.query(
+            image_hash=image_hash, port=transport.port, concurrency=1, success=1
+        )
+        totals = [r["total_s"] for r in rows if r["total_s"]]
+        median = percentile(totals, 50)
+        if median is not None:
+            sequential = median * len(ok)
+    speedup = None
+    if sequential is not None and ok_wall > 0:
+        speedup = sequential / ok_wall
+    print(
+        f"\n{bcolors.OKGREEN}Updated {len(ok)} devices in {len(sessions)} sessions, {wall:.1f}s with up to {max_sessions} at a time.{bcolors.ENDC}"
+    )
+    if speedup is not None:
+        print(
+            "One at a time: %.1fs (median of %d sessions in the history), speedup x%.2f"
+            % (sequential, len(totals), speedup)
+        )
+    elif ok:
+        print(
+            "One at a time: unknown, no single sessions of this image in the history."
+        )
+    emit_event(
+        "sessions",
+        sessions=len(sessions),
+        success=len(ok),
+        concurrency=max_sessions,
+        wall_s=round(wall, 3),
+        sequential_s=round(sequential, 3) if sequential is not None else None,
+        speedup=round(speedup, 2) if speedup is not None else None,
+    )
+
+
+def main():
+    global debug_msg
+    global transport
+    global mac_addr
+    global suota_firmware_name
+    global scan_transport
+    global continuous
+    global verifier
+    global fault_injector
+    global history
+    global inventory
+    global dashboard
+    global events
+    global tracer
+    global min_rate
+    global updater_events
+    global preconnect_session
+
+    global patch_length
+    global patch_data
+
+    parser = argparse.ArgumentParser(
+        "Requires SUOTA firmware img file to update BleuIO Dongle with."
+    )
+    parser.add_argument(
+        "-fw",
+        help="Requires SUOTA firmware img file to update BleuIO Dongle with.",
+        required=False,
+        default=None,
+    )
+    parser.add_argument("-dbg", "--debug", action="store_true", help="shows debug msg")
+    parser.add_argument(
+        "-p",
+        "--port",
+        required=False,
+        default="",
+        help="Choose port used by dongle used to update. If note choosen the first port found used by a BleuIO Dongle will be used. With the bluez transport: the adapter to use (default: hci0).",
+    )
+    parser.add_argument(
+        "-t",
+        "--transport",
+        choices=["bleuio", "bluez", "sim"],
+        default="bleuio",
+        help="bleuio: a BleuIO Dongle over serial, bluez: the host's own BLE adapter through BlueZ, sim: simulated SUOTA devices. (default: bleuio)",
+    )
+    parser.add_argument(
+        "-sp",
+        "--scan-port",
+        required=False,
+        default="",
+        help="Port of a second BleuIO Dongle used to look for the next device while updating.",
+    )
+    parser.add_argument(
+        "-c",
+        "--continuous",
+        action="store_true",
+        help="Keep updating every BleuIO Dongle found in SUOTA mode without asking.",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check in the background that each updated device comes back with the new firmware.",
+    )
+    parser.add_argument(
+        "-vp",
+        "--verify-port",
+        required=False,
+        default="",
+        help="Port of a second BleuIO Dongle used for --verify. Needed with the bleuio transport.",
+    )
+    parser.add_argument(
+        "--expect-version",
+        required=False,
+        default="",
+        help="Firmware version the updated devices should report. If not given it is read from the image header.",
+    )
+    parser.add_argument(
+        "--faults",
+        required=False,
+        default="",
+        help="Inject faults for testing the failure paths: comma separated list of %s or 'all'."
+        % (", ".join(FAULT_CLASSES)),
+    )
+    parser.add_argument(
+        "--fault-rate",
+        type=float,
+        default=0.01,
+        help="Probability of a fault per operation with --faults. (default: 0.01)",
+    )
+    parser.add_argument(
+        "--fault-seed",
+        type=int,
+        default=0,
+        help="Seed of the fault schedule with --faults. (default: 0)",
+    )
+    parser.add_argument(
+        "--fault-delay",
+        type=float,
+        default=2.0,
+        help="Delay in seconds of delay_notification faults. (default: 2.0)",
+    )
+    parser.add_argument(
+        "--sim-devices",
+        type=int,
+        default=1,
+        help="Number of simulated devices with the sim transport. (default: 1)",
+    )
+    parser.add_argument(
+        "--sim-weak",
+        type=int,
+        default=0,
+        help="Number of the simulated devices with a weak, slow link. (default: 0)",
+    )
+    parser.add_argument(
+        "--sim-l2cap",
+        type=int,
+        default=0,
+        help="Number of the simulated devices that can receive the image over L2CAP. (default: 0)",
+    )
+    parser.add_argument(
+        "--sim-latency-ms",
+        type=float,
+        default=0,
+        help="Time in ms the simulated dongle spends on each write, shared by all its connections. (default: 0)",
+    )
+    parser.add_argument(
+        "--sim-flash-ms",
+        type=float,
+        default=0,
+        help="Time in ms the simulated devices take to write a block to flash. (default: 0)",
+    )
+    parser.add_argument(
+        "-s",
+        "--sessions",
+        type=int,
+        default=1,
+        help="Number of devices to update at the same time through the one dongle. Not with --pipeline or the bluez transport. (default: 1)",
+    )
+    parser.add_argument(
+        "--rollout",
+        action="store_true",
+        help="Update the devices in waves: --canary devices first, then --wave-growth times more in each wave, up to -s (2 or more) at a time. Halts when more than --max-failure-rate of the sessions fail with an image error.",
+    )
+    parser.add_argument(
+        "--canary",
+        type=int,
+        default=1,
+        help="--rollout: number of devices in the first wave. (default: 1)",
+    )
+    parser.add_argument(
+        "--wave-growth",
+        type=float,
+        default=2.0,
+        help="--rollout: size of each wave compared to the one before. (default: 2)",
+    )
+    parser.add_argument(
+        "--max-failure-rate",
+        type=float,
+        default=0.1,
+        help="--rollout: share of the finished sessions failing with a SUOTA image error (CRC, header, size, ...) above which the rollout halts. (default: 0.1)",
+    )
+    parser.add_argument(
+        "--sim-crc-errors",
+        type=int,
+        default=0,
+        help="Number of the simulated devices that report a CRC error at the end of the update. (default: 0)",
+    )
+    parser.add_argument(
+        "--dashboard",
+        action="store_true",
+        help="With -s: show a live table of the running sessions instead of their progress lines.",
+    )
+    parser.add_argument(
+        "--dashboard-fps",
+        type=float,
+        default=DASHBOARD_FPS,
+        help="Frames per second of --dashboard. (default: %d)" % (DASHBOARD_FPS),
+    )
+    parser.add_argument(
+        "--gatt-only",
+        action="store_true",
+        help="Always send the image with GATT writes, even to devices that support L2CAP.",
+    )
+    parser.add_argument(
+        "--min-rate",
+        type=float,
+        default=0,
+        help="Transfer rate in bytes/s below which a device is put behind the other devices found, measured over the first %d blocks. (default: 0, off)"
+        % (EARLY_RATE_BLOCKS),
+    )
+    parser.add_argument(
+        "-pl",
+        "--pipeline",
+        action="store_true",
+        help="Queue the AT write commands of the image transfer without waiting for each Ack.",
+    )
+    parser.add_argument(
+        "--pipeline-window",
+        type=int,
+        default=AT_PIPELINE_WINDOW,
+        help="Max number of AT commands in flight when using --pipeline. (default: %d)"
+        % (AT_PIPELINE_WINDOW),
+    )
+    parser.add_argument(
+        "--fixed-timeouts",
+        action="store_true",
+        help="Always wait the maximum time for a response instead of deriving the timeouts from the measured round-trip times.",
+    )
+    parser.add_argument(
+        "--json",
+        nargs="?",
+        const="-",
+        default=None,
+        help="Write the update events as JSON lines to a file, or to stdout if no file is given. The normal output then goes to stderr.",
+    )
+    parser.add_argument(
+        "--progress-step",
+        type=float,
+        default=10,
+        help="Percent of the image between the progress events of --json, 0 for every block. (default: 10)",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write a timeline of the AT commands, chunk writes, waits and sleeps to this file in Chrome trace format.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print the predicted transfer time of the -fw image for the link assumptions below and exit.",
+    )
+    parser.add_argument(
+        "--mtu",
+        default="512",
+        help="--plan: MTU, or comma separated MTUs to compare. (default: 512)",
+    )
+    parser.add_argument(
+        "--pd-char-size",
+        type=int,
+        default=244,
+        help="--plan: PD_CHAR_SIZE of the devices. (default: 244)",
+    )
+    parser.add_argument(
+        "--conn-interval",
+        type=float,
+        default=PLAN_CONN_INTERVAL * 1000,
+        help="--plan: connection interval in ms. (default: %g)"
+        % (PLAN_CONN_INTERVAL * 1000),
+    )
+    parser.add_argument(
+        "--baud",
+        type=int,
+        default=PLAN_BAUD,
+        help="--plan: serial rate of the dongle. (default: %d)" % (PLAN_BAUD),
+    )
+    parser.add_argument(
+        "--at-latency",
+        type=float,
+        default=PLAN_AT_LATENCY * 1000,
+        help="--plan: round trip of an AT command to the dongle in ms. (default: %g)"
+        % (PLAN_AT_LATENCY * 1000),
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=1,
+        help="--plan: number of devices to update. (default: 1)",
+    )
+    parser.add_argument(
+        "--dongles",
+        type=int,
+        default=1,
+        help="--plan: number of host dongles updating in parallel. (default: 1)",
+    )
+    parser.add_argument(
+        "--calibrate",
+        action="store_true",
+        help="--plan: scale the prediction to the sessions of the chosen transport in --history, those updated one at a time.",
+    )
+    parser.add_argument(
+        "--history",
+        default=DEFAULT_HISTORY_FILE,
+        help="SQLite file every update session is recorded in. (default: %s)"
+        % (DEFAULT_HISTORY_FILE),
+    )
+    parser.add_argument(
+        "--no-history", action="store_true", help="Don't record the update sessions."
+    )
+    parser.add_argument(
+        "--inventory",
+        default=DEFAULT_INVENTORY_FILE,
+        help="JSON file with the last known firmware version and update result of each device seen. Devices already updated with the image are not connected to again. (default: %s)"
+        % (DEFAULT_INVENTORY_FILE),
+    )
+    parser.add_argument(
+        "--no-inventory", action="store_true", help="Don't use or keep the inventory."
+    )
+    parser.add_argument(
+        "--inventory-ttl",
+        type=float,
+        default=INVENTORY_TTL_DAYS,
+        help="Days after which a device not seen is dropped from the inventory. (default: %d)"
+        % (INVENTORY_TTL_DAYS),
+    )
+    parser.add_argument(
+        "--site",
+        default=platform.node(),
+        help="Name of the site recorded with each session. (default: host name)",
+    )
+    parser.add_argument(
+        "--report",
+        choices=sorted(HISTORY_GROUPS.keys()),
+        help="Print the percentiles of the update time and throughput in the history grouped by site, port, firmware, mac or image and exit.",
+    )
+    parser.add_argument(
+        "--report-days",
+        type=float,
+        default=0,
+        help="Only include the sessions of the last N days in --report. (default: all)",
+    )
+    args = parser.parse_args()
+
+    if args.report:
+        history = UpdateHistory(args.history)
+        since = None
+        if args.report_days:
+            since = time.time() - args.report_days * 24 * 3600
+        history.print_report(args.report, since)
+        history.close()
+        sys.exit(0)
+    if not args.fw:
+        parser.error("the following arguments are required: -fw")
+    if args.rollout and args.sessions < 2:
+        # Every wave would be capped at one device
+        parser.error("--rollout needs -s 2 or more")
+    if args.plan:
+        if args.devices < 1 or args.dongles < 1:
+            parser.error("--devices and --dongles must be at least 1")
+        try:
+            image_size = os.path.getsize(args.fw) + CHECKSUM_SIZE
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+        planner = TransferPlanner(
+            args.conn_interval / 1000.0,
+            args.baud,
+            args.at_latency / 1000.0,
+            args.pipeline_window if args.pipeline else 1,
+        )
+        if args.calibrate:
+            history = UpdateHistory(args.history)
+            used = planner.calibrate(history.query(transport=args.transport))
+            history.close()
+            if used:
+                print(
+                    "Calibrated with %d sessions: transfer x%.2f, %.1fs per device besides the transfer.\n"
+                    % (used, planner.transfer_scale, planner.overhead)
+                )
+            else:
+                print("No sessions in the history to calibrate with.\n")
+        print("Image: %s (%d bytes)\n" % (args.fw, image_size))
+        print_plan(
+            planner,
+            image_size,
+            [int(mtu) for mtu in args.mtu.split(",")],
+            args.pd_char_size,
+            args.devices,
+            args.dongles,
+        )
+        sys.exit(0)
+    if not args.no_history:
+        history = UpdateHistory(args.history)
+
+    if args.json == "-":
+        events = EventStream(sys.stdout, args.progress_step)
+        sys.stdout = sys.stderr
+    elif args.json:
+        events = EventStream(open(args.json, "a"), args.progress_step, close_out=True)
+
+    if args.trace:
+        tracer = Tracer(args.trace)
+
+    suota_firmware_name = args.fw
+    if args.debug:
+        debug_msg = True
+
+    continuous = args.continuous
+    min_rate = args.min_rate
+    timeouts.enabled = not args.fixed_timeouts
+
+    try:
+        f = open(suota_firmware_name, "rb")
+        patch_data = f.read()
+        patch_length = len(patch_data)
+        if patch_length > patch_data_len:
+            print("Firmare file is too big.")
+            f.close
+            sys.exit(1)
+        f.close
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+
+    check = checksum(patch_data, patch_length)
+
+    image_hash = hashlib.sha256(patch_data).hexdigest()
+    new_version = args.expect_version or image_version(patch_data)
+
+    patch_data += bytes([check])
+    patch_length += 1
+
+    handler = updater_events = UpdaterEvents()
+    if args.faults:
+        if args.faults == "all":
+            fault_classes = FAULT_CLASSES
+        else:
+            fault_classes = [f.strip() for f in args.faults.split(",")]
+            for fault in fault_classes:
+                if fault not in FAULT_CLASSES:
+                    parser.error("unknown fault class: " + fault)
+        fault_injector = FaultInjector(
+            fault_classes, args.fault_rate, args.fault_seed, args.fault_delay
+        )
+        wrapper = FaultInjectingTransport(handler, fault_injector)
+        transport = wrapper.wrap(open_transport(args, wrapper, new_version))
+    else:
+        transport = open_transport(args, handler, new_version)
+    scan_transport = open_scan_transport(args, handler)
+
+    if not args.no_inventory:
+        inventory = DeviceInventory(args.inventory, args.inventory_ttl * 24 * 3600)
+        inventory.target_version = new_version
+        inventory.target_image = image_hash
+
+    if args.verify:
+        try:
+            verifier = PostRebootVerifier(
+                lambda handler: open_verify_transport(args, handler),
+                new_version,
+            )
+        except Exception as e:
+            print(
+                f"{bcolors.WARNING}Post-reboot verification disabled: {e}{bcolors.ENDC}"
+            )
+
+    print(
+        f"\n-BleuIO_SUOTA_SSD00X_Updater.py\n-Version: {bcolors.OKCYAN}{fw_version}{bcolors.ENDC}"
+    )
+    print(f"-Created: {bcolors.OKCYAN}{created}\r\n{bcolors.ENDC}")
+    print(
+        "-=:Welcome to Smart Sensor Devices Script for Updating the BleuIO Dongle Firmware (SUOTA):=-\r\n"
+    )
+    print_dbg_msg("File size: %d bytes" % (patch_length))
+
+    emit_event(
+        "start",
+        image=os.path.basename(suota_firmware_name),
+        size=patch_length,
+        sha256=image_hash,
+        version=new_version,
+        transport=transport.name,
+        port=transport.port,
+    )
+
+    # Init
+    transport.start()
+    if scan_transport is not None:
+        scan_transport.start()
+
+    record_fields = dict(
+        site=args.site,
+        port=transport.port,
+        transport=transport.name,
+        new_version=new_version,
+        image_name=os.path.basename(suota_firmware_name),
+        image_hash=image_hash,
+        image_size=patch_length,
+    )
+    update_done = False
+    if args.sessions > 1 or args.rollout:
+        if args.dashboard:
+            dashboard = Dashboard(args.dashboard_fps)
+        rollout = None
+        if args.rollout:
+            rollout = RolloutController(
+                args.canary, args.wave_growth, args.sessions, args.max_failure_rate
+            )
+        try:
+            run_sessions(
+                args.sessions, patch_data, record_fields, args.gatt_only, rollout
+            )
+        except Exception as e:
             print(e)
         except (KeyboardInterrupt, SystemExit) as d:
             print("Exiting...")
+            if inventory is not None:
+                inventory.save()
+            if events is not None:
+                events.close()
+            if tracer is not None:
+                tracer.save()
+            sys.exit(1)
+        update_done = True
+    while not update_done:
+        print(
+            f"\r\nLooking to update BleuIO Dongle with fw: {suota_firmware_name}\r\n\r\n"
+        )
+        mac_addr = None
+        timeouts.new_session()
+        print_dbg_msg("Timeouts: " + timeouts.summary())
+        record = None
+        if history is not None:
+            record = SessionRecord(concurrency=1, **record_fields)
+        try:
+            try:
+                bleuio_mac = find_BleuIO(BLEUIO_SUOTA_ADV_DATA)
+            except Exception as e:
+                print_dbg_msg(e)
+                fault_detected()
+                if record is not None:
+                    history.insert(record.finish(False, error=e))
+                emit_event("complete", mac=None, success=False, error=str(e))
+                continue
+            session = preconnect_session
+            preconnect_session = None
+            if session is None or not session.mac == bleuio_mac:
+                session = main_session(bleuio_mac, args.gatt_only)
+            session.record = record
+            if record is not None:
+                record.set(
+                    mac=bleuio_mac,
+                    retries=discovery.attempts(bleuio_mac) - 1,
+                    rssi=discovery.rssi(bleuio_mac),
+                )
+            emit_event(
+                "discovered",
+                mac=bleuio_mac,
+                rssi=discovery.rssi(bleuio_mac),
+                attempt=discovery.attempts(bleuio_mac),
+            )
+            print(
+                f"\nConnecting to BleuIO Dongle: {bcolors.OKCYAN} (MAC Addr: {mac_addr}){bcolors.ENDC}\n"
+            )
+            start_background_scan()
+            session.run()
+            updater_events.session = None
+            if session.success:
+                next_session = preconnect_next_device(args.gatt_only)
+                print(f"{bcolors.OKGREEN}BleuIO Updated Successfully!{bcolors.ENDC}\n")
+                # Update done
+                if continuous:
+                    answer = "y"
+                else:
+                    answer = input("Update another BleuIO Dongle? (y/n)\n>>")
+                answer = answer.lower()
+                if not answer[0] == "y":
+                    update_done = True
+                    if next_session is not None:
+                        transport.cancel_connect()
+                        transport.disconnect()
+            elif not session.supported:
+                # Update not possible
+                answer = input("Do you want to try again? (y/n)\n>>")
+                answer = answer.lower()
+                if not answer[0] == "y":
+                    update_done = True
+        except (KeyboardInterrupt, SystemExit) as d:
+            print("Exiting...")
+            if inventory is not None:
+                inventory.save()
+            if events is not None:
+                events.close()
+            if tracer is not None:
+                tracer.save()
             sys.exit(1)
-        pass
 
+    stop_background_scan()
+    if verifier is not None:
+        print("Waiting for post-reboot verification...")
+        verifier.wait(VERIFY_TIMEOUT * max(1, verifier.summary()[2]))
+        passed, failed, pending = verifier.summary()
+        print(
+            "Verification: %d passed, %d failed, %d not verified."
+            % (passed, failed, pending)
+        )
+    if fault_injector is not None:
+        fault_injector.print_report()
+    if history is not None:
+        history.close()
+    if inventory is not None:
+        inventory.save()
+    if tracer is not None:
+        tracer.save()
+    if events is not None:
+        emit_event("done")
+        events.close()
+        if events.dropped:
+            print("%d events were dropped." % (events.dropped))
     print("Script done. Shutting down...")
     sys.exit(1)
 
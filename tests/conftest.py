@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BleuIO_SUOTA_Updater as updater  # noqa: E402
+
+
+@pytest.fixture
+def sim_image():
+    """Returns a builder of images with a DA1468x header carrying a version and their checksum byte."""
+
+    def build(version, size=5000):
+        header = b"pP" + bytes(10) + version.encode("ascii").ljust(16, b"\x00")
+        data = header + bytes((i * 7) & 0xFF for i in range(size - len(header)))
+        return data + bytes([updater.checksum(data, len(data))])
+
+    return build
+
+
+@pytest.fixture
+def quiet(monkeypatch):
+    """Runs the updater with no history, inventory, events or faults and an empty discovery queue."""
+    for name in (
+        "history",
+        "inventory",
+        "verifier",
+        "events",
+        "tracer",
+        "fault_injector",
+    ):
+        monkeypatch.setattr(updater, name, None)
+    monkeypatch.setattr(updater, "discovery", updater.DiscoveryQueue())
+    monkeypatch.setattr(updater, "bleuio_found", False)
+
+
+@pytest.fixture
+def sim(monkeypatch, quiet):
+    """Points the updater at a SimTransport, wrapped in a FaultInjectingTransport if given an injector."""
+    transports = []
+
+    def open_sim(*peers, injector=None):
+        if injector is None:
+            transport = updater.SimTransport(updater.UpdaterEvents(), list(peers))
+        else:
+            wrapper = updater.FaultInjectingTransport(updater.UpdaterEvents(), injector)
+            transport = wrapper.wrap(updater.SimTransport(wrapper, list(peers)))
+            monkeypatch.setattr(updater, "fault_injector", injector)
+        monkeypatch.setattr(updater, "transport", transport)
+        transports.append(transport)
+        return transport
+
+    yield open_sim
+    for transport in transports:
+        transport.close()
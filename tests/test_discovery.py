@@ -0,0 +1,122 @@
+import pytest
+
+import BleuIO_SUOTA_Updater as updater
+
+
+@pytest.fixture
+def queue(quiet):
+    return updater.DiscoveryQueue()
+
+
+def pop_all(queue):
+    macs = []
+    while True:
+        mac = queue.pop()
+        if mac is None:
+            return macs
+        macs.append(mac)
+
+
+def test_strongest_signal_first(queue):
+    queue.add("aa", -80)
+    queue.add("BB", -40)
+    queue.add("CC")
+    queue.add("DD", -60)
+    # Stronger than DD but in the same RSSI step, found later
+    queue.add("EE", -59)
+    assert len(queue) == 5
+    assert queue.rssi("aa") == -80
+    assert pop_all(queue) == ["BB", "DD", "EE", "AA", "CC"]
+
+
+def test_rssi_is_updated(queue):
+    assert queue.add("AA", -80)
+    assert queue.add("BB", -70)
+    assert queue.add("AA", -50)
+    assert len(queue) == 2
+    assert pop_all(queue) == ["AA", "BB"]
+
+
+def test_throughput_within_a_step(queue, monkeypatch, tmp_path):
+    history = updater.UpdateHistory(str(tmp_path / "history.db"))
+    monkeypatch.setattr(updater, "history", history)
+    try:
+        history.insert({"mac": "BB", "started": 1.0, "success": 1, "throughput": 900.0})
+        history.insert(
+            {"mac": "CC", "started": 1.0, "success": 1, "throughput": 1800.0}
+        )
+        queue.add("AA", -61)
+        queue.add("BB", -62)
+        queue.add("CC", -63)
+        # A step stronger beats any throughput
+        queue.add("DD", -50)
+        assert pop_all(queue) == ["DD", "CC", "BB", "AA"]
+    finally:
+        history.close()
+
+
+def test_stale_devices_first(queue, monkeypatch, tmp_path):
+    inventory = updater.DeviceInventory(str(tmp_path / "inventory.json"))
+    inventory.target_version = "2.0.0"
+    inventory.set_version("AA", "2.0.0")
+    inventory.set_version("BB", "1.0.0")
+    monkeypatch.setattr(updater, "inventory", inventory)
+    queue.add("AA", -40)
+    queue.add("BB", -80)
+    queue.add("CC", -70)
+    assert pop_all(queue) == ["CC", "BB", "AA"]
+
+
+def test_deferred_devices_last(queue):
+    queue.add("AA", -40)
+    queue.start(queue.pop())
+    # Nobody else waiting
+    assert not queue.defer("AA")
+
+    queue.add("BB", -80)
+    queue.add("CC", -90)
+    assert queue.defer("AA")
+    assert queue.active() == 0
+    assert queue.current is None
+    # Deferring isn't a failed attempt
+    assert queue.attempts("AA") == 0
+    assert pop_all(queue) == ["BB", "CC", "AA"]
+
+    queue.start("AA")
+    queue.add("DD", -90)
+    # Only once
+    assert not queue.defer("AA")
+
+
+def test_retries_and_updated(queue):
+    for attempt in range(updater.RETRIES_NUMBER):
+        assert queue.add("AA", -40)
+        queue.start(queue.pop())
+        # Not queued again while it is updated
+        assert not queue.add("AA", -40)
+        assert queue.active() == 1
+        queue.finish(False)
+        assert queue.active() == 0
+    assert queue.attempts("aa") == updater.RETRIES_NUMBER
+    assert not queue.add("AA", -40)
+
+    queue.add("BB", -40)
+    queue.start("BB")
+    assert len(queue) == 0
+    queue.finish(True, "bb")
+    assert not queue.add("BB", -40)
+    assert queue.pop() is None
+
+
+def test_advert_queues_the_device(sim):
+    peers = [
+        updater.SimSuotaPeer("00:00:00:00:00:01", rssi=-70),
+        updater.SimSuotaPeer("00:00:00:00:00:02", rssi=-45),
+    ]
+    transport = sim(*peers)
+    transport.scan(updater.BLEUIO_SUOTA_ADV_DATA)
+    transport.close()
+    transport._event_thread.join(2)
+
+    assert updater.discovery.pop() == "00:00:00:00:00:02"
+    assert updater.discovery.pop() == "00:00:00:00:00:01"
@@ -0,0 +1,95 @@
+import io
+import json
+import threading
+
+import BleuIO_SUOTA_Updater as updater
+
+
+def records(out):
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_json_lines():
+    out = io.StringIO()
+    stream = updater.EventStream(out)
+    stream.emit("discovered", mac="AA", rssi=-50, attempt=1)
+    stream.emit("status", mac="AA", status=0x10, name="IMG_STARTED")
+    stream.close()
+
+    first, second = records(out)
+    assert set(first) == {"ts", "event", "mac", "rssi", "attempt"}
+    assert first["event"] == "discovered" and first["rssi"] == -50
+    assert second["event"] == "status" and second["status"] == 0x10
+    assert first["ts"] <= second["ts"]
+    assert not out.closed
+
+
+def test_progress_steps():
+    out = io.StringIO()
+    stream = updater.EventStream(out, progress_step=10)
+    for percent in (0.5, 5, 9.9, 12, 19, 25, 100):
+        stream.progress("AA", percent, rate=1000.0)
+    stream.progress("BB", 5)
+    stream.close()
+
+    sent = [(r["mac"], r["percent"]) for r in records(out)]
+    assert sent == [("AA", 0.5), ("AA", 12), ("AA", 25), ("AA", 100), ("BB", 5)]
+    assert all(r["event"] == "progress" for r in records(out))
+
+
+def test_close_out(tmp_path):
+    path = tmp_path / "events.jsonl"
+    out = open(path, "w")
+    stream = updater.EventStream(out, close_out=True)
+    stream.emit("wave", wave=1, size=2, finished=0)
+    stream.close()
+    assert out.closed
+    assert json.loads(path.read_text())["event"] == "wave"
+
+
+class BlockingOut(io.StringIO):
+    def __init__(self):
+        io.StringIO.__init__(self)
+        self.release = threading.Event()
+
+    def write(self, data):
+        self.release.wait(5)
+        return io.StringIO.write(self, data)
+
+
+def test_full_queue_drops(monkeypatch):
+    monkeypatch.setattr(updater, "EVENT_QUEUE_SIZE", 2)
+    out = BlockingOut()
+    stream = updater.EventStream(out)
+    for i in range(20):
+        stream.emit("progress", mac="AA", percent=i)
+    # Never more than the queue and the batch being written
+    assert stream.dropped >= 20 - 3
+    out.release.set()
+    stream.close()
+    assert len(records(out)) == 20 - stream.dropped
+
+
+def test_session_events(sim, sim_image, monkeypatch):
+    image = sim_image("3.1.4")
+    peer = updater.SimSuotaPeer("00:00:00:00:00:01", new_fw_version="3.1.4")
+    sim(peer)
+    out = io.StringIO()
+    monkeypatch.setattr(updater, "events", updater.EventStream(out))
+    session = updater.SuotaSession(peer.mac, image)
+    session.run()
+    updater.events.close()
+
+    sent = records(out)
+    statuses = [r["name"] for r in sent if r["event"] == "status"]
+    assert statuses == [
+        updater.error_list[updater.SUOTA_STATUS_IMG_STARTED],
+        updater.error_list[updater.SUOTA_STATUS_CMP_OK],
+    ]
+    progress = [r["percent"] for r in sent if r["event"] == "progress"]
+    assert progress == sorted(progress) and progress[-1] == 100
+    complete = sent[-1]
+    assert complete["event"] == "complete"
+    assert complete["mac"] == peer.mac and complete["success"] is True
+    assert complete["status"] == updater.SUOTA_STATUS_CMP_OK
+    assert complete["error"] == ""
@@ -0,0 +1,107 @@
+import BleuIO_SUOTA_Updater as updater
+
+MAC = "00:00:00:00:00:01"
+
+
+def draws(injector, count=200):
+    candidates = [
+        ["drop_read"],
+        ["ack_error", "disconnect"],
+        ["drop_notification", "delay_notification", "corrupt_notification"],
+    ]
+    return [injector.draw(candidates[i % 3], MAC) for i in range(count)]
+
+
+def test_schedule_depends_on_seed():
+    first = draws(updater.FaultInjector(updater.FAULT_CLASSES, 0.3, seed=7))
+    assert first == draws(updater.FaultInjector(updater.FAULT_CLASSES, 0.3, seed=7))
+    assert first != draws(updater.FaultInjector(updater.FAULT_CLASSES, 0.3, seed=8))
+    assert any(first) and not all(first)
+
+    # Only the enabled classes are injected
+    injector = updater.FaultInjector(["disconnect"], 1.0)
+    assert set(draws(injector)) == {None, "disconnect"}
+    assert updater.FaultInjector(updater.FAULT_CLASSES, 0.0).draw(["drop_read"]) is None
+
+
+def test_report_and_lost():
+    injector = updater.FaultInjector(["drop_read", "ack_error"], 1.0)
+    injector.draw(["drop_read"], MAC)
+    injector.draw(["ack_error"], "00:00:00:00:00:02")
+    injector.detected(MAC)
+    injector.recovered(MAC)
+    injector.draw(["drop_read"], MAC)
+    injector.lost()
+
+    report = injector.report()
+    assert report["drop_read"][:2] == (2, 1)
+    assert report["drop_read"][4] is not None
+    assert report["drop_read"][6] == 1
+    assert report["ack_error"] == (1, 0, None, None, None, None, 1)
+
+
+def run_session(image):
+    session = updater.SuotaSession(MAC, image)
+    session.run()
+    return session
+
+
+def test_ack_error_recovered_by_retry(sim, sim_image):
+    image = sim_image("3.1.4")
+    injector = updater.FaultInjector(["ack_error"], 1.0)
+    peer = updater.SimSuotaPeer(MAC, new_fw_version="3.1.4")
+    sim(peer, injector=injector)
+
+    failed = run_session(image)
+    assert not failed.success
+    assert failed.error == "Write command error: 01"
+    count, detected, ttd_mean, ttd_max, ttr_mean, ttr_max, lost = injector.report()[
+        "ack_error"
+    ]
+    assert (count, detected, ttr_mean, lost) == (1, 1, None, 0)
+
+    injector.rate = 0.0
+    retry = run_session(image)
+    assert retry.success, retry.error
+    assert peer.fw_version == "3.1.4"
+    count, detected, ttd_mean, ttd_max, ttr_mean, ttr_max, lost = injector.report()[
+        "ack_error"
+    ]
+    assert (count, detected, lost) == (1, 1, 0)
+    assert ttd_max <= ttr_mean
+
+
+def test_disconnect_detected_from_the_event(sim, sim_image):
+    injector = updater.FaultInjector(["disconnect"], 1.0)
+    peer = updater.SimSuotaPeer(MAC)
+    sim(peer, injector=injector)
+    # The last attempt of the device, its faults are lost when it fails
+    for attempt in range(updater.RETRIES_NUMBER):
+        updater.discovery.start(MAC)
+
+    session = run_session(sim_image("3.1.4"))
+    assert not session.success
+    assert session.error == "Disconnected!"
+    assert not peer.connected
+    count, detected, ttd_mean, ttd_max, ttr_mean, ttr_max, lost = injector.report()[
+        "disconnect"
+    ]
+    assert (count, detected, ttr_mean, lost) == (1, 1, None, 1)
+    # Not a timeout: the session wakes up on the disconnect event
+    assert ttd_max < 1
+
+
+def test_delayed_notifications(sim, sim_image):
+    image = sim_image("3.1.4")
+    injector = updater.FaultInjector(["delay_notification"], 0.5, seed=1, delay=0.05)
+    peer = updater.SimSuotaPeer(MAC, new_fw_version="3.1.4")
+    sim(peer, injector=injector)
+
+    session = run_session(image)
+    assert session.success, session.error
+    assert bytes(peer.image) == image
+    count, detected, ttd_mean, ttd_max, ttr_mean, ttr_max, lost = injector.report()[
+        "delay_notification"
+    ]
+    assert count > 0 and detected == 0 and lost == 0
+    assert ttr_mean is not None
@@ -0,0 +1,126 @@
+import pytest
+
+import BleuIO_SUOTA_Updater as updater
+
+
+def test_percentile():
+    assert updater.percentile([], 50) is None
+    assert updater.percentile([7], 99) == 7
+    assert updater.percentile([4, 1, 3, 2], 50) == 2.5
+    assert updater.percentile([1, 2, 3, 4, 5], 90) == pytest.approx(4.6)
+    assert updater.percentile([1, 2, 3], 100) == 3
+
+
+def finished_row(success=True, status=updater.SUOTA_STATUS_CMP_OK, **fields):
+    record = updater.SessionRecord(**fields)
+    record.fields["started"] = 100.0
+    record.marks = {
+        "scan": 100.0,
+        "connect": 101.0,
+        "handshake": 103.0,
+        "transfer": 104.0,
+        "end": 114.0,
+        "done": 115.0,
+    }
+    return record.finish(success, status, "" if success else "failed")
+
+
+def test_session_record():
+    row = finished_row(mac="00:00:00:00:00:01", image_size=20000)
+    assert row["scan_s"] == 1.0
+    assert row["connect_s"] == 2.0
+    assert row["handshake_s"] == 1.0
+    assert row["transfer_s"] == 10.0
+    assert row["end_s"] == 1.0
+    assert row["total_s"] == 15.0
+    assert row["throughput"] == 2000.0
+    assert row["status_name"] == updater.error_list[updater.SUOTA_STATUS_CMP_OK]
+    assert (row["success"], row["error"]) == (1, "")
+
+    # A session that failed during the handshake
+    record = updater.SessionRecord(image_size=20000)
+    record.mark("connect")
+    row = record.finish(False, None, Exception("Cannot read MTU!"))
+    assert "connect_s" not in row and "transfer_s" not in row
+    assert "throughput" not in row and "status_name" not in row
+    assert (row["success"], row["error"]) == (0, "Cannot read MTU!")
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = updater.UpdateHistory(str(tmp_path / "history.db"))
+    yield history
+    history.close()
+
+
+def add(history, mac, started, success=True, throughput=1000.0, **fields):
+    row = {
+        "mac": mac,
+        "started": started,
+        "success": 1 if success else 0,
+        "throughput": throughput,
+        "total_s": 20000 / throughput + 5,
+    }
+    row.update(fields)
+    history.insert(row)
+
+
+def test_query(history):
+    add(history, "AA", 1.0, site="lab")
+    add(history, "BB", 2.0, site="line")
+    add(history, "AA", 3.0, success=False, site="line")
+
+    assert [r["started"] for r in history.query()] == [3.0, 2.0, 1.0]
+    assert [r["started"] for r in history.query(mac="AA")] == [3.0, 1.0]
+    assert [r["mac"] for r in history.query(since=2.0, site="line")] == ["AA", "BB"]
+    assert history.query(mac="CC") == []
+    with pytest.raises(Exception, match="Unknown history column: nope"):
+        history.query(nope=1)
+
+    history.set_verified("AA", True, "2.0.0")
+    newest, oldest = history.query(mac="AA")
+    assert (newest["verified"], newest["verified_version"]) == (1, "2.0.0")
+    assert oldest["verified"] is None
+
+
+def test_throughput_of_successful_updates(history):
+    assert history.throughput("AA") is None
+    for started, throughput in enumerate([1000.0, 3000.0, 2000.0]):
+        add(history, "AA", started, throughput=throughput)
+    add(history, "AA", 9.0, success=False, throughput=9000.0)
+    assert history.throughput("aa") == 2000.0
+
+
+def test_report(history):
+    for started, throughput in enumerate([1000.0, 2000.0, 4000.0]):
+        add(history, "AA", started, throughput=throughput, new_version="2.0.0")
+    add(history, "BB", 5.0, success=False, new_version="2.0.0")
+    add(history, "BB", 6.0, throughput=500.0, new_version="1.9.0")
+
+    rows = history.report("mac")
+    assert [r[:3] for r in rows] == [("AA", 3, 1.0), ("BB", 2, 0.5)]
+    assert rows[0][4] == [2000.0, pytest.approx(3600.0), pytest.approx(3960.0)]
+    assert rows[1][3] == [45.0, 45.0, 45.0]
+    firmware = history.report("firmware", since=5.0)
+    assert [r[:3] for r in firmware] == [("1.9.0", 1, 1.0), ("2.0.0", 1, 0.0)]
+    assert firmware[1][4] == [None, None, None]
+
+
+def test_reopen_keeps_the_sessions(tmp_path):
+    path = str(tmp_path / "history.db")
+    history = updater.UpdateHistory(path)
+    history.insert(finished_row(mac="AA", image_size=20000))
+    history.close()
+    # Closed, the late writes of a session are ignored
+    history.insert(finished_row(mac="BB"))
+
+    history = updater.UpdateHistory(path)
+    try:
+        (row,) = history.query()
+        assert (row["mac"], row["transfer_s"], row["throughput"]) == (
+            "AA",
+            10.0,
+            2000.0,
+        )
+    finally:
+        history.close()
@@ -0,0 +1,118 @@
+import json
+import time
+
+import pytest
+
+import BleuIO_SUOTA_Updater as updater
+
+
+@pytest.fixture
+def path(tmp_path, quiet):
+    return str(tmp_path / "inventory.json")
+
+
+def test_seen_and_result(path):
+    inventory = updater.DeviceInventory(path)
+    inventory.target_image = "abc"
+    inventory.target_version = "2.0.0"
+    inventory.seen("aa", True, -50)
+    inventory.set_version("AA", "1.0.0")
+    inventory.set_version("AA", None)
+    entry = inventory.devices["AA"]
+    assert entry["suota_mode"] and entry["rssi"] == -50
+    assert entry["version"] == "1.0.0"
+    assert inventory.stale("AA")
+
+    inventory.result("AA", False, updater.SUOTA_STATUS_CRC_ERR)
+    assert entry["result"] == updater.error_list[updater.SUOTA_STATUS_CRC_ERR]
+    inventory.result("AA", False, None, "Disconnected!")
+    assert entry["result"] == "Disconnected!"
+    assert not inventory.up_to_date("AA")
+
+    inventory.result("AA", True, updater.SUOTA_STATUS_CMP_OK)
+    assert (entry["result"], entry["image"], entry["version"]) == ("ok", "abc", "2.0.0")
+    assert not inventory.stale("aa")
+
+
+def test_up_to_date(path, capsys, monkeypatch):
+    inventory = updater.DeviceInventory(path)
+    inventory.target_image = "abc"
+    inventory.result("AA", True)
+    sent = []
+    monkeypatch.setattr(updater, "emit_event", lambda e, **f: sent.append((e, f)))
+
+    assert inventory.up_to_date("aa")
+    # Printed once per run
+    assert inventory.up_to_date("AA")
+    assert capsys.readouterr().out.count("Skipping AA") == 1
+    assert sent == [("skipped", {"mac": "AA", "version": None})]
+
+    inventory.target_image = "def"
+    assert not inventory.up_to_date("AA")
+    assert not inventory.up_to_date("BB")
+
+    inventory.target_image = "abc"
+    inventory.verified("AA", False, "1.0.0")
+    assert not inventory.up_to_date("AA")
+    assert inventory.devices["AA"]["version"] == "1.0.0"
+
+
+def test_save_and_load(path):
+    inventory = updater.DeviceInventory(path)
+    inventory.target_image = "abc"
+    inventory.seen("AA", False)
+    inventory.result("BB", True)
+    inventory.save()
+
+    with open(path) as f:
+        assert set(json.load(f)) == {"AA", "BB"}
+    loaded = updater.DeviceInventory(path)
+    assert loaded.devices == inventory.devices
+    assert loaded.target_image is None
+
+
+def test_ttl(path):
+    inventory = updater.DeviceInventory(path, ttl=3600)
+    inventory.seen("AA", True)
+    inventory.seen("BB", True)
+    inventory.devices["AA"]["last_seen"] = time.time() - 7200
+    inventory.save()
+    assert set(inventory.devices) == {"BB"}
+
+    with open(path, "w") as f:
+        json.dump({"CC": {"last_seen": time.time() - 7200}}, f)
+    assert updater.DeviceInventory(path, ttl=3600).devices == {}
+    assert set(updater.DeviceInventory(path, ttl=10000).devices) == {"CC"}
+
+
+def test_unreadable_file(path, capsys):
+    with open(path, "w") as f:
+        f.write("{not json")
+    inventory = updater.DeviceInventory(path)
+    assert inventory.devices == {}
+    assert "Cannot read the inventory" in capsys.readouterr().out
+
+
+def test_session_results(sim, sim_image, path, monkeypatch):
+    image = sim_image("3.1.4")
+    inventory = updater.DeviceInventory(path)
+    inventory.target_image = "abc"
+    inventory.target_version = updater.image_version(image)
+    monkeypatch.setattr(updater, "inventory", inventory)
+    good = updater.SimSuotaPeer("00:00:00:00:00:01", new_fw_version="3.1.4")
+    bad = updater.SimSuotaPeer("00:00:00:00:00:02", crc_error=True)
+    transport = sim(good, bad)
+    transport.scan(updater.BLEUIO_SUOTA_ADV_DATA)
+    transport.close()
+    transport._event_thread.join(2)
+    for peer in (good, bad):
+        updater.SuotaSession(peer.mac, image).run()
+
+    devices = updater.DeviceInventory(path).devices
+    assert devices[good.mac]["result"] == "ok"
+    assert devices[good.mac]["version"] == "3.1.4"
+    assert (
+        devices[bad.mac]["result"] == updater.error_list[updater.SUOTA_STATUS_CRC_ERR]
+    )
+    assert devices[bad.mac]["suota_mode"]
+    assert not inventory.stale(good.mac) and inventory.stale(bad.mac)
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import BleuIO_SUOTA_Updater as updater
+
+
+class FakeSerial:
+    """Answers each AT command with the Echo, Ack and End lines of the dongle."""
+
+    def __init__(self, errors=(), events=()):
+        self.errors = errors
+        self.events = events
+        self.writes = []
+        self.commands = []
+        self._buffer = b""
+        self._lock = threading.Lock()
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def read(self, size):
+        time.sleep(0.001)
+        with self._lock:
+            data = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+        return data
+
+    def write(self, data):
+        cmds = [cmd for cmd in data.split(b"\r") if cmd]
+        self.writes.append(len(cmds))
+        with self._lock:
+            for cmd in cmds:
+                self.commands.append(cmd.decode())
+                n = len(self.commands)
+                err = 1 if n in self.errors else 0
+                self._buffer += b'{"C":%d,"cmd":"%s"}\r\n' % (n, cmd)
+                self._buffer += b'{"A":%d,"err":%d,"errMsg":"x"}\r\n' % (n, err)
+                if n in self.events:
+                    self._buffer += b'{"SE":%d,"evt":{"action":"x"}}\r\n' % (n)
+                self._buffer += b'{"E":%d,"nol":3}\r\n' % (n)
+        return len(data)
+
+
+class FakeDongle:
+    def __init__(self, serial):
+        self._serial = serial
+        self.rx_buffer = b""
+        self.reader_running = True
+
+    def _stop_reader(self):
+        self.reader_running = False
+
+    def _start_reader(self):
+        self.reader_running = True
+
+
+def test_pipeline_matches_acks_in_order():
+    serial = FakeSerial(errors=(3, 7), events=(5,))
+    dongle = FakeDongle(serial)
+    evts = []
+    pipeline = updater.AtPipeline(dongle, evts.append, window=4)
+    pipeline.start()
+    assert not dongle.reader_running
+    cmds = ["AT+GATTCWRITEWRB=001A %02X" % (i) for i in range(10)]
+    indexes = [pipeline.submit(cmd) for cmd in cmds]
+
+    assert indexes == list(range(1, 11))
+    assert pipeline.flush() == [(3, cmds[2], 1), (7, cmds[6], 1)]
+    assert serial.commands == cmds
+    assert len(evts) == 1 and '"SE":5' in evts[0][0]
+    assert pipeline.commands_per_second() > 0
+    # The errors were returned by the flush
+    assert pipeline.flush() == []
+    pipeline.stop()
+    assert dongle.reader_running
+
+
+def test_pipeline_refills_in_batches():
+    serial = FakeSerial()
+    pipeline = updater.AtPipeline(FakeDongle(serial), lambda lines: None, window=4)
+    pipeline.start()
+    for i in range(20):
+        pipeline.submit("AT+GATTCWRITEWRB=001A %02X" % (i))
+    pipeline.stop()
+
+    assert sum(serial.writes) == 20
+    assert serial.writes[0] == 4
+    # Every write but the one of the final flush waits for half the window
+    assert all(n >= pipeline.refill for n in serial.writes[:-1])
+    assert len(serial.writes) <= 1 + 16 // pipeline.refill + 1
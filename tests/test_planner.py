@@ -0,0 +1,78 @@
+import pytest
+
+import BleuIO_SUOTA_Updater as updater
+
+
+def test_plan_counts():
+    planner = updater.TransferPlanner()
+    plan = planner.plan(20001, 247, 244)
+    chunk_size, block_size = updater.suota_geometry(247, 244)
+    counts = updater.transfer_counts(20001, chunk_size, block_size)
+
+    assert (plan["chunk_size"], plan["block_size"]) == (chunk_size, block_size)
+    for key, value in counts.items():
+        assert plan[key] == value
+    assert plan["at_commands"] == (
+        counts["chunk_writes"] + counts["patch_len_writes"] + 12
+    )
+    assert plan["transfer_s"] == planner.transfer_time(20001, chunk_size, block_size)
+    assert plan["device_s"] == plan["transfer_s"] + planner.device_overhead()
+
+
+def test_bigger_mtu_and_pipeline_are_faster():
+    planner = updater.TransferPlanner()
+    small = planner.plan(100000, 23, 244)
+    big = planner.plan(100000, 512, 244)
+    assert big["at_commands"] < small["at_commands"]
+    assert big["transfer_s"] < small["transfer_s"]
+
+    pipelined = updater.TransferPlanner(pipeline_window=4).plan(100000, 512, 244)
+    assert pipelined["transfer_s"] < big["transfer_s"]
+    assert pipelined["chunk_writes"] == big["chunk_writes"]
+    # Still one chunk per connection event at best
+    assert pipelined["transfer_s"] >= big["chunk_writes"] * updater.PLAN_CONN_INTERVAL
+
+
+def test_device_overhead():
+    planner = updater.TransferPlanner(conn_interval=0.03)
+    gatt = planner.at_command(updater.AT_WRITE_CMD_BYTES + 8) + 2 * 0.03
+    assert planner.device_overhead() == pytest.approx(
+        updater.FIND_POLL_INTERVAL / 2 + 8 * 0.03 + 8 * gatt
+    )
+    # Well below the fixed scan wait of the single-device updater
+    assert planner.device_overhead() < 1
+
+
+def session(transfer_s, total_s, success=1, concurrency=1):
+    return {
+        "success": success,
+        "image_size": 20001,
+        "chunk_size": 244,
+        "block_size": 244,
+        "transfer_s": transfer_s,
+        "total_s": total_s,
+        "concurrency": concurrency,
+    }
+
+
+def test_calibrate():
+    planner = updater.TransferPlanner()
+    predicted = planner.transfer_time(20001, 244, 244)
+    sessions = [
+        session(2 * predicted, 2 * predicted + 4.0),
+        session(3 * predicted, 3 * predicted + 6.0),
+        session(4 * predicted, 4 * predicted + 5.0),
+        # Not used: failed, or shared the link with other sessions
+        session(100 * predicted, 200.0, success=0),
+        session(100 * predicted, 200.0, concurrency=4),
+    ]
+    assert planner.calibrate(sessions) == 3
+    assert planner.transfer_scale == pytest.approx(3.0)
+    assert planner.device_overhead() == pytest.approx(5.0)
+    assert planner.transfer_time(20001, 244, 244) == pytest.approx(3 * predicted)
+    plan = planner.plan(20001, 247, 244)
+    assert plan["device_s"] == pytest.approx(plan["transfer_s"] + 5.0)
+
+    # Without any usable session the prediction isn't scaled
+    assert planner.calibrate(sessions[3:]) == 0
+    assert planner.transfer_scale == 1.0
@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import pytest
+
+import BleuIO_SUOTA_Updater as updater
+
+CRC_ERR = updater.SUOTA_STATUS_CRC_ERR
+
+
+def ended(rollout, *statuses):
+    for i, status in enumerate(statuses):
+        rollout.session_ended(
+            SimpleNamespace(mac="00:00:00:00:00:%02X" % (i), status=status)
+        )
+
+
+def start(rollout, count):
+    for i in range(count):
+        rollout.session_started(None)
+
+
+def test_waves(quiet):
+    rollout = updater.RolloutController(canary=2, growth=2, cap=5, max_failure_rate=0.5)
+    assert rollout.slots(0, 10) == 2
+    start(rollout, 2)
+    # The next wave waits for the sessions of this one
+    assert rollout.slots(2, 8) == 0
+    assert rollout.slots(1, 8) == 0
+    ended(rollout, updater.SUOTA_STATUS_CMP_OK, updater.SUOTA_STATUS_CMP_OK)
+    assert rollout.slots(0, 8) == 4
+    assert rollout.wave == 2
+    start(rollout, 1)
+    assert rollout.slots(1, 7) == 3
+    start(rollout, 3)
+    ended(rollout, *[updater.SUOTA_STATUS_CMP_OK] * 4)
+    assert rollout.slots(0, 4) == 5
+    assert (rollout.wave, rollout.wave_size) == (3, 5)
+    # Nothing waiting, the wave doesn't start
+    start(rollout, 5)
+    ended(rollout, *[updater.SUOTA_STATUS_CMP_OK] * 5)
+    assert rollout.slots(0, 0) == 0
+    assert rollout.wave == 3
+    assert not rollout.halted
+
+
+@pytest.mark.parametrize("growth,sizes", [(2, [1, 2, 4, 8, 8]), (1, [1, 2, 3, 4, 5])])
+def test_wave_sizes(quiet, growth, sizes):
+    rollout = updater.RolloutController(1, growth, 8, max_failure_rate=0.5)
+    for size in sizes:
+        assert rollout.slots(0, 100) == size
+        start(rollout, size)
+        ended(rollout, *[updater.SUOTA_STATUS_CMP_OK] * size)
+
+
+def test_halts_on_image_failures(quiet, capsys):
+    rollout = updater.RolloutController(canary=2, growth=2, cap=4, max_failure_rate=0.4)
+    rollout.slots(0, 10)
+    start(rollout, 2)
+    ended(rollout, CRC_ERR)
+    # Waits for the whole canary wave
+    assert not rollout.halted
+    ended(rollout, updater.SUOTA_STATUS_CMP_OK)
+    assert rollout.halted
+    assert rollout.slots(0, 10) == 0
+    assert "Rollout halted in wave 1: 1 of 2 sessions" in capsys.readouterr().out
+
+
+def test_other_failures_dont_count(quiet):
+    rollout = updater.RolloutController(canary=2, growth=2, cap=4, max_failure_rate=0.0)
+    rollout.slots(0, 10)
+    start(rollout, 2)
+    # Lost links and devices that were already up to date
+    ended(rollout, None, updater.SUOTA_STATUS_SAME_IMAGE_ERROR)
+    assert not rollout.halted
+    assert rollout.failures == 0
+    assert rollout.slots(0, 10) == 4
+
+
+def test_rollout_halts_sessions(sim, sim_image, monkeypatch):
+    monkeypatch.setattr(updater, "SCHEDULE_WINDOW", 0.1)
+    monkeypatch.setattr(updater, "scan_transport", None)
+    monkeypatch.setattr(updater, "dashboard", None)
+    monkeypatch.setattr(updater, "continuous", False)
+    monkeypatch.setattr(updater, "suota_firmware_name", "fw.img", raising=False)
+    peers = [
+        updater.SimSuotaPeer("00:00:00:00:00:%02X" % (i), crc_error=True, rssi=-40 - i)
+        for i in range(6)
+    ]
+    sim(*peers)
+    rollout = updater.RolloutController(canary=2, growth=2, cap=4, max_failure_rate=0.5)
+    sessions = updater.run_sessions(4, sim_image("3.1.4"), {}, rollout=rollout)
+
+    assert rollout.halted
+    assert [s.mac for s in sessions] == [peers[0].mac, peers[1].mac]
+    assert all(s.status == CRC_ERR for s in sessions)
+    assert not any(peer.rebooted for peer in peers)
@@ -0,0 +1,178 @@
+import queue
+
+import pytest
+
+import BleuIO_SUOTA_Updater as updater
+
+HANDLES = updater.SimTransport.HANDLES
+
+
+class Recorder:
+    """A transport handler that queues every event it gets as (name, args)."""
+
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def __getattr__(self, name):
+        if not name.startswith("on_"):
+            raise AttributeError(name)
+        return lambda *args: self.events.put((name, args))
+
+    def wait(self, name, timeout=2):
+        """Returns the args of the next `name` event, skipping the others."""
+        while True:
+            event, args = self.events.get(timeout=timeout)
+            if event == name:
+                return args
+
+    def names(self, timeout=0.2):
+        names = []
+        while True:
+            try:
+                names.append(self.events.get(timeout=timeout)[0])
+            except queue.Empty:
+                return names
+
+
+@pytest.fixture
+def link():
+    transports = []
+
+    def open_link(*peers, latency=0.0):
+        recorder = Recorder()
+        transport = updater.SimTransport(recorder, list(peers), latency)
+        transports.append(transport)
+        return transport, recorder
+
+    yield open_link
+    for transport in transports:
+        transport.close()
+
+
+def test_scan_reports_advertisers(link):
+    suota = updater.SimSuotaPeer("00:00:00:00:00:01", rssi=-60)
+    app = updater.SimSuotaPeer("00:00:00:00:00:02")
+    app.suota_mode = False
+    transport, recorder = link(suota, app)
+
+    transport.scan(updater.BLEUIO_SUOTA_ADV_DATA)
+    assert recorder.wait("on_adv") == (suota.mac, suota.adv_data(), -60)
+    assert recorder.names() == []
+
+    # Connected devices don't advertise
+    transport.connect(suota.mac)
+    recorder.wait("on_connected")
+    transport.scan(updater.BLEUIO_ADV_DATA)
+    assert recorder.wait("on_adv")[0] == app.mac
+    assert recorder.names() == []
+
+
+def test_browse_and_read(link):
+    peer = updater.SimSuotaPeer("00:00:00:00:00:01", mtu=247, pd_char_size=128)
+    transport, recorder = link(peer)
+
+    # Nothing to read before the connection
+    transport.read(HANDLES[updater.SUOTA_MTU_UUID])
+    assert transport.write(HANDLES[updater.SUOTA_MEM_DEV_UUID], b"\x00") == 1
+    transport.connect(peer.mac.lower())
+    recorder.wait("on_connected")
+    assert transport.is_connected() and peer.connected
+
+    transport.browse()
+    assert recorder.wait("on_service") == (updater.SUOTA_SERVICE_UUID,)
+    found = {}
+    while True:
+        event, args = recorder.events.get(timeout=2)
+        if event == "on_browse_complete":
+            break
+        found[args[0]] = args[1]
+    assert updater.SUOTA_L2CAP_PSM_UUID not in found
+    assert found[updater.SUOTA_MTU_UUID] == HANDLES[updater.SUOTA_MTU_UUID]
+
+    transport.read(HANDLES[updater.SUOTA_MTU_UUID])
+    handle, data = recorder.wait("on_read")
+    assert updater.read_value(updater.SUOTA_MTU_UUID, data) == "247"
+    transport.read(HANDLES[updater.SUOTA_PD_CHAR_SIZE_UUID])
+    assert recorder.wait("on_read")[1] == (128).to_bytes(2, "little")
+
+    transport.disconnect()
+    recorder.wait("on_disconnected")
+    assert not transport.is_connected() and not peer.connected
+
+
+def test_notifications_need_subscribe(link):
+    peer = updater.SimSuotaPeer("00:00:00:00:00:01")
+    transport, recorder = link(peer)
+    transport.connect(peer.mac)
+    recorder.wait("on_connected")
+    start = bytes([0, 0, 0, 0x13])
+
+    assert transport.write(HANDLES[updater.SUOTA_MEM_DEV_UUID], start, True) == 0
+    assert recorder.wait("on_write_status") == (
+        HANDLES[updater.SUOTA_MEM_DEV_UUID],
+        0,
+    )
+    assert "on_notification" not in recorder.names()
+
+    transport.subscribe(HANDLES[updater.SUOTA_SERV_STATUS_UUID])
+    transport.write(HANDLES[updater.SUOTA_MEM_DEV_UUID], start)
+    assert recorder.wait("on_notification") == (
+        HANDLES[updater.SUOTA_SERV_STATUS_UUID],
+        bytes([updater.SUOTA_STATUS_IMG_STARTED]),
+    )
+
+
+def test_reboot_drops_the_link(link):
+    peer = updater.SimSuotaPeer("00:00:00:00:00:01")
+    transport, recorder = link(peer)
+    transport.connect(peer.mac)
+    recorder.wait("on_connected")
+
+    transport.write(HANDLES[updater.SUOTA_MEM_DEV_UUID], bytes([0, 0, 0, 0xFD]))
+    recorder.wait("on_disconnected")
+    assert peer.rebooted and not peer.suota_mode
+    # Without a complete image the firmware stays the same
+    assert peer.fw_version == "1.0.0"
+
+
+def test_l2cap(link):
+    peer = updater.SimSuotaPeer("00:00:00:00:00:01", l2cap_psm=updater.SIM_L2CAP_PSM)
+    transport, recorder = link(peer)
+    assert transport.l2cap_send(b"\x00") == 1
+    transport.connect(peer.mac)
+    recorder.wait("on_connected")
+    transport.subscribe(HANDLES[updater.SUOTA_SERV_STATUS_UUID])
+
+    assert not transport.l2cap_connect(updater.SIM_L2CAP_PSM + 1)
+    assert transport.l2cap_connect(updater.SIM_L2CAP_PSM)
+    transport.write(HANDLES[updater.SUOTA_PATCH_LEN_UUID], (8).to_bytes(2, "little"))
+    assert transport.l2cap_send(bytes(5)) == 0
+    assert transport.l2cap_send(bytes(3)) == 0
+    assert recorder.wait("on_notification")[1] == bytes([updater.SUOTA_STATUS_CMP_OK])
+    assert transport.l2cap_send(bytes(9)) == 0
+    assert recorder.wait("on_notification")[1] == bytes(
+        [updater.SUOTA_STATUS_PATCH_LEN_ERR]
+    )
+    assert bytes(peer.image) == bytes(8)
+
+    transport.l2cap_close()
+    assert transport.l2cap_send(b"\x00") == 1
+
+
+def test_open_connection_shares_the_link(link):
+    first = updater.SimSuotaPeer("00:00:00:00:00:01")
+    second = updater.SimSuotaPeer("00:00:00:00:00:02")
+    transport, recorder = link(first, second)
+    other = Recorder()
+    connection = transport.open_connection(other)
+    try:
+        assert connection.link_lock is transport.link_lock
+        transport.connect(first.mac)
+        connection.connect(second.mac)
+        recorder.wait("on_connected")
+        other.wait("on_connected")
+        transport.disconnect()
+        recorder.wait("on_disconnected")
+        assert connection.is_connected() and second.connected
+    finally:
+        connection.close()
@@ -0,0 +1,69 @@
+import pytest
+
+import BleuIO_SUOTA_Updater as updater
+
+
+def test_ceiling_until_enough_samples():
+    rtt = updater.RttEstimator(1, 30)
+    for i in range(updater.RTT_MIN_SAMPLES - 1):
+        rtt.sample(0.1)
+        assert rtt.timeout() == 30
+    rtt.sample(0.1)
+    assert rtt.timeout() == 1
+
+
+def test_rfc6298_estimate():
+    rtt = updater.RttEstimator(0, 100)
+    rtt.sample(2.0)
+    assert (rtt.srtt, rtt.rttvar) == (2.0, 1.0)
+    rtt.sample(4.0)
+    assert rtt.rttvar == pytest.approx(0.75 * 1.0 + 0.25 * 2.0)
+    assert rtt.srtt == pytest.approx(0.875 * 2.0 + 0.125 * 4.0)
+    rtt.sample(4.0)
+    assert rtt.timeout() == pytest.approx(rtt.srtt + 4 * rtt.rttvar)
+
+
+def test_clamped_to_the_limits():
+    rtt = updater.RttEstimator(2, 10)
+    for rtt_s in (5.0, 0.1, 9.0, 0.2):
+        rtt.sample(rtt_s)
+    assert rtt.timeout() == 10
+    rtt.reset()
+    for i in range(10):
+        rtt.sample(0.01)
+    assert rtt.timeout() == 2
+
+
+def test_adaptive_timeouts():
+    timeouts = updater.AdaptiveTimeouts()
+    assert set(timeouts._rtt) == set(updater.TIMEOUT_LIMITS)
+    for op in ("read", "block"):
+        for i in range(updater.RTT_MIN_SAMPLES):
+            timeouts.sample(op, 0.05)
+        assert timeouts.get(op) == updater.TIMEOUT_LIMITS[op][0]
+    assert timeouts.get("write") == updater.TIMEOUT_LIMITS["write"][1]
+    assert "read: 1.00s (srtt 0.050s, n=3)" in timeouts.summary()
+
+    # Only the device dependent timeouts are measured again for a session
+    timeouts.new_session()
+    assert timeouts.get("block") == updater.TIMEOUT_LIMITS["block"][1]
+    assert timeouts.get("read") == updater.TIMEOUT_LIMITS["read"][0]
+
+    timeouts.enabled = False
+    assert timeouts.get("read") == updater.TIMEOUT_LIMITS["read"][1]
+
+
+def test_session_measures_its_timeouts(sim, sim_image):
+    image = sim_image("3.1.4")
+    peer = updater.SimSuotaPeer("00:00:00:00:00:01")
+    sim(peer)
+    shared = updater.AdaptiveTimeouts()
+    session = updater.SuotaSession(peer.mac, image, shared_timeouts=shared)
+    session.run()
+
+    assert session.success, session.error
+    assert shared._rtt["read"].samples >= updater.RTT_MIN_SAMPLES
+    assert shared._rtt["start"].samples == 1
+    assert shared._rtt["end"].samples == 1
+    assert shared._rtt["block"].samples == -(-len(image) // 512)
+    assert shared.get("block") == updater.TIMEOUT_LIMITS["block"][0]
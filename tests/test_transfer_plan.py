@@ -0,0 +1,153 @@
+import pytest
+
+import BleuIO_SUOTA_Updater as updater
+
+
+def baseline_walk(image_size, chunk_size, block_size):
+    """The transfer as the next_block()/next_chunk() globals walked it before the plan.
+
+    Returns the chunk writes as (block index, offset, length) and the
+    SUOTA_PATCH_LEN writes as (block index, value).
+    """
+    chunks = []
+    patch_len_writes = []
+    block = 0
+    block_offset = 0
+    block_length = min(block_size, image_size)
+
+    def write_chunks():
+        chunk_offset = 0
+        chunk_length = min(chunk_size, block_length)
+        while True:
+            chunks.append((block, block_offset + chunk_offset, chunk_length))
+            if chunk_offset + chunk_length == block_length:
+                return
+            chunk_offset += chunk_length
+            chunk_length = min(chunk_size, block_length - chunk_offset)
+
+    def is_last_block():
+        return block_offset + block_length == image_size
+
+    patch_len_writes.append((block, block_length))
+    write_chunks()
+    while not is_last_block():
+        block += 1
+        block_offset += block_length
+        block_length = min(block_size, image_size - block_offset)
+        if is_last_block():
+            # Written again for the last block, whatever its length
+            patch_len_writes.append((block, block_length))
+        else:
+            write_chunks()
+    write_chunks()
+    return chunks, patch_len_writes
+
+
+GEOMETRIES = [
+    updater.suota_geometry(23, 244),
+    updater.suota_geometry(247, 244),
+    updater.suota_geometry(512, 244),
+    (20, 240),
+    (244, 244),
+    (100, 250),
+]
+
+
+@pytest.mark.parametrize("chunk_size,block_size", GEOMETRIES)
+@pytest.mark.parametrize("extra", [0, 1, -1, 17])
+def test_plan_matches_baseline(chunk_size, block_size, extra):
+    for blocks in (2, 3, 10):
+        image_size = blocks * block_size + extra
+        plan = updater.TransferPlan(image_size, chunk_size, block_size)
+        chunks, patch_len_writes = baseline_walk(image_size, chunk_size, block_size)
+
+        assert [entry[:3] for entry in plan] == chunks
+        # The plan skips the write of a length the device already has
+        current = 0
+        expected = []
+        for block, value in patch_len_writes:
+            if not value == current:
+                expected.append((block, value))
+                current = value
+        assert [(entry[0], entry[3]) for entry in plan if entry[3]] == expected
+        assert plan.patch_len_writes() == len(expected)
+        assert plan.blocks == chunks[-1][0] + 1
+
+
+@pytest.mark.parametrize("chunk_size,block_size", GEOMETRIES)
+@pytest.mark.parametrize("image_size", [1, 19, 240, 241, 1000, 20001])
+def test_plan_entries(chunk_size, block_size, image_size):
+    plan = updater.TransferPlan(image_size, chunk_size, block_size)
+
+    # The entries cover the image once, in order
+    offset = 0
+    for block, entry_offset, length, patch_len in plan:
+        assert entry_offset == offset
+        assert 0 < length <= chunk_size
+        assert block == entry_offset // block_size
+        offset += length
+    assert offset == image_size
+    assert (
+        len(plan)
+        == updater.transfer_counts(image_size, chunk_size, block_size)["chunk_writes"]
+    )
+
+    for block in range(plan.blocks):
+        entries = plan.block(block)
+        assert entries[0][1] == block * block_size
+        assert entries[-1][1] + entries[-1][2] == plan.block_end(block)
+        assert all(entry[0] == block for entry in entries)
+        # Only the first chunk of a block can carry its length
+        assert not any(entry[3] for entry in entries[1:])
+    assert plan[0][3] == plan.block_end(0)
+    assert plan[-1] == plan[len(plan) - 1]
+    with pytest.raises(IndexError):
+        plan[len(plan)]
+
+
+@pytest.mark.parametrize("chunk_size,block_size", GEOMETRIES)
+def test_plan_index(chunk_size, block_size):
+    image_size = 3 * block_size + 7
+    plan = updater.TransferPlan(image_size, chunk_size, block_size)
+    for offset in range(image_size):
+        block, entry_offset, length, patch_len = plan[plan.index(offset)]
+        assert entry_offset <= offset < entry_offset + length
+    for block in range(plan.blocks):
+        assert plan[plan.index(block * block_size)] == plan.block(block)[0]
+
+
+@pytest.mark.parametrize("l2cap_psm", [None, updater.SIM_L2CAP_PSM])
+def test_sim_update(sim, sim_image, l2cap_psm):
+    image = sim_image("3.1.4")
+    peer = updater.SimSuotaPeer(
+        "00:00:00:00:00:01",
+        new_fw_version=updater.image_version(image),
+        l2cap_psm=l2cap_psm,
+    )
+    sim(peer)
+    record = updater.SessionRecord(concurrency=1)
+    session = updater.SuotaSession(peer.mac, image, record)
+    session.run()
+
+    assert session.success, session.error
+    assert session.status == updater.SUOTA_STATUS_CMP_OK
+    assert session.link == ("gatt" if l2cap_psm is None else "l2cap")
+    assert session.old_version == "1.0.0"
+    assert session.bytes_sent == len(image)
+    assert bytes(peer.image) == image
+    assert peer.rebooted
+    assert peer.fw_version == "3.1.4"
+    assert not peer.connected
+
+
+def test_sim_update_crc_error(sim, sim_image):
+    image = sim_image("3.1.4")
+    peer = updater.SimSuotaPeer("00:00:00:00:00:01", crc_error=True)
+    sim(peer)
+    session = updater.SuotaSession(peer.mac, image)
+    session.run()
+
+    assert not session.success
+    assert session.status == updater.SUOTA_STATUS_CRC_ERR
+    assert not peer.rebooted
+    assert peer.fw_version == "1.0.0"